@@ -0,0 +1,83 @@
+from argparse import ArgumentParser
+from json import dumps
+from platform import python_implementation
+from platform import python_version
+from subprocess import DEVNULL
+from subprocess import CalledProcessError
+from subprocess import check_output
+from sys import stdout
+from time import perf_counter
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from trio import run
+
+# a benchmark returns the number of operations it timed, the seconds it took
+# and any other measure (e.g. bytes per operation)
+Result = Tuple[int, float, Dict[str, Any]]
+Benchmark = Callable[..., Awaitable[Result]]
+
+
+def commit() -> Optional[str]:
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                            stderr=DEVNULL, text=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+class timer:
+    '''accumulate the time spent inside the with blocks'''
+
+    def __init__(self) -> None:
+        self.seconds = 0.
+
+    def __enter__(self) -> 'timer':
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.seconds += perf_counter() - self.start
+
+
+def report(name: str, params: Dict[str, Any], ops: int, seconds: float,
+           **extra: Any) -> Dict[str, Any]:
+    '''one json line per measurement, so the output of different commits
+    can be compared with any tool'''
+    return {'benchmark': name,
+            'params': params,
+            'ops': ops,
+            'seconds': seconds,
+            'ops_per_sec': ops / seconds if seconds else None,
+            'usec_per_op': 1e6 * seconds / ops if ops else None,
+            **extra}
+
+
+def main(benchmarks: Dict[str, Tuple[Benchmark, List[Dict[str, Any]]]],
+         argv: Optional[Sequence[str]] = None) -> None:
+    '''run each benchmark on each set of params, repeat times, and print the
+    best run (the least disturbed by the rest of the machine)'''
+    parser = ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-k', dest='only', action='append',
+                        help='run only the benchmarks with this substring')
+    args = parser.parse_args(argv)
+
+    context = {'commit': commit(),
+               'python': f'{python_implementation()} {python_version()}'}
+    for name, (benchmark, all_params) in benchmarks.items():
+        if args.only and not any(only in name for only in args.only):
+            continue
+        for params in all_params:
+            results = [run(lambda: benchmark(**params))
+                       for _ in range(args.repeat)]
+            ops, seconds, measures = min(results, key=lambda result: result[1])
+            print(dumps(report(name, params, ops, seconds,
+                               **measures, **context)),
+                  file=stdout, flush=True)
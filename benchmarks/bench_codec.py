@@ -0,0 +1,123 @@
+'''the journal codecs against jsonlines
+
+run with `python -m benchmarks.bench_codec`; the jsonlines numbers are for a
+json projection of the messages (enums as names, boards as FEN + uci
+moves), not rebuilt into the dataclasses, so they are a lower bound
+'''
+
+from dataclasses import asdict
+from enum import Enum
+from io import StringIO
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from chess import Board
+from jsonlines import Reader
+from jsonlines import Writer
+
+from moves.rest.codec import BINARY
+from moves.rest.types import Command
+from moves.rest.types import GameUniverse
+from moves.rest.types import InputQueueElement
+from moves.rest.types import Move
+from moves.rest.types import OutputQueueElement
+from moves.rest.types import Player
+from moves.rest.types import PlayerType
+from moves.rest.types import Result
+
+from ._support_for_benchmarks import Benchmark
+from ._support_for_benchmarks import Result as BenchmarkResult
+from ._support_for_benchmarks import main
+from ._support_for_benchmarks import timer
+
+# a game of 40 plies
+MOVES = ('e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7 f1e1 b7b5 a4b3 '
+         'd7d6 c2c3 e8g8 h2h3 c6b8 d2d4 b8d7 c3c4 c7c6 c4b5 a6b5 b1c3 c8b7 '
+         'c1g5 b5b4 c3b1 h7h6 g5h4 c6c5 d4e5 f6e4 h4e7 d8e7 e5d6 e7f6 b1d2 '
+         'e4d6').split()
+
+
+def _messages(kind: str) -> List[Any]:
+    white = Player('2f0c6e1a-cd7e-4b8a-9f0e-0a1b2c3d4e5f', PlayerType.HUMAN)
+    black = Player('9d8c7b6a-5e4f-4a3b-8c2d-1e0f9a8b7c6d', PlayerType.CPU)
+    if kind == 'input':
+        return [InputQueueElement(Command.MOVE, game_id='game_id',
+                                  move=Move(move, white.player_id))
+                for move in MOVES]
+    board = Board()
+    acc = []
+    for move in MOVES:
+        board.push_uci(move)
+        acc.append(OutputQueueElement(
+            Result.MOVE, GameUniverse('game_id', board, white, black).snapshot(),
+            move=move))
+    return acc
+
+
+def _jsonable(obj: Any) -> Any:
+    if isinstance(obj, Enum):
+        return obj.name
+    if isinstance(obj, Board):
+        return {'fen': obj.root().fen(),
+                'moves': [move.uci() for move in obj.move_stack]}
+    if isinstance(obj, dict):
+        return {k: _jsonable(v) for k, v in obj.items()}
+    return obj
+
+
+def _projection(message: Any) -> Any:
+    return _jsonable(asdict(message))
+
+
+async def encode(codec: str, kind: str, rounds: int) -> BenchmarkResult:
+    messages = _messages(kind)
+    t = timer()
+    size = 0
+    if codec == 'jsonlines':
+        projections = [_projection(message) for message in messages]
+        for _ in range(rounds):
+            io = StringIO()
+            with t:
+                Writer(io).write_all(projections)
+            size = len(io.getvalue())
+    else:
+        for _ in range(rounds):
+            with t:
+                frames = [BINARY.encode(message) for message in messages]
+            size = sum(len(frame) for frame in frames)
+    return (rounds * len(messages), t.seconds,
+            {'bytes_per_op': size / len(messages)})
+
+
+async def decode(codec: str, kind: str, rounds: int) -> BenchmarkResult:
+    messages = _messages(kind)
+    t = timer()
+    if codec == 'jsonlines':
+        io = StringIO()
+        Writer(io).write_all(_projection(message) for message in messages)
+        for _ in range(rounds):
+            io.seek(0)
+            with t:
+                list(Reader(io))
+    else:
+        data = b''.join(BINARY.encode(message) for message in messages)
+        for _ in range(rounds):
+            with t:
+                [BINARY.decode(data[start:end])
+                 for start, end in BINARY.split(data)]
+    return rounds * len(messages), t.seconds, {}
+
+
+BENCHMARKS: Dict[str, Tuple[Benchmark, List[Dict[str, Any]]]] = {
+    'encode': (encode, [{'codec': codec, 'kind': kind, 'rounds': 100}
+                        for kind in ('input', 'output')
+                        for codec in ('jsonlines', 'binary')]),
+    'decode': (decode, [{'codec': codec, 'kind': kind, 'rounds': 100}
+                        for kind in ('input', 'output')
+                        for codec in ('jsonlines', 'binary')]),
+}
+
+if __name__ == '__main__':
+    main(BENCHMARKS)
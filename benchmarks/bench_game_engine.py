@@ -0,0 +1,78 @@
+'''the per-move cost of the game engine
+
+run with `python -m benchmarks.bench_game_engine`; 'board' is the original
+move handling (Board.parse_uci, push, is_game_over, and an outcome() per
+output consumer), 'position' the same through a Position (the outcome
+computed once per position), 'handle' the whole game_engine.handle
+'''
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from chess import Board
+
+from moves.rest.game_engine import handle
+from moves.rest.multiverse import Multiverse
+from moves.rest.position import Position
+from moves.rest.types import Command
+from moves.rest.types import InputQueueElement
+from moves.rest.types import Move
+from moves.rest.types import Player
+from moves.rest.types import PlayerType
+
+from ._support_for_benchmarks import Benchmark
+from ._support_for_benchmarks import Result
+from ._support_for_benchmarks import main
+from ._support_for_benchmarks import timer
+from .bench_codec import MOVES
+
+WHITE = Player('2f0c6e1a-cd7e-4b8a-9f0e-0a1b2c3d4e5f', PlayerType.HUMAN)
+BLACK = Player('9d8c7b6a-5e4f-4a3b-8c2d-1e0f9a8b7c6d', PlayerType.HUMAN)
+
+
+async def move(method: str, rounds: int, consumers: int) -> Result:
+    '''play the game rounds times; each operation is a move, whose outcome
+    is read by consumers output consumers (say, /register and save)'''
+    t = timer()
+    for _ in range(rounds):
+        if method == 'board':
+            board = Board()
+            with t:
+                for uci in MOVES:
+                    board.push(board.parse_uci(uci))
+                    board.is_game_over()
+                    for _ in range(consumers):
+                        board.outcome()
+        elif method == 'position':
+            game_position = Position(Board())
+            with t:
+                for uci in MOVES:
+                    game_position.push(game_position.parse_uci(uci))
+                    for _ in range(consumers):
+                        game_position.outcome
+        else:
+            games = Multiverse()
+            list(handle(games, InputQueueElement(Command.NEW_GAME,
+                                                 white=WHITE, black=BLACK,
+                                                 game_id='game_id')))
+            inputs = [InputQueueElement(Command.MOVE, game_id='game_id',
+                                        move=Move(uci, player.player_id))
+                      for uci, player in zip(MOVES, [WHITE, BLACK] * len(MOVES))]
+            with t:
+                for input_element in inputs:
+                    for output_element in handle(games, input_element):
+                        for _ in range(consumers):
+                            output_element.snapshot.outcome
+    return rounds * len(MOVES), t.seconds, {}
+
+
+BENCHMARKS: Dict[str, Tuple[Benchmark, List[Dict[str, Any]]]] = {
+    'move': (move, [{'method': method, 'rounds': 100, 'consumers': consumers}
+                    for consumers in (0, 2)
+                    for method in ('board', 'position', 'handle')]),
+}
+
+if __name__ == '__main__':
+    main(BENCHMARKS)
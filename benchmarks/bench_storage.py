@@ -0,0 +1,98 @@
+'''cold start of the journal: recovery of all the topics, or of one
+
+run with `python -m benchmarks.bench_storage`; 'jsonlines' is the original
+recovery (every line parsed through a python file object, held in memory
+by topic), the others go through Journal, whose sealed segments are read
+through the index (unsealed ones are scanned)
+'''
+
+from collections import defaultdict
+from os import remove
+from os.path import dirname
+from os.path import join
+from tempfile import TemporaryDirectory
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from jsonlines import open
+
+from moves.rest.codec import BINARY
+from moves.rest.codec import JSON
+from moves.rest.storage import Journal
+from moves.rest.types import Command
+from moves.rest.types import InputQueueElement
+from moves.rest.types import Move
+
+from ._support_for_benchmarks import Benchmark
+from ._support_for_benchmarks import Result
+from ._support_for_benchmarks import main
+from ._support_for_benchmarks import timer
+
+MOVES = ['e2e4', 'e7e5', 'g1f3', 'b8c6', 'f1b5', 'a7a6', 'b5a4', 'g8f6']
+
+
+def _line(codec: str, i: int, topics: int) -> Tuple[Any, str]:
+    game_id = f'game_{i % topics}'
+    move = MOVES[i // topics % len(MOVES)]
+    user_id = '2f0c6e1a-cd7e-4b8a-9f0e-0a1b2c3d4e5f'
+    if codec == 'binary':
+        return (InputQueueElement(Command.MOVE, game_id=game_id,
+                                  move=Move(move, user_id)),
+                f'input/{game_id}')
+    return ({'command': 'MOVE', 'game_id': game_id,
+             'move': {'move': move, 'user_id': user_id}},
+            f'input/{game_id}')
+
+
+def _write(fn: str, codec: str, messages: int, topics: int,
+           sealed: bool) -> None:
+    journal = Journal(fn, commit_interval=None,
+                      codec=BINARY if codec == 'binary' else JSON)
+    journal.write([_line(codec, i, topics) for i in range(messages)])
+    journal.close()
+    if not sealed:
+        # as if the process died before sealing the segment
+        remove(join(dirname(fn), 'storage.000001.idx'))
+
+
+async def recovery(codec: str, messages: int, topics: int, sealed: bool,
+                   read_topics: int) -> Result:
+    '''open the journal and read read_topics topics; each operation is a
+    journaled message (read or skipped)'''
+    with TemporaryDirectory() as tmp:
+        fn = join(tmp, 'storage.jsonl')
+        _write(fn, 'json' if codec == 'jsonlines' else codec, messages,
+               topics, sealed)
+        t = timer()
+        with t:
+            if codec == 'jsonlines':
+                old_messages: Dict[str, List[Any]] = defaultdict(list)
+                with open(join(tmp, 'storage.000001.jsonl'), 'r') as reader:
+                    for message, topic_id in reader:
+                        old_messages[topic_id].append(message)
+                for i in range(read_topics):
+                    old_messages.pop(f'input/game_{i}')
+            else:
+                journal = Journal(fn, commit_interval=None,
+                                  codec=BINARY if codec == 'binary' else JSON)
+                for i in range(read_topics):
+                    journal.read(f'input/game_{i}')
+        if codec != 'jsonlines':
+            journal.close()
+    return messages, t.seconds, {}
+
+
+BENCHMARKS: Dict[str, Tuple[Benchmark, List[Dict[str, Any]]]] = {
+    'recovery': (recovery, [{'codec': codec, 'messages': 100_000,
+                             'topics': 1_000, 'sealed': sealed,
+                             'read_topics': read_topics}
+                            for read_topics in (1_000, 1)
+                            for codec in ('jsonlines', 'json', 'binary')
+                            for sealed in (True, False)
+                            if codec != 'jsonlines' or sealed]),
+}
+
+if __name__ == '__main__':
+    main(BENCHMARKS)
@@ -0,0 +1,146 @@
+'''microbenchmarks of the broker hot paths
+
+run with `python -m benchmarks.bench_triopubsub > results.jsonl`: each line
+is a json object with the benchmark name, its params, the timings and the
+commit, so the results of two commits can be compared line by line
+'''
+
+from gc import collect
+from tracemalloc import get_traced_memory
+from tracemalloc import start
+from tracemalloc import stop
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from trio import WouldBlock
+
+from moves.triopubsub import Broker
+from moves.triopubsub import Record
+from moves.triopubsub import Subscription
+
+from ._support_for_benchmarks import Benchmark
+from ._support_for_benchmarks import Result
+from ._support_for_benchmarks import main
+from ._support_for_benchmarks import timer
+
+ROUND = 100  # messages sent between two drains of the subscriptions
+
+
+def _drain(subscriptions: List[Subscription[Any]]) -> None:
+    '''consume the queued messages, as the subscribers would'''
+    for subscription in subscriptions:
+        records: List[Record[Any]] = []
+        while True:
+            try:
+                records.append(subscription.r.receive_nowait())
+            except WouldBlock:
+                break
+        if records:
+            subscription._received(records)
+
+
+async def fan_out(subscribers: int, messages: int, batch: int) -> Result:
+    '''Broker.send (batch=1) or Broker.send_many throughput with N
+    subscribers on the topic; each operation is one message'''
+    b = Broker()
+    try:
+        b.add_topic('t', str)
+        subscriptions = [b.add_subscription('t', f's{i}', str)
+                         for i in range(subscribers)]
+        payload = [f'message {i}' for i in range(batch)]
+        t = timer()
+        for _ in range(messages // ROUND):
+            with t:
+                if batch == 1:
+                    for _ in range(ROUND):
+                        b.send(payload[0], 't')
+                else:
+                    for _ in range(ROUND // batch):
+                        b.send_many(payload, 't')
+            _drain(subscriptions)
+        return messages // ROUND * ROUND, t.seconds, {}
+    finally:
+        await b.aclose()
+
+
+async def replay(history: int, subscriptions: int) -> Result:
+    '''add_subscription with send_old_messages on a topic with history
+    messages retained; each operation is one new subscription'''
+    b = Broker()
+    try:
+        b.add_topic('t', str)
+        b.send_many([f'message {i}' for i in range(history)], 't')
+        t = timer()
+        for i in range(subscriptions):
+            with t:
+                b.add_subscription('t', f's{i}', str)
+            await b.remove_subscription('t', f's{i}')
+        return subscriptions, t.seconds, {}
+    finally:
+        await b.aclose()
+
+
+async def tmp_subscription_churn(topics: int, history: int,
+                                 subscriptions: int) -> Result:
+    '''a tmp_subscription created and removed, as done by every
+    /start_new_game on the output/* pattern, with topics game topics of
+    history messages each'''
+    b = Broker()
+    try:
+        for i in range(topics):
+            b.add_topic(f'output/{i}', str)
+            b.send_many([f'message {j}' for j in range(history)],
+                        f'output/{i}')
+        t = timer()
+        for _ in range(subscriptions):
+            with t:
+                async with b.tmp_subscription('output/*', str,
+                                              send_old_messages=False):
+                    pass
+        return subscriptions, t.seconds, {}
+    finally:
+        await b.aclose()
+
+
+async def retained_memory(messages: int, size: int) -> Result:
+    '''memory the broker holds for each retained message, on top of the
+    message itself (allocated beforehand); each operation is one send'''
+    b = Broker()
+    try:
+        b.add_topic('t', str)
+        payload = [f'{i:0{size}}' for i in range(messages)]
+        collect()
+        start()
+        try:
+            before, _ = get_traced_memory()
+            t = timer()
+            with t:
+                for message in payload:
+                    b.send(message, 't')
+            after, _ = get_traced_memory()
+        finally:
+            stop()
+        return messages, t.seconds, {'bytes_per_op': (after - before) / messages}
+    finally:
+        await b.aclose()
+
+
+BENCHMARKS: Dict[str, Tuple[Benchmark, List[Dict[str, Any]]]] = {
+    'fan_out': (fan_out, [{'subscribers': subscribers, 'messages': 10_000,
+                           'batch': batch}
+                          for subscribers in (0, 1, 10, 100)
+                          for batch in (1, ROUND)]),
+    'replay': (replay, [{'history': history, 'subscriptions': 100}
+                        for history in (0, 100, 1_000, 10_000)]),
+    'tmp_subscription_churn': (tmp_subscription_churn,
+                               [{'topics': topics, 'history': 100,
+                                 'subscriptions': 1_000}
+                                for topics in (1, 10, 100, 1_000)]),
+    'retained_memory': (retained_memory, [{'messages': 10_000, 'size': size}
+                                          for size in (10, 1_000)]),
+}
+
+if __name__ == '__main__':
+    main(BENCHMARKS)
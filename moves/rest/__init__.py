@@ -1,4 +1,11 @@
+from argparse import ArgumentParser
+from functools import partial
 from logging import Logger
+from os.path import join
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
 
 from trio import open_nursery
 from trio import run
@@ -6,20 +13,78 @@ from trio import run
 from ..configurations import running_on_ec2
 from ..logs import setup_logs
 from ..triopubsub import Broker
+from ..triopubsub import PubSub
+from ..triopubsub_unix import open_remote_broker
+from ..triopubsub_unix import serve_broker
+from .book import OpeningBook
+from .codec import BINARY
+from .constants import BROKER_SOCKET
+from .constants import CPU_MOVE_SLO
+from .constants import GAMES_CAPACITY
+from .constants import GAMES_MAX_IDLE
+from .constants import INPUT_RETENTION
 from .constants import INPUT_TOPIC
-from .constants import OUTPUT_TOPIC
+from .constants import METRICS_TOPICS
+from .constants import MOVES_CACHE_CAPACITY
 from .cpu import cpu
+from .engines import MAX_ENGINES
 from .save import save
 from .game_engine import game_engine
+from .game_engine import shard_of
+from .movecache import MoveCache
+from .multiverse import Multiverse
 from .rest import rest
+from .storage import load_broker
 from .types import InputQueueElement
-from .types import OutputQueueElement
 
 setup_logs(__name__)
 LOGS = Logger(__name__)
 
 
-async def parent() -> None:
+def mk_games(directory: Optional[str], shard: int = 0,
+             shards: int = 1) -> Optional[Multiverse]:
+    '''the games of a game engine, evicted to directory (if any); with
+    shards, each shard has a subdirectory of its own (directory/<shard>)'''
+    if directory is None:
+        return None
+    if shards > 1:
+        directory = join(directory, str(shard))
+    return Multiverse(directory, capacity=GAMES_CAPACITY,
+                      max_idle=GAMES_MAX_IDLE)
+
+
+def mk_moves(path: Optional[str]) -> MoveCache:
+    'the moves cache of the cpu players, persisted to path (if any)'
+    return MoveCache(MOVES_CACHE_CAPACITY, path)
+
+
+def mk_book(path: Optional[str]) -> Optional[OpeningBook]:
+    'the opening book of the cpu players, if any'
+    if path is None:
+        return None
+    return OpeningBook(path)
+
+
+def mk_broker(journal: Optional[str] = None, shards: int = 1) -> Broker:
+    '''the broker, with the input topic (the game engine adds an output
+    topic per game); with a journal the topics are restored from it, with
+    shards the inputs are keyed by the shard of their game'''
+    broker = Broker()
+    if journal is not None:
+        load_broker(journal, broker, codec=BINARY, exclude=[METRICS_TOPICS])
+    broker.add_topic(INPUT_TOPIC, InputQueueElement,
+                     retention=INPUT_RETENTION,
+                     key=partial(shard_of, shards=shards) if shards > 1 else None)
+    return broker
+
+
+async def parent(journal: Optional[str] = None, shards: int = 1,
+                 games: Optional[str] = None,
+                 engines: int = MAX_ENGINES,
+                 moves: Optional[str] = None,
+                 book: Optional[str] = None,
+                 slo: float = CPU_MOVE_SLO,
+                 ponder: bool = False) -> None:
     '''Main entry point; the goal is to juggle 3 actors:
     - game_engine: the games (plural)
     - cpu: pc players (plural)
@@ -30,35 +95,142 @@ async def parent() -> None:
     cpu handle incoming messages to deal with a move
         send messages to game_engine to signal a move
     rest is similar to cpu, but exposes the API trough REST/WEBSOCKET endpoints
+
+    with a journal, game_engine rebuilds the games from the journaled inputs;
+    with shards, the games are split among as many game_engine tasks; with
+    games, the idle and ended games are moved to that directory; cpu plays
+    with a pool of engines, and remembers their moves in moves; and plays
+    the openings from book, and a move in slo seconds; with ponder, it
+    thinks on the time of the humans too
     '''
 
-    # 2 topics (in+out) - the needed subscription will be created by each task
-    broker = Broker()
-    broker.add_topic(INPUT_TOPIC, InputQueueElement)
-    broker.add_topic(OUTPUT_TOPIC, OutputQueueElement)
+    # the topics - the needed subscription will be created by each task
+    broker = mk_broker(journal, shards)
 
     try:
         async with open_nursery() as nursery:
             # game engine
-            nursery.start_soon(game_engine, broker)
+            for shard in range(shards):
+                nursery.start_soon(partial(game_engine,
+                                           recover_games=journal is not None,
+                                           shard=shard, shards=shards,
+                                           games=mk_games(games, shard,
+                                                          shards)),
+                                   broker)
 
             # input and output from/to humans
             nursery.start_soon(rest, broker)
 
             # input and output from/to cpu
-            nursery.start_soon(cpu, broker)
+            nursery.start_soon(partial(cpu, engines=engines,
+                                       cache=mk_moves(moves),
+                                       book=mk_book(book), slo=slo,
+                                       ponder=ponder),
+                               broker)
 
             # store game results
             nursery.start_soon(save, broker)
     finally:
         await broker.remove_topic(INPUT_TOPIC)
-        await broker.remove_topic(OUTPUT_TOPIC)
         await broker.aclose()
 
 
+# the actors that can run in a process of their own
+ROLES: Dict[str, Callable[[PubSub], Awaitable[None]]] = {
+    'engine': game_engine,
+    'rest': rest,
+    'cpu': cpu,
+    'save': save}
+
+
+async def broker_process(path: str, journal: Optional[str] = None,
+                         shards: int = 1) -> None:
+    'serve the broker to the other processes'
+    broker = mk_broker(journal, shards)
+    try:
+        await serve_broker(broker, path)
+    finally:
+        await broker.aclose()
+
+
+async def actor_process(role: str, path: str, recover: bool = False,
+                        shard: int = 0, shards: int = 1,
+                        games: Optional[str] = None,
+                        engines: int = MAX_ENGINES,
+                        moves: Optional[str] = None,
+                        book: Optional[str] = None,
+                        slo: float = CPU_MOVE_SLO,
+                        ponder: bool = False) -> None:
+    'run a single actor, connected to the broker process'
+    async with open_remote_broker(path) as broker:
+        if role == 'engine':
+            await game_engine(broker, recover_games=recover,
+                              shard=shard, shards=shards,
+                              games=mk_games(games, shard, shards))
+        elif role == 'cpu':
+            await cpu(broker, engines=engines, cache=mk_moves(moves),
+                      book=mk_book(book), slo=slo, ponder=ponder)
+        else:
+            await ROLES[role](broker)
+
+
 def main() -> None:
+    parser = ArgumentParser(prog='moves-rest')
+    parser.add_argument('--role',
+                        choices=['all', 'broker', *ROLES],
+                        default='all',
+                        help='run everything in a process (all), or only '
+                             'the broker, or only an actor connected to '
+                             'the broker process')
+    parser.add_argument('--socket', default=BROKER_SOCKET,
+                        help='the unix socket of the broker process')
+    parser.add_argument('--journal',
+                        help='journal the topics (all, broker) in this '
+                             'file, and restore them at startup')
+    parser.add_argument('--recover', action='store_true',
+                        help='rebuild the games from the journaled inputs '
+                             '(engine; implied by --journal with all)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='split the games among this many game engines '
+                             '(all, broker, engine)')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='the games handled by this engine (engine, '
+                             'from 0 to shards - 1)')
+    parser.add_argument('--games',
+                        help='move the idle and the ended games to this '
+                             'directory (all, engine; a subdirectory per '
+                             'shard)')
+    parser.add_argument('--engines', type=int, default=MAX_ENGINES,
+                        help='the size of the pool of engines (all, cpu; '
+                             'at most one per core)')
+    parser.add_argument('--moves',
+                        help='keep the moves found by the engines in this '
+                             'file (all, cpu)')
+    parser.add_argument('--book',
+                        help='play the openings from this polyglot book '
+                             '(all, cpu)')
+    parser.add_argument('--slo', type=float, default=CPU_MOVE_SLO,
+                        help='the seconds for a cpu move: the engines think '
+                             'less under load (all, cpu)')
+    parser.add_argument('--ponder', action='store_true',
+                        help='search the expected replies of the humans '
+                             'with the idle engines (all, cpu)')
+    args = parser.parse_args()
+
+    afn: Callable[[], Awaitable[None]]
+    if args.role == 'all':
+        afn = partial(parent, args.journal, args.shards, args.games,
+                      args.engines, args.moves, args.book, args.slo,
+                      args.ponder)
+    elif args.role == 'broker':
+        afn = partial(broker_process, args.socket, args.journal, args.shards)
+    else:
+        afn = partial(actor_process, args.role, args.socket, args.recover,
+                      args.shard, args.shards, args.games, args.engines,
+                      args.moves, args.book, args.slo, args.ponder)
+
     if running_on_ec2():
         from trio_asyncio import run as trio_asyncio_run
-        trio_asyncio_run(parent)
+        trio_asyncio_run(afn)
     else:
-        run(parent)
+        run(afn)
@@ -0,0 +1,50 @@
+'''an opening book (polyglot .bin), to play the openings without an engine
+
+the book is memory mapped, and a position is looked up by a binary search
+of its zobrist hash
+'''
+
+from logging import getLogger
+from random import Random
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+from chess import Board
+from chess import Move
+from chess.polyglot import open_reader
+
+LOGS = getLogger(__name__)
+
+
+class OpeningBook:
+    '''the moves of a polyglot book, chosen at random by their weight (so
+    the cpu does not always play the same opening)'''
+
+    def __init__(self, path: str, random: Optional[Random] = None) -> None:
+        self.reader = open_reader(path)
+        self.random = random if random is not None else Random()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        LOGS.info('opened the book %s (%d entries)', path, len(self.reader))
+
+    def move(self, board: Board) -> Optional[Move]:
+        'a book move of the position, or None if out of book'
+        try:
+            entry = self.reader.weighted_choice(board, random=self.random)
+        except IndexError:
+            self.misses += 1
+            return None
+        if not board.is_legal(entry.move):  # a collision of the hashes
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.move
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'hits': self.hits,
+                'misses': self.misses}
+
+    def close(self) -> None:
+        self.reader.close()
@@ -0,0 +1,477 @@
+'''encodings of the messages journaled by storage
+
+a codec turns an object in a self-delimited frame and back: JsonCodec
+writes json lines (only for json-like values), BinaryCodec a compact,
+length-prefixed, encoding that also covers the types in moves.rest.types
+(moves as 16 bits, boards as start FEN + move stack, enums as ints)
+'''
+
+from json import dumps
+from json import loads
+from pickle import HIGHEST_PROTOCOL
+from pickle import dumps as pickle_dumps
+from pickle import loads as pickle_loads
+from struct import Struct
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Protocol
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+from typing import cast
+
+from chess import STARTING_FEN
+from chess import Board
+from chess import Move as ChessMove
+from chess import Outcome
+from chess import Termination
+
+from .types import Command
+from .types import GameUniverse
+from .types import InputQueueElement
+from .types import Move
+from .types import OutputQueueElement
+from .types import Player
+from .types import PlayerType
+from .types import Result
+from .types import Snapshot
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class Codec(Protocol):
+    def encode(self, obj: Any) -> bytes:
+        'a frame with obj'
+
+    def decode(self, frame: Buffer) -> Any:
+        'the object in a frame'
+
+    def decode_many(self, data: Sequence[Buffer]) -> List[Any]:
+        'the objects in the frames in data (each item can hold many frames)'
+
+    def split(self, data: Buffer) -> Iterator[Tuple[int, int]]:
+        '''the [start, end) of the complete frames in data (a truncated last
+        frame is skipped)'''
+
+
+class JsonCodec:
+    'json lines, ascii only'
+
+    def encode(self, obj: Any) -> bytes:
+        return (dumps(obj) + '\n').encode('ascii')
+
+    def decode(self, frame: Buffer) -> Any:
+        return loads(str(frame, 'ascii'))
+
+    def decode_many(self, data: Sequence[Buffer]) -> List[Any]:
+        # the lines as items of a single json array: a single loads call
+        items = b','.join(bytes(lines).rstrip(b'\n').replace(b'\n', b',')
+                          for lines in data)
+        return cast(List[Any], loads(b'[' + items + b']'))
+
+    def split(self, data: Buffer) -> Iterator[Tuple[int, int]]:
+        data = bytes(data) if isinstance(data, memoryview) else data
+        start = 0
+        while True:
+            end = data.find(b'\n', start) + 1
+            if not end:
+                return
+            yield start, end
+            start = end
+
+
+# tags
+
+_NONE = 0
+_FALSE = 1
+_TRUE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_BYTES = 6
+_LIST = 7
+_TUPLE = 8
+_DICT = 9
+_PLAYER_TYPE = 16
+_COMMAND = 17
+_RESULT = 18
+_PLAYER = 32
+_MOVE = 33
+_GAME_UNIVERSE = 34
+_INPUT_QUEUE_ELEMENT = 35
+_OUTPUT_QUEUE_ELEMENT = 36
+_SNAPSHOT = 37
+_BOARD = 40
+_CHESS_MOVE = 41
+_UCI = 42  # a str with an uci move
+_OUTCOME = 43
+_PICKLE = 255  # anything else
+
+_DOUBLE = Struct('<d')
+_UINT16 = Struct('<H')
+
+
+def _pack_move(move: ChessMove) -> int:
+    'from (6 bits), to (6 bits), promotion (3 bits)'
+    return (move.from_square
+            | move.to_square << 6
+            | (move.promotion or 0) << 12)
+
+
+def _unpack_move(packed: int) -> ChessMove:
+    return ChessMove(packed & 0x3f, packed >> 6 & 0x3f, packed >> 12 or None)
+
+
+def _packable_uci(uci: str) -> Optional[ChessMove]:
+    try:
+        move = ChessMove.from_uci(uci)
+    except ValueError:
+        return None
+    return move if move.drop is None and move.uci() == uci else None
+
+
+class _Encoder:
+    def __init__(self) -> None:
+        self.out = bytearray()
+
+    def varint(self, n: int) -> None:
+        out = self.out
+        while n > 0x7f:
+            out.append(n & 0x7f | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def str(self, s: str) -> None:
+        data = s.encode('utf-8')
+        self.varint(len(data))
+        self.out += data
+
+    def move(self, move: ChessMove) -> None:
+        self.out += _UINT16.pack(_pack_move(move))
+
+    def value(self, obj: Any) -> None:
+        encoder = _ENCODERS.get(type(obj))
+        if encoder is None:
+            data = pickle_dumps(obj, HIGHEST_PROTOCOL)
+            self.out.append(_PICKLE)
+            self.varint(len(data))
+            self.out += data
+        else:
+            encoder(self, obj)
+
+
+def _encode_int(e: _Encoder, n: int) -> None:
+    e.out.append(_INT)
+    e.varint(n << 1 if n >= 0 else (-n << 1) - 1)  # zigzag
+
+
+def _encode_float(e: _Encoder, f: float) -> None:
+    e.out.append(_FLOAT)
+    e.out += _DOUBLE.pack(f)
+
+
+def _encode_str(e: _Encoder, s: str) -> None:
+    move = _packable_uci(s) if 4 <= len(s) <= 5 else None
+    if move is None:
+        e.out.append(_STR)
+        e.str(s)
+    else:
+        e.out.append(_UCI)
+        e.move(move)
+
+
+def _encode_bytes(e: _Encoder, b: bytes) -> None:
+    e.out.append(_BYTES)
+    e.varint(len(b))
+    e.out += b
+
+
+def _encoder_sequence(tag: int) -> Callable[[_Encoder, Any], None]:
+    def encode(e: _Encoder, items: Any) -> None:
+        e.out.append(tag)
+        e.varint(len(items))
+        for item in items:
+            e.value(item)
+    return encode
+
+
+def _encode_dict(e: _Encoder, d: Dict[Any, Any]) -> None:
+    e.out.append(_DICT)
+    e.varint(len(d))
+    for k, v in d.items():
+        e.value(k)
+        e.value(v)
+
+
+def _encoder_enum(tag: int) -> Callable[[_Encoder, Any], None]:
+    def encode(e: _Encoder, member: Any) -> None:
+        e.out.append(tag)
+        e.varint(member.value)
+    return encode
+
+
+def _encode_player(e: _Encoder, player: Player) -> None:
+    e.out.append(_PLAYER)
+    e.str(player.player_id)
+    e.varint(player.player_type.value)
+    e.value(player.player_name)
+
+
+def _encode_move(e: _Encoder, move: Move) -> None:
+    e.out.append(_MOVE)
+    e.value(move.move)
+    e.str(move.user_id)
+
+
+def _position(board: Board) -> Tuple[Any, ...]:
+    return (board.pawns, board.knights, board.bishops, board.rooks,
+            board.queens, board.kings, board.promoted, *board.occupied_co,
+            board.turn, board.castling_rights, board.ep_square,
+            board.halfmove_clock, board.fullmove_number)
+
+
+_STARTING_POSITION = _position(Board())
+
+
+def _encode_board(e: _Encoder, board: Board) -> None:
+    'the start position and the move stack: the history is needed to detect repetitions'
+    e.out.append(_BOARD)
+    root = board.root()
+    e.out.append(board.chess960)
+    # fen() is slow: compare the bitboards first
+    e.str('' if _position(root) == _STARTING_POSITION else root.fen())
+    e.varint(len(board.move_stack))
+    for move in board.move_stack:
+        e.move(move)
+
+
+def _encode_chess_move(e: _Encoder, move: ChessMove) -> None:
+    e.out.append(_CHESS_MOVE)
+    e.move(move)
+
+
+def _encode_game_universe(e: _Encoder, game_universe: GameUniverse) -> None:
+    e.out.append(_GAME_UNIVERSE)
+    e.str(game_universe.game_id)
+    _encode_board(e, game_universe.board)
+    e.value(game_universe.white)
+    e.value(game_universe.black)
+
+
+def _encode_input_queue_element(e: _Encoder, element: InputQueueElement) -> None:
+    e.out.append(_INPUT_QUEUE_ELEMENT)
+    e.varint(element.command.value)
+    e.value(element.white)
+    e.value(element.black)
+    e.value(element.game_id)
+    e.value(element.move)
+
+
+def _encode_output_queue_element(e: _Encoder, element: OutputQueueElement) -> None:
+    e.out.append(_OUTPUT_QUEUE_ELEMENT)
+    e.varint(element.result.value)
+    _encode_snapshot(e, element.snapshot)
+    e.value(element.error)
+    e.value(element.move)
+
+
+def _encode_snapshot(e: _Encoder, snapshot: Snapshot) -> None:
+    e.out.append(_SNAPSHOT)
+    e.str(snapshot.game_id)
+    e.value(snapshot.white)
+    e.value(snapshot.black)
+    e.str(snapshot.fen)
+    e.varint(snapshot.ply)
+    e.value(snapshot.last_move)
+    e.value(snapshot.outcome)
+
+
+def _encode_outcome(e: _Encoder, outcome: Outcome) -> None:
+    e.out.append(_OUTCOME)
+    e.varint(outcome.termination.value)
+    e.value(outcome.winner)
+
+
+_ENCODERS: Dict[type, Callable[[_Encoder, Any], None]] = {
+    type(None): lambda e, _: e.out.append(_NONE),
+    bool: lambda e, b: e.out.append(_TRUE if b else _FALSE),
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    list: _encoder_sequence(_LIST),
+    tuple: _encoder_sequence(_TUPLE),
+    dict: _encode_dict,
+    PlayerType: _encoder_enum(_PLAYER_TYPE),
+    Command: _encoder_enum(_COMMAND),
+    Result: _encoder_enum(_RESULT),
+    Player: _encode_player,
+    Move: _encode_move,
+    GameUniverse: _encode_game_universe,
+    InputQueueElement: _encode_input_queue_element,
+    OutputQueueElement: _encode_output_queue_element,
+    Snapshot: _encode_snapshot,
+    Board: _encode_board,
+    ChessMove: _encode_chess_move,
+    Outcome: _encode_outcome,
+}
+
+
+class _Decoder:
+    '''reads straight from data (also a memoryview on a memory map): only
+    the str and bytes values are copied'''
+
+    def __init__(self, data: Buffer) -> None:
+        self.data = data
+        self.pos = 0
+
+    def byte(self) -> int:
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def varint(self) -> int:
+        data = self.data
+        pos = self.pos
+        b = data[pos]
+        pos += 1
+        n = b & 0x7f
+        shift = 7
+        while b > 0x7f:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            shift += 7
+        self.pos = pos
+        return n
+
+    def bytes(self) -> bytes:
+        size = self.varint()
+        self.pos += size
+        return bytes(self.data[self.pos - size:self.pos])
+
+    def str(self) -> str:
+        size = self.varint()
+        self.pos += size
+        return str(self.data[self.pos - size:self.pos], 'utf-8')
+
+    def move(self) -> ChessMove:
+        self.pos += 2
+        return _unpack_move(_UINT16.unpack_from(self.data, self.pos - 2)[0])
+
+    def value(self) -> Any:
+        tag = self.data[self.pos]
+        self.pos += 1
+        return _DECODERS[tag](self)
+
+
+def _decode_float(d: _Decoder) -> float:
+    d.pos += 8
+    return cast(float, _DOUBLE.unpack_from(d.data, d.pos - 8)[0])
+
+
+def _decode_int(d: _Decoder) -> int:
+    n = d.varint()
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _decode_list(d: _Decoder) -> List[Any]:
+    return [d.value() for _ in range(d.varint())]
+
+
+def _decode_dict(d: _Decoder) -> Dict[Any, Any]:
+    return {d.value(): d.value() for _ in range(d.varint())}
+
+
+def _decode_board(d: _Decoder) -> Board:
+    chess960 = bool(d.byte())
+    board = Board(d.str() or STARTING_FEN, chess960=chess960)
+    for _ in range(d.varint()):
+        board.push(d.move())
+    return board
+
+
+def _decode_game_universe(d: _Decoder) -> GameUniverse:
+    game_id = d.str()
+    d.pos += 1  # _BOARD
+    return GameUniverse(game_id, _decode_board(d), d.value(), d.value())
+
+
+_DECODERS: Dict[int, Callable[[_Decoder], Any]] = {
+    _NONE: lambda d: None,
+    _FALSE: lambda d: False,
+    _TRUE: lambda d: True,
+    _INT: _decode_int,
+    _FLOAT: _decode_float,
+    _STR: _Decoder.str,
+    _BYTES: _Decoder.bytes,
+    _LIST: _decode_list,
+    _TUPLE: lambda d: tuple(_decode_list(d)),
+    _DICT: _decode_dict,
+    _PLAYER_TYPE: lambda d: PlayerType(d.varint()),
+    _COMMAND: lambda d: Command(d.varint()),
+    _RESULT: lambda d: Result(d.varint()),
+    _PLAYER: lambda d: Player(d.str(), PlayerType(d.varint()), d.value()),
+    _MOVE: lambda d: Move(d.value(), d.str()),
+    _GAME_UNIVERSE: _decode_game_universe,
+    _INPUT_QUEUE_ELEMENT: lambda d: InputQueueElement(Command(d.varint()),
+                                                      d.value(), d.value(),
+                                                      d.value(), d.value()),
+    _OUTPUT_QUEUE_ELEMENT: lambda d: OutputQueueElement(Result(d.varint()),
+                                                        d.value(), d.value(),
+                                                        d.value()),
+    _SNAPSHOT: lambda d: Snapshot(d.str(), d.value(), d.value(), d.str(),
+                                  d.varint(), d.value(), d.value()),
+    _BOARD: _decode_board,
+    _CHESS_MOVE: _Decoder.move,
+    _UCI: lambda d: d.move().uci(),
+    _OUTCOME: lambda d: Outcome(Termination(d.varint()), d.value()),
+    _PICKLE: lambda d: pickle_loads(d.bytes()),
+}
+
+
+class BinaryCodec:
+    'varint length prefixed frames of tagged values'
+
+    def encode(self, obj: Any) -> bytes:
+        payload = _Encoder()
+        payload.value(obj)
+        frame = _Encoder()
+        frame.varint(len(payload.out))
+        return bytes(frame.out + payload.out)
+
+    def decode(self, frame: Buffer) -> Any:
+        d = _Decoder(frame)
+        d.varint()
+        return d.value()
+
+    def decode_many(self, data: Sequence[Buffer]) -> List[Any]:
+        acc = []
+        for frames in data:
+            d = _Decoder(frames)
+            while d.pos < len(frames):
+                d.varint()
+                acc.append(d.value())
+        return acc
+
+    def split(self, data: Buffer) -> Iterator[Tuple[int, int]]:
+        d = _Decoder(data)
+        while d.pos < len(data):
+            start = d.pos
+            try:
+                size = d.varint()
+            except IndexError:
+                return
+            end = d.pos + size
+            if end > len(data):
+                return
+            yield start, end
+            d.pos = end
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
@@ -1,2 +1,51 @@
+from ..triopubsub import Retention
+
 INPUT_TOPIC = 'input'
+# each game has its own output topic, OUTPUT_TOPIC/<game_id>
 OUTPUT_TOPIC = 'output'
+OUTPUT_TOPICS = f'{OUTPUT_TOPIC}/*'
+
+# where the broker process listens (see moves-rest --role)
+BROKER_SOCKET = 'moves.sock'
+
+# history replayed to late subscribers; bounded to keep memory flat with uptime
+INPUT_RETENTION = Retention(max_count=1024)
+OUTPUT_RETENTION = Retention(max_count=1024)
+
+# the games announced to the front ends (see /games): the adds and the
+# removes, so only the latest are kept
+GAMES_TOPIC = 'games'
+GAMES_RETENTION = Retention(max_count=1024)
+
+# the metrics of the cpu players (the pool of engines, the games waiting for
+# a move); only the latest is kept
+CPU_METRICS_TOPIC = 'metrics/cpu'
+METRICS_RETENTION = Retention(max_count=1)
+# not journaled: the metrics describe the running processes
+METRICS_TOPICS = 'metrics/*'
+
+# the seconds for a cpu move (the engines think less under load), and the
+# least an engine thinks
+CPU_MOVE_SLO = 5.
+MIN_THINK_TIME = .05
+
+# moves found by the engines kept by the cpu players (see MoveCache)
+MOVES_CACHE_CAPACITY = 65536
+
+# games kept in memory by a game engine (with --games), the others are
+# evicted to disk; and the seconds after which an idle game is evicted
+GAMES_CAPACITY = 1024
+GAMES_MAX_IDLE = 3600.
+
+# unknown game ids remembered by a game engine, so that their inputs are
+# dropped without asking the broker (and the journal) again
+MISSING_GAMES_CAPACITY = 4096
+
+# queued messages for a websocket client before it gets disconnected (it can
+# reconnect and resume from the last offset received)
+WEBSOCKET_CAPACITY = 1024
+
+
+def output_topic(game_id: str) -> str:
+    'the topic of the outputs of a game'
+    return f'{OUTPUT_TOPIC}/{game_id}'
@@ -1,6 +1,14 @@
 from logging import getLogger
+from typing import Any
 from typing import AsyncIterator
-from typing import Union
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
 from typing import cast
 
 from async_generator import aclosing
@@ -9,120 +17,258 @@ from chess import WHITE
 from chess import Move
 from chess.engine import EngineError
 from chess.engine import Limit
-from chess.engine import SimpleEngine
-from chess.engine import UciProtocol
-from chess.engine import popen_uci
-from trio.to_thread import run_sync
-
-from ..configurations import STOCKFISH
-from ..configurations import running_on_ec2
-from ..triopubsub import Broker
+from trio import Nursery
+from trio import open_nursery
+
+from ..triopubsub import PubSub
+from .book import OpeningBook
+from .constants import CPU_METRICS_TOPIC
+from .constants import CPU_MOVE_SLO
 from .constants import INPUT_TOPIC
-from .constants import OUTPUT_TOPIC
+from .constants import METRICS_RETENTION
+from .constants import MIN_THINK_TIME
+from .constants import MOVES_CACHE_CAPACITY
+from .constants import OUTPUT_TOPICS
+from .engines import MAX_ENGINES
+from .engines import EngineOpener
+from .engines import EnginePool
+from .engines import open_engine
+from .movecache import Entry
+from .movecache import MoveCache
+from .ponder import Ponderer
+from .scheduler import Scheduler
 from .types import Command
-from .types import GameUniverse
 from .types import InputQueueElement
 from .types import OutputQueueElement
 from .types import PlayerType
 from .types import Result
+from .types import Snapshot
 from .types import Move as RestMove
 
 LOGS = getLogger(__name__)
 
-UnionEngine = Union[SimpleEngine, UciProtocol]
 
+async def find_move(pool: EnginePool, cache: MoveCache,
+                    book: Optional[OpeningBook], ponderer: Optional[Ponderer],
+                    snapshot: Snapshot, limit: Limit) -> Optional[Entry]:
+    '''the move to play and the expected reply (in uci) from the cache, the
+    book or an engine'''
+    if ponderer is not None:
+        await ponderer.wait(snapshot, limit)
+    cached = cache.get(snapshot.fen, limit)
+    if cached is not None:
+        return cached
+
+    # a board of its own: the engine thread does not race anyone
+    board = snapshot.board()
+    if book is not None:
+        book_move = book.move(board)
+        if book_move is not None:
+            return book_move.uci(), None
 
-async def cpu_move(engine: UnionEngine,
-                   game_universe: GameUniverse) -> AsyncIterator[InputQueueElement]:
+    if ponderer is not None:
+        ponderer.make_room()
     try:
-        if running_on_ec2():
-            assert isinstance(engine, UciProtocol)
-            from trio_asyncio import aio_as_trio
-            result = await aio_as_trio(engine.play)(game_universe.board,
-                                                    Limit(time=5))
-        else:
-            assert isinstance(engine, SimpleEngine)
-            result = await run_sync(engine.play,
-                                    game_universe.board,
-                                    Limit(time=5))
+        result = await pool.play(board, limit)
     except EngineError:
         LOGS.exception('cannot play')
+        return None
+    uci = cast(Move, result.move).uci()
+    ponder = result.ponder.uci() if result.ponder is not None else None
+    cache.put(snapshot.fen, limit, (uci, ponder))
+    return uci, ponder
+
+
+async def cpu_move(pool: EnginePool, cache: MoveCache,
+                   book: Optional[OpeningBook], scheduler: Scheduler,
+                   ponderer: Optional[Ponderer],
+                   snapshot: Snapshot) -> AsyncIterator[InputQueueElement]:
+    limit = scheduler.limit(pool, snapshot)
+    found = await find_move(pool, cache, book, ponderer, snapshot, limit)
+    if found is None:
         return
+    uci, reply = found
+
+    user_id: str
+    if snapshot.turn == WHITE:
+        assert snapshot.white.player_type == PlayerType.CPU
+        user_id = snapshot.white.player_id
+    elif snapshot.turn == BLACK:
+        assert snapshot.black is not None
+        assert snapshot.black.player_type == PlayerType.CPU
+        user_id = snapshot.black.player_id
     else:
-        move = cast(Move, result.move)
-
-        user_id: str
-        if game_universe.board.turn == WHITE:
-            assert game_universe.white.player_type == PlayerType.CPU
-            user_id = game_universe.white.player_id
-        elif game_universe.board.turn == BLACK:
-            assert game_universe.black is not None
-            assert game_universe.black.player_type == PlayerType.CPU
-            user_id = game_universe.black.player_id
-        else:
-            LOGS.exception('unknown turn [%s]', game_universe.board.turn)
-            return
+        LOGS.exception('unknown turn [%s]', snapshot.turn)
+        return
 
-        yield InputQueueElement(command=Command.MOVE,
-                                game_id=game_universe.game_id,
-                                move=RestMove(move=move.uci(), user_id=user_id))
+    if ponderer is not None and reply is not None:
+        ponderer.ponder(snapshot, uci, reply)
 
+    yield InputQueueElement(command=Command.MOVE,
+                            game_id=snapshot.game_id,
+                            move=RestMove(move=uci, user_id=user_id))
 
-async def handle(engine: UnionEngine,
+
+async def handle(pool: EnginePool, cache: MoveCache,
+                 book: Optional[OpeningBook], scheduler: Scheduler,
+                 ponderer: Optional[Ponderer],
                  output_element: OutputQueueElement) -> AsyncIterator[InputQueueElement]:
     if output_element.result == Result.ERROR:
         return  # nothing to do here
 
     if output_element.result == Result.GAME_CREATED:
-        game_universe = output_element.game_universe
+        snapshot = output_element.snapshot
 
-        if game_universe.white.player_type == PlayerType.CPU:
-            async for input_element in cpu_move(engine, game_universe):
+        if snapshot.white.player_type == PlayerType.CPU:
+            async for input_element in cpu_move(pool, cache, book, scheduler,
+                                                ponderer, snapshot):
                 yield input_element
 
     if output_element.result == Result.MOVE:
-        game_universe = output_element.game_universe
-
-        if ((game_universe.board.turn == WHITE and
-             game_universe.white.player_type == PlayerType.CPU) or
-            (game_universe.board.turn == BLACK and
-             game_universe.black is not None and
-             game_universe.black.player_type == PlayerType.CPU)):
-            async for input_element in cpu_move(engine, game_universe):
+        snapshot = output_element.snapshot
+
+        if ((snapshot.turn == WHITE and
+             snapshot.white.player_type == PlayerType.CPU) or
+            (snapshot.turn == BLACK and
+             snapshot.black is not None and
+             snapshot.black.player_type == PlayerType.CPU)):
+            async for input_element in cpu_move(pool, cache, book, scheduler,
+                                                ponderer, snapshot):
                 yield input_element
 
     if output_element.result == Result.END_GAME:
-        return  # nothing to do here
+        if ponderer is not None:
+            ponderer.forget(output_element.snapshot.game_id)
 
     if output_element.result == Result.SUGGESTION:
         raise NotImplementedError()
 
 
-async def cpu(broker: Broker) -> None:
-    '"passive" element: wait for inputs and handle them'
+def coalesce(output_elements: Sequence[Optional[OutputQueueElement]]
+             ) -> Tuple[List[OutputQueueElement], bool]:
+    '''keep only the latest element of each game (the previous ones would
+    ask a move for a position already left behind); errors do not change
+    the position, so they do not hide the previous element.
 
-    # IA
-    engine: UnionEngine
-    try:
-        if running_on_ec2():
-            from trio_asyncio import aio_as_trio
-            _, engine = await aio_as_trio(popen_uci)(STOCKFISH)
+    return the elements and whether the stop sentinel (None) was found'''
+    latest: Dict[str, OutputQueueElement] = {}
+    for output_element in output_elements:
+        if output_element is None:
+            return list(latest.values()), True
+        if output_element.result == Result.ERROR:
+            continue
+        game_id = output_element.snapshot.game_id
+        latest.pop(game_id, None)  # keep the arrival order
+        latest[game_id] = output_element
+    return list(latest.values()), False
+
+
+class Dispatcher:
+    '''run the outputs concurrently, but one at a time per game: the ones
+    that arrive while their game is running wait, and only the latest of
+    them is kept (as in coalesce)'''
+
+    def __init__(self, nursery: Nursery,
+                 run: Callable[[OutputQueueElement], Awaitable[None]]) -> None:
+        self.nursery = nursery
+        self.run = run
+        self.running: Set[str] = set()
+        # game_id -> the next output to run
+        self.pending: Dict[str, OutputQueueElement] = {}
+
+    def dispatch(self, output_element: OutputQueueElement) -> None:
+        game_id = output_element.snapshot.game_id
+        if game_id in self.running:
+            self.pending[game_id] = output_element
         else:
-            engine = SimpleEngine.popen_uci(STOCKFISH)
-    except BaseException:
-        LOGS.error('STOCKFISH: %s', STOCKFISH)
-        raise
+            self.running.add(game_id)
+            self.nursery.start_soon(self._run, game_id, output_element)
+
+    async def _run(self, game_id: str,
+                   output_element: Optional[OutputQueueElement]) -> None:
+        try:
+            while output_element is not None:
+                await self.run(output_element)
+                output_element = self.pending.pop(game_id, None)
+        finally:
+            self.running.discard(game_id)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'running': len(self.running),
+                'pending': len(self.pending)}
+
+
+async def cpu(broker: PubSub, *,
+              engines: int = MAX_ENGINES,
+              opener: EngineOpener = open_engine,
+              cache: Optional[MoveCache] = None,
+              book: Optional[OpeningBook] = None,
+              slo: float = CPU_MOVE_SLO,
+              ponder: bool = False) -> None:
+    '''"passive" element: wait for inputs and handle them
+
+    the games are played concurrently by a pool of engines (at most one
+    search at a time per game), that are asked only the positions not in
+    cache and out of book, for as long as the load allows a move in slo
+    seconds (see Scheduler); with ponder, the idle engines search the
+    expected replies (see Ponderer); the metrics are published on
+    CPU_METRICS_TOPIC
+
+    the book is closed at the end'''
+
+    moves = MoveCache(MOVES_CACHE_CAPACITY) if cache is None else cache
+    scheduler = Scheduler(slo, MIN_THINK_TIME)
+
+    try:
+        broker.add_topic(CPU_METRICS_TOPIC, dict, retention=METRICS_RETENTION)
+    except KeyError:
+        pass  # a previous cpu added it
+
+    try:
+        async with EnginePool(engines, opener) as pool:
+            def publish_metrics() -> None:
+                broker.send({'engines': pool.metrics(),
+                             'cache': moves.metrics(),
+                             'book': book.metrics() if book is not None else None,
+                             'scheduler': scheduler.metrics(),
+                             'ponder': (ponderer.metrics()
+                                        if ponderer is not None else None),
+                             'games': dispatcher.metrics()},
+                            CPU_METRICS_TOPIC)
+
+            async def run(output_element: OutputQueueElement) -> None:
+                LOGS.info('output_element: %s', output_element)
+
+                input_elements: List[InputQueueElement] = []
+                async for input_element in handle(pool, moves, book, scheduler,
+                                                  ponderer, output_element):
+                    LOGS.info('input_element: %s', input_element)
+
+                    input_elements.append(input_element)
+
+                if input_elements:
+                    broker.send_many(input_elements, INPUT_TOPIC)
+                    publish_metrics()
 
-    async with aclosing(broker.subscribe_topic(OUTPUT_TOPIC,
-                                               OutputQueueElement)) as output_elements:  # type: ignore
-        # main loop
-        async for output_element in output_elements:
-            LOGS.info('output_element: %s', output_element)
+            async with open_nursery() as nursery:
+                dispatcher = Dispatcher(nursery, run)
+                ponderer = (Ponderer(nursery, pool, moves, scheduler)
+                            if ponder else None)
 
-            if output_element is None:
-                break
+                async with aclosing(broker.subscribe_topic_batches(OUTPUT_TOPICS,
+                                                                   OutputQueueElement)) as batches:  # type: ignore
+                    # main loop
+                    async for batch in batches:
+                        output_elements, stop = coalesce(batch)
 
-            async for input_element in handle(engine, output_element):
-                LOGS.info('input_element: %s', input_element)
+                        for output_element in output_elements:
+                            dispatcher.dispatch(output_element)
+                        publish_metrics()
 
-                broker.send(input_element, INPUT_TOPIC)
+                        if stop:
+                            break
+                # and the nursery waits for the running games
+    finally:
+        moves.save()
+        if book is not None:
+            book.close()
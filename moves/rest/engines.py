@@ -0,0 +1,307 @@
+'''a pool of uci engines (stockfish), shared by the cpu players
+
+every engine searches a position at a time, in a thread of its own (or,
+on ec2, through trio_asyncio): the pool lends the idle ones, and the
+searches wait for an engine when they are all busy
+
+the pool also supervises the engines: an engine idle for a while is asked
+if it is still alive (isready) before a search, a search has a deadline,
+and an engine that dies, fails or misses the deadline is killed and
+replaced, and the search retried (a cancelled search is stopped, uci stop,
+and its engine checked before the next search)
+'''
+
+from asyncio import run_coroutine_threadsafe
+from logging import getLogger
+from math import inf
+from os import cpu_count
+from time import perf_counter
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Protocol
+from typing import Tuple
+from typing import Union
+
+from chess import Board
+from chess.engine import INFO_BASIC
+from chess.engine import EngineError
+from chess.engine import Limit
+from chess.engine import PlayResult
+from chess.engine import SimpleEngine
+from chess.engine import UciProtocol
+from chess.engine import popen_uci
+from trio import Cancelled
+from trio import CapacityLimiter
+from trio import TooSlowError
+from trio import fail_after
+from trio import move_on_after
+from trio.abc import AsyncResource
+from trio.to_thread import run_sync
+
+from ..configurations import STOCKFISH
+from ..configurations import running_on_ec2
+from ..triopubsub import Histogram
+
+LOGS = getLogger(__name__)
+
+UnionEngine = Union[SimpleEngine, UciProtocol]
+
+# an engine per core: more would only steal cpu time to each other
+MAX_ENGINES = cpu_count() or 1
+
+# the seconds a search can last over its time limit (or at all, without a
+# time limit), the seconds for an answer to isready, and for an engine to
+# quit (then it is killed)
+SEARCH_GRACE = 5.
+SEARCH_DEADLINE = 60.
+PING_DEADLINE = 5.
+QUIT_DEADLINE = 5.
+# the seconds an engine can be idle before it is checked
+CHECK_INTERVAL = 60.
+# the searches tried again, on a new engine, after a failure
+SEARCH_RETRIES = 2
+
+
+class Engine(Protocol):
+    'what the pool needs from an engine'
+
+    async def play(self, board: Board, limit: Limit) -> PlayResult:
+        'cancelled, it stops the search (the engine finishes it in the background)'
+
+    async def ping(self) -> None: ...
+
+    async def quit(self) -> None: ...
+
+    def kill(self) -> None: ...
+
+
+class Stockfish:
+    'a stockfish process, as an Engine'
+
+    def __init__(self, engine: UnionEngine) -> None:
+        self.engine = engine
+
+    async def play(self, board: Board, limit: Limit) -> PlayResult:
+        'the info of the result has the nodes searched'
+        if running_on_ec2():
+            assert isinstance(self.engine, UciProtocol)
+            from trio_asyncio import aio_as_trio
+            # cancelled, python-chess sends stop
+            return await aio_as_trio(self.engine.play)(board, limit,
+                                                       info=INFO_BASIC)
+        assert isinstance(self.engine, SimpleEngine)
+        future = run_coroutine_threadsafe(
+            self.engine.protocol.play(board, limit, info=INFO_BASIC),
+            self.engine.protocol.loop)
+        try:
+            # cancellable: a wedged engine does not hold the search
+            return await run_sync(future.result, cancellable=True)
+        except Cancelled:
+            future.cancel()  # python-chess sends stop
+            raise
+
+    async def ping(self) -> None:
+        'isready'
+        if running_on_ec2():
+            assert isinstance(self.engine, UciProtocol)
+            from trio_asyncio import aio_as_trio
+            await aio_as_trio(self.engine.ping)()
+        else:
+            assert isinstance(self.engine, SimpleEngine)
+            await run_sync(self.engine.ping, cancellable=True)
+
+    async def quit(self) -> None:
+        if running_on_ec2():
+            assert isinstance(self.engine, UciProtocol)
+            from trio_asyncio import aio_as_trio
+            await aio_as_trio(self.engine.quit)()
+        else:
+            assert isinstance(self.engine, SimpleEngine)
+            await run_sync(self.engine.quit, cancellable=True)
+
+    def kill(self) -> None:
+        'stop the process, without waiting for it'
+        if running_on_ec2():
+            assert isinstance(self.engine, UciProtocol)
+            if self.engine.transport is not None:
+                self.engine.transport.close()
+        else:
+            assert isinstance(self.engine, SimpleEngine)
+            self.engine.close()
+
+
+async def open_engine() -> Engine:
+    'start a stockfish process'
+    engine: UnionEngine
+    if running_on_ec2():
+        from trio_asyncio import aio_as_trio
+        _, engine = await aio_as_trio(popen_uci)(STOCKFISH)
+    else:
+        engine = await run_sync(SimpleEngine.popen_uci, STOCKFISH)
+    return Stockfish(engine)
+
+
+EngineOpener = Callable[[], Awaitable[Engine]]
+
+
+def deadline(limit: Limit, grace: float = SEARCH_GRACE) -> float:
+    'the seconds a search with limit can last'
+    if limit.time is None:
+        return SEARCH_DEADLINE
+    return limit.time + grace
+
+
+def _kill(engine: Engine) -> None:
+    try:
+        engine.kill()
+    except Exception:
+        LOGS.exception('cannot kill the engine')
+
+
+class EnginePool(AsyncResource):
+    '''size engines (at most MAX_ENGINES), opened on demand by opener
+
+    use play as the engine's one; the metrics count the searches waiting
+    for an engine, the busy engines, the search times and speed, and the
+    engines replaced
+
+    grace, check_interval and quit_deadline are the SEARCH_GRACE, the
+    CHECK_INTERVAL and the QUIT_DEADLINE of the pool'''
+
+    def __init__(self, size: int, opener: EngineOpener = open_engine, *,
+                 grace: float = SEARCH_GRACE,
+                 check_interval: float = CHECK_INTERVAL,
+                 quit_deadline: float = QUIT_DEADLINE) -> None:
+        self.size = max(1, min(size, MAX_ENGINES))
+        self.opener = opener
+        self.grace = grace
+        self.check_interval = check_interval
+        self.quit_deadline = quit_deadline
+        self.limiter = CapacityLimiter(self.size)
+        # with the time they were left idle
+        self.idle: List[Tuple[Engine, float]] = []
+        self.engines: List[Engine] = []
+        # metrics
+        self.searches = Histogram()
+        self.waits = Histogram()
+        self.nodes = 0
+        self.search_time = 0.
+        self.pings = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.open_failures = 0
+        self.cancelled = 0
+        self.restarts = 0
+
+    async def _ready(self, engine: Engine) -> bool:
+        self.pings += 1
+        try:
+            with fail_after(PING_DEADLINE):
+                await engine.ping()
+        except (EngineError, TooSlowError):
+            LOGS.exception('engine not ready')
+            return False
+        return True
+
+    def _discard(self, engine: Engine) -> None:
+        'kill an engine: the next search opens another'
+        self.engines.remove(engine)
+        self.restarts += 1
+        _kill(engine)
+
+    async def _borrow(self) -> Engine:
+        while self.idle:
+            engine, since = self.idle.pop()
+            if (perf_counter() - since < self.check_interval or
+                    await self._ready(engine)):
+                return engine
+            self._discard(engine)
+        try:
+            engine = await self.opener()
+        except (OSError, EngineError) as e:  # say, stockfish is not there
+            LOGS.exception('cannot open an engine')
+            self.open_failures += 1
+            raise EngineError('cannot open an engine') from e
+        self.engines.append(engine)
+        return engine
+
+    async def play(self, board: Board, limit: Limit) -> PlayResult:
+        'EngineError if the search failed on SEARCH_RETRIES + 1 engines'
+        start = perf_counter()
+        async with self.limiter:
+            self.waits.observe(perf_counter() - start)
+            error: Optional[Exception] = None
+            for _ in range(SEARCH_RETRIES + 1):
+                engine = await self._borrow()
+                search_start = perf_counter()
+                try:
+                    with fail_after(deadline(limit, self.grace)):
+                        result = await engine.play(board, limit)
+                except TooSlowError as e:
+                    LOGS.error('engine wedged, searching %s', board.fen())
+                    self.timeouts += 1
+                    self._discard(engine)
+                    error = e
+                    continue
+                except EngineError as e:
+                    LOGS.exception('engine failed, searching %s', board.fen())
+                    self.failures += 1
+                    self._discard(engine)
+                    error = e
+                    continue
+                except Cancelled:
+                    # stopped (see Engine.play): checked before the next
+                    # search, the isready is answered when the stop is done
+                    self.cancelled += 1
+                    self.idle.append((engine, -inf))
+                    raise
+
+                elapsed = perf_counter() - search_start
+                self.searches.observe(elapsed)
+                self.search_time += elapsed
+                self.nodes += result.info.get('nodes', 0)
+                self.idle.append((engine, perf_counter()))
+                return result
+            raise EngineError(f'no engine could search {board.fen()}') from error
+
+    def load(self) -> int:
+        'the searches running or waiting for an engine'
+        statistics = self.limiter.statistics()
+        return statistics.borrowed_tokens + statistics.tasks_waiting
+
+    def metrics(self) -> Dict[str, Any]:
+        statistics = self.limiter.statistics()
+        return {'size': self.size,
+                'busy': statistics.borrowed_tokens,
+                'waiting': statistics.tasks_waiting,
+                'waits': self.waits.snapshot(),
+                'searches': self.searches.snapshot(),
+                'nodes': self.nodes,
+                'nps': (self.nodes / self.search_time
+                        if self.search_time else None),
+                'pings': self.pings,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'open_failures': self.open_failures,
+                'cancelled': self.cancelled,
+                'restarts': self.restarts}
+
+    async def aclose(self) -> None:
+        'quit the engines: the ones that do not in time are killed'
+        for engine in self.engines:
+            quitted = False
+            with move_on_after(self.quit_deadline) as cancel_scope:
+                cancel_scope.shield = True  # even if the pool is cancelled
+                try:
+                    await engine.quit()
+                    quitted = True
+                except EngineError:
+                    LOGS.exception('cannot quit the engine')
+            if not quitted:
+                _kill(engine)
+        self.engines.clear()
+        self.idle.clear()
@@ -1,16 +1,29 @@
+from collections import OrderedDict
+from dataclasses import replace
 from logging import getLogger
+from re import fullmatch
 from typing import Dict
+from typing import Iterable
 from typing import Iterator
+from typing import List
+from typing import MutableMapping
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from uuid import uuid4
+from zlib import crc32
 
 from async_generator import aclosing
-from chess import BLACK
 from chess import WHITE
 from chess import Board
 
-from ..triopubsub import Broker
+from ..triopubsub import PubSub
 from .constants import INPUT_TOPIC
-from .constants import OUTPUT_TOPIC
+from .constants import MISSING_GAMES_CAPACITY
+from .constants import OUTPUT_RETENTION
+from .constants import output_topic
+from .multiverse import Multiverse
+from .position import position
 from .types import Command
 from .types import GameUniverse
 from .types import InputQueueElement
@@ -20,88 +33,363 @@ from .types import Result
 LOGS = getLogger(__name__)
 
 
-def handle(games: Dict[str, GameUniverse],
+def shard_of(input_element: Optional[InputQueueElement], shards: int) -> int:
+    '''the shard of the game of the input: a hash of the game_id, stable
+    across processes; the inputs without a game_id go to the shard 0'''
+    if input_element is None or input_element.game_id is None:
+        return 0
+    return crc32(input_element.game_id.encode()) % shards
+
+
+def _new_game_id(shard: int, shards: int) -> str:
+    'a game_id of the shard'
+    while True:
+        game_id = str(uuid4())
+        if crc32(game_id.encode()) % shards == shard:
+            return game_id
+
+
+def valid_game_id(game_id: str) -> bool:
+    '''whether game_id has the shape of the generated ones (a uuid4, see
+    _new_game_id): the ids come from the clients, and name files and topics'''
+    return fullmatch(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+                     game_id) is not None
+
+
+def _invalid(input_element: InputQueueElement) -> bool:
+    return (input_element.game_id is not None and
+            not valid_game_id(input_element.game_id))
+
+
+def _wrong_turn(game_universe: GameUniverse,
+                input_element: InputQueueElement) -> bool:
+    'detect if the move is not from the player to move'
+    assert input_element.move is not None
+
+    if game_universe.board.turn == WHITE:
+        return game_universe.white.player_id != input_element.move.user_id
+    return (game_universe.black is None or
+            game_universe.black.player_id != input_element.move.user_id)
+
+
+def handle(games: MutableMapping[str, GameUniverse],
            input_element: InputQueueElement) -> Iterator[OutputQueueElement]:
-    LOGS.info('input_element: %s', input_element)
+    LOGS.debug('input_element: %s', input_element)
 
     if input_element.command == Command.NEW_GAME:
         assert input_element.white is not None
 
-        game_universe = GameUniverse(game_id=str(uuid4()),
-                                     board=Board(),
-                                     white=input_element.white,
-                                     black=input_element.black)
+        # the front end assigns the game_id (so the input can be replayed)
+        new_game = GameUniverse(game_id=input_element.game_id or str(uuid4()),
+                                board=Board(),
+                                white=input_element.white,
+                                black=input_element.black)
 
-        games[game_universe.game_id] = game_universe
+        games[new_game.game_id] = new_game
 
         yield OutputQueueElement(result=Result.GAME_CREATED,
-                                 game_universe=game_universe)
+                                 snapshot=new_game.snapshot())
+
+        return
 
+    assert input_element.game_id is not None
+    game_universe = games.get(input_element.game_id)
+    if game_universe is None:
+        LOGS.warning('unknown game: %s', input_element.game_id)
         return
 
     if input_element.command == Command.END_GAME:
-        raise NotImplementedError()
+        # abandoned (the game over ones end with their last move)
+        yield OutputQueueElement(result=Result.END_GAME,
+                                 snapshot=game_universe.snapshot())
+        return
 
     if input_element.command == Command.MOVE:
-        assert input_element.game_id is not None
         assert input_element.move is not None
 
-        game_universe = games[input_element.game_id]
-        LOGS.info('[game_universe: %s]', game_universe)
+        LOGS.debug('[game_universe: %s]', game_universe)
 
-        # detect if the move is from the right player
-        if ((game_universe.board.turn == WHITE and
-             game_universe.white.player_id != input_element.move.user_id) or
-            (game_universe.board.turn == BLACK and
-             (game_universe.black is None or
-              game_universe.black.player_id != input_element.move.user_id))):
+        if _wrong_turn(game_universe, input_element):
             yield OutputQueueElement(result=Result.ERROR,
-                                     game_universe=game_universe,
+                                     snapshot=game_universe.snapshot(),
                                      error=Exception('wrong turn'))
             return
 
+        # legal moves and outcome are computed once per position
+        game_position = position(game_universe.board, game_universe.position)
+        game_universe.position = game_position
         try:
-            move = game_universe.board.parse_uci(input_element.move.move)
-            game_universe.board.push(move)
+            move = game_position.parse_uci(input_element.move.move)
         except (AssertionError, ValueError) as e:
             LOGS.exception('invalid move: %s', input_element.move)
             yield OutputQueueElement(result=Result.ERROR,
-                                     game_universe=game_universe,
+                                     snapshot=game_universe.snapshot(),
                                      error=e)
             return
+        game_position.push(move)
 
-        LOGS.info('PUSHED')
+        LOGS.debug('PUSHED')
 
-        if game_universe.board.is_game_over():
+        if game_position.outcome is not None:
             LOGS.info('GAME ENDED!')
-            LOGS.info('result: %s', game_universe.board.result())
+            LOGS.info('result: %s', game_position.outcome.result())
             LOGS.info('GAME ENDED!')
             result = Result.END_GAME
         else:
             result = Result.MOVE
 
         yield OutputQueueElement(result=result,
-                                 game_universe=game_universe,
+                                 snapshot=game_universe.snapshot(),
                                  move=input_element.move.move)
         return
 
 
-async def game_engine(broker: Broker) -> None:
-    '"passive" element: wait for inputs and handle them'
+def recover(input_elements: Iterable[Optional[InputQueueElement]]
+            ) -> Tuple[Dict[str, GameUniverse], Set[str]]:
+    '''rebuild the games from the inputs already handled, in bulk: no
+    outputs, and a single game over check per game
 
-    async with aclosing(broker.subscribe_topic(INPUT_TOPIC,
-                                               InputQueueElement)) as input_elements:  # type: ignore
-        # mutable multiverse
-        games: Dict[str, GameUniverse] = {}
+    return the games and the ended ones (game over, or abandoned); the
+    inputs of the games whose NEW_GAME is not there (evicted, or without a
+    game_id), and the ones with an invalid game_id, are skipped'''
+    games: Dict[str, GameUniverse] = {}
+    abandoned: Set[str] = set()
+    skipped = 0
+    for input_element in input_elements:
+        if input_element is None:
+            continue
+        if _invalid(input_element):
+            skipped += 1
+            continue
 
-        # main loop
-        async for input_element in input_elements:
-            LOGS.info('input_element: %s', input_element)
+        if input_element.command == Command.NEW_GAME:
+            if input_element.game_id is None:
+                skipped += 1
+                continue
+            assert input_element.white is not None
+            games[input_element.game_id] = GameUniverse(
+                game_id=input_element.game_id,
+                board=Board(),
+                white=input_element.white,
+                black=input_element.black)
+
+        elif input_element.command == Command.END_GAME:
+            assert input_element.game_id is not None
+
+            if input_element.game_id not in games:
+                skipped += 1
+                continue
+            abandoned.add(input_element.game_id)
+
+        elif input_element.command == Command.MOVE:
+            assert input_element.game_id is not None
+            assert input_element.move is not None
+
+            game_universe = games.get(input_element.game_id)
+            if game_universe is None:
+                skipped += 1
+                continue
+            # the moves of the ended games are ignored
+            if input_element.game_id in abandoned:
+                continue
+
+            # the rejected moves are rejected again
+            if _wrong_turn(game_universe, input_element):
+                continue
+            try:
+                move = game_universe.board.parse_uci(input_element.move.move)
+            except (AssertionError, ValueError):
+                continue
+            game_universe.board.push(move)
+
+    ended = abandoned | {game_id
+                         for game_id, game_universe in games.items()
+                         if game_universe.board.is_game_over()}
+
+    LOGS.info('recovered %d games (%d ended), skipped %d inputs',
+              len(games), len(ended), skipped)
+    return games, ended
 
-            if input_element is None:
-                break
 
-            for output_element in handle(games, input_element):
-                LOGS.info('output_element: %s', output_element)
+def rebuild(output_elements: Iterable[OutputQueueElement]
+            ) -> Optional[GameUniverse]:
+    '''rebuild a game from its outputs (see handle), retained by its output
+    topic: from the first snapshot, replay the moves of the following ones
 
-                broker.send(output_element, OUTPUT_TOPIC)
+    None if there are no outputs, or the game ended'''
+    game_universe: Optional[GameUniverse] = None
+    for output_element in output_elements:
+        if output_element.result == Result.END_GAME:
+            return None
+        if game_universe is None:
+            snapshot = output_element.snapshot
+            game_universe = GameUniverse(game_id=snapshot.game_id,
+                                         board=snapshot.board(),
+                                         white=snapshot.white,
+                                         black=snapshot.black)
+        elif (output_element.result == Result.MOVE and
+              output_element.move is not None):
+            game_universe.board.push_uci(output_element.move)
+    return game_universe
+
+
+async def _restore(broker: PubSub, games: MutableMapping[str, GameUniverse],
+                   game_id: str) -> bool:
+    '''add the output topic of a game (pre-filled by the journal, if any) and,
+    if the game is not in games, rebuild it from there (see rebuild)
+
+    return whether the game is live'''
+    topic_id = output_topic(game_id)
+    try:
+        broker.add_topic(topic_id, OutputQueueElement,
+                         retention=OUTPUT_RETENTION)
+    except KeyError:  # a local broker has it already
+        pass
+    if game_id in games:
+        return True
+    records = await broker.fetch_records(topic_id, OutputQueueElement)
+    game_universe = rebuild(record.message for record in records)
+    if game_universe is None:
+        await broker.finish_topic(topic_id)
+        return False
+    LOGS.info('restored game %s from its outputs', game_id)
+    games[game_id] = game_universe
+    return True
+
+
+async def game_engine(broker: PubSub, *,
+                      recover_games: bool = False,
+                      shard: int = 0,
+                      shards: int = 1,
+                      games: Optional[Multiverse] = None) -> None:
+    '''"passive" element: wait for inputs and handle them
+
+    with recover_games the inputs retained by the input topic (for example
+    restored from the journal) are taken as already handled: the games are
+    rebuilt from them (see recover) and their output topics added again,
+    then only the following inputs are handled.
+    The games whose NEW_GAME the input topic did not retain are rebuilt from
+    their output topics (see rebuild): the ones with inputs among the
+    retained ones at once, the others at their next input
+
+    with shards > 1 only the games of shard are handled, so that shards
+    engines (tasks or processes) share the load; the input topic must be
+    keyed by partial(shard_of, shards=shards)
+
+    the ended games are archived, and the idle ones evicted, by games (by
+    default they are only kept in memory, see Multiverse)
+
+    the inputs with an invalid game_id (see valid_game_id) are dropped, and
+    so are the ones of the games that could not be restored (the latest
+    MISSING_GAMES_CAPACITY are remembered)'''
+    key = shard if shards > 1 else None
+
+    # mutable multiverse
+    if games is None:
+        games = Multiverse()
+    # the games with an output topic (added by this engine)
+    known: Set[str] = set()
+    # the games that could not be restored, least recently asked first
+    missing: OrderedDict[str, None] = OrderedDict()
+
+    async def restore(game_id: str) -> None:
+        if game_id in missing:
+            missing.move_to_end(game_id)
+        elif await _restore(broker, games, game_id):
+            known.add(game_id)
+        else:
+            missing[game_id] = None
+            if len(missing) > MISSING_GAMES_CAPACITY:
+                missing.popitem(last=False)
+
+    offset = None
+    if recover_games:
+        records = await broker.fetch_records(INPUT_TOPIC, InputQueueElement,
+                                             key=key)
+        recovered, ended = recover(record.message for record in records)
+        # the ended ones were archived when they ended
+        for game_id, game_universe in recovered.items():
+            if game_id not in ended:
+                games[game_id] = game_universe
+                broker.add_topic(output_topic(game_id), OutputQueueElement,
+                                 retention=OUTPUT_RETENTION)
+                known.add(game_id)
+        # the games started before the retained inputs
+        for record in records:
+            if (record.message is None or record.message.game_id is None or
+                    _invalid(record.message)):
+                continue
+            game_id = record.message.game_id
+            if game_id not in recovered and game_id not in known:
+                await restore(game_id)
+        if records:
+            offset = records[-1].offset + 1
+
+    async with aclosing(broker.subscribe_topic_batches(INPUT_TOPIC,
+                                                       InputQueueElement,
+                                                       offset=offset,
+                                                       key=key)) as batches:  # type: ignore
+
+        # main loop: handle a burst of inputs, publish the outputs at once
+        async for input_elements in batches:
+            # topic_id -> outputs, in order
+            output_elements: Dict[str, List[OutputQueueElement]] = {}
+            finished: List[str] = []
+            stop = False
+            for input_element in input_elements:
+                if input_element is None:
+                    stop = True
+                    break
+
+                if _invalid(input_element):
+                    LOGS.warning('invalid game_id: %r', input_element.game_id)
+                    continue
+                if (input_element.command == Command.NEW_GAME and
+                        input_element.game_id is None):
+                    # keep its following inputs in this shard
+                    input_element = replace(input_element,
+                                            game_id=_new_game_id(shard, shards))
+                elif (input_element.command != Command.NEW_GAME and
+                      input_element.game_id is not None and
+                      input_element.game_id not in known and
+                      # not ended in this batch
+                      output_topic(input_element.game_id) not in output_elements):
+                    await restore(input_element.game_id)
+
+                for output_element in handle(games, input_element):
+                    LOGS.debug('output_element: %s', output_element)
+
+                    game_id = output_element.snapshot.game_id
+                    topic_id = output_topic(game_id)
+                    if output_element.result == Result.GAME_CREATED:
+                        try:
+                            broker.add_topic(topic_id, OutputQueueElement,
+                                             retention=OUTPUT_RETENTION)
+                        except KeyError:  # added by rest (start_new_game)
+                            pass
+                        known.add(game_id)
+                        missing.pop(game_id, None)
+                    if output_element.result == Result.END_GAME:
+                        # no more inputs for it
+                        outcome = output_element.snapshot.outcome
+                        games.archive(game_id,
+                                      outcome.result()
+                                      if outcome is not None
+                                      else '*')
+                        finished.append(topic_id)
+                        known.discard(game_id)
+
+                    output_elements.setdefault(topic_id, []).append(
+                        output_element)
+
+            for topic_id, game_output_elements in output_elements.items():
+                broker.send_many(game_output_elements, topic_id)
+
+            # the topic (and its history) goes away with its last subscriber
+            for topic_id in finished:
+                await broker.finish_topic(topic_id)
+
+            games.evict_idle()
+
+            if stop:
+                break
@@ -0,0 +1,122 @@
+'''the moves found by the engines, by position
+
+the same positions are searched again and again (the starting position,
+the common openings, the cpu vs cpu games that replay the same line): the
+cache answers them without an engine
+
+a position is its fen without the clocks (that the engines ignore, but for
+the 50 moves rule), so the snapshots are looked up without a Board; a move
+answers the searches with a limit up to the one it was searched with (a
+move searched for 5 seconds is good for a 1 second search)
+'''
+
+from collections import OrderedDict
+from json import dumps
+from json import loads
+from logging import getLogger
+from os import replace
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from chess.engine import Limit
+
+LOGS = getLogger(__name__)
+
+# (time, depth, nodes, mate)
+LimitKey = Tuple[Optional[float], Optional[int], Optional[int], Optional[int]]
+# (move, ponder), in uci
+Entry = Tuple[str, Optional[str]]
+
+
+def position(fen: str) -> str:
+    'fen without the clocks'
+    return fen.rsplit(' ', 2)[0]
+
+
+def limit_key(limit: Limit) -> LimitKey:
+    return limit.time, limit.depth, limit.nodes, limit.mate
+
+
+def covers(searched: LimitKey, wanted: LimitKey) -> bool:
+    '''whether a search with the searched limit is at least as good as one
+    with the wanted limit: the same bounds, none lower'''
+    return all((s is None and w is None) or
+               (s is not None and w is not None and s >= w)
+               for s, w in zip(searched, wanted))
+
+
+class MoveCache:
+    '''position -> the move (and the expected reply) found by the engine,
+    with the limit of the search; at most capacity entries (the least
+    recently used are dropped)
+
+    with a path, the entries are read from it at startup and written back
+    by save'''
+
+    def __init__(self, capacity: int, path: Optional[str] = None) -> None:
+        self.capacity = capacity
+        self.path = path
+        self.entries: OrderedDict[str, Tuple[LimitKey, Entry]] = OrderedDict()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        if path is not None:
+            self._load(path)
+
+    def _load(self, path: str) -> None:
+        try:
+            with open(path) as fp:
+                json = loads(fp.read())
+        except FileNotFoundError:
+            return
+        for fen, limit, move, ponder in json:
+            self.entries[fen] = (tuple(limit), (move, ponder))
+        self._shrink()
+        LOGS.info('loaded %d moves from %s', len(self.entries), path)
+
+    def save(self) -> None:
+        'write the entries (least recently used first) to path, if any'
+        if self.path is None:
+            return
+        json = [[fen, limit, move, ponder]
+                for fen, (limit, (move, ponder)) in self.entries.items()]
+        with open(f'{self.path}.tmp', 'w') as fp:
+            fp.write(dumps(json))
+        replace(f'{self.path}.tmp', self.path)
+
+    def _shrink(self) -> None:
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, fen: str, limit: Limit) -> Optional[Entry]:
+        'the move of a search of the position with (at least) limit'
+        k = position(fen)
+        cached = self.entries.get(k)
+        if cached is None or not covers(cached[0], limit_key(limit)):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(k)
+        self.hits += 1
+        return cached[1]
+
+    def put(self, fen: str, limit: Limit, entry: Entry) -> None:
+        'keep the move found, unless a better search is cached'
+        k = position(fen)
+        cached = self.entries.get(k)
+        if cached is None or not covers(cached[0], limit_key(limit)):
+            self.entries[k] = (limit_key(limit), entry)
+        self.entries.move_to_end(k)
+        self._shrink()
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evicted': self.evicted}
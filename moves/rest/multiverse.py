@@ -0,0 +1,213 @@
+'''the games of a game engine, with the idle ones evicted to disk
+
+a game is kept on disk in a compact form, a json with the players, the
+starting position and the uci moves; an evicted game is read back (and
+its moves replayed) when it is needed again
+'''
+
+from collections import OrderedDict
+from json import dumps
+from json import loads
+from logging import getLogger
+from os import listdir
+from os import makedirs
+from os import remove
+from os import replace
+from os.path import altsep
+from os.path import join
+from os.path import sep
+from time import monotonic
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import MutableMapping
+from typing import Optional
+
+from chess import Board
+from chess import Move
+
+from .types import GameUniverse
+from .types import Player
+from .types import PlayerType
+
+LOGS = getLogger(__name__)
+
+IDLE_DIR = 'idle'
+ARCHIVE_DIR = 'archive'
+
+
+def _dump_player(player: Optional[Player]) -> Optional[Dict[str, Any]]:
+    if player is None:
+        return None
+    return {'player_id': player.player_id,
+            'player_type': player.player_type.name,
+            'player_name': player.player_name}
+
+
+def _load_player(json: Optional[Dict[str, Any]]) -> Optional[Player]:
+    if json is None:
+        return None
+    return Player(json['player_id'], PlayerType[json['player_type']],
+                  json['player_name'])
+
+
+def dump(game_universe: GameUniverse) -> Dict[str, Any]:
+    'the compact form of a game: players, starting position and moves'
+    board = game_universe.board
+    return {'game_id': game_universe.game_id,
+            'white': _dump_player(game_universe.white),
+            'black': _dump_player(game_universe.black),
+            'fen': board.root().fen(),
+            'moves': ' '.join(move.uci() for move in board.move_stack)}
+
+
+def load(json: Dict[str, Any]) -> GameUniverse:
+    'rebuild a game from its compact form (the moves are not validated)'
+    board = Board(json['fen'])
+    for uci in json['moves'].split():
+        board.push(Move.from_uci(uci))
+    white = _load_player(json['white'])
+    assert white is not None
+    return GameUniverse(json['game_id'], board, white,
+                        _load_player(json['black']))
+
+
+class Multiverse(MutableMapping[str, GameUniverse]):
+    '''game_id -> GameUniverse, with at most capacity games in memory
+
+    the least recently used games over capacity, and the ones not used for
+    max_idle seconds (see evict_idle), are moved to directory; finished
+    games are moved to the archive (see archive)
+
+    without a directory the games are only kept in memory: no eviction,
+    and the finished games are dropped'''
+
+    def __init__(self, directory: Optional[str] = None, *,
+                 capacity: Optional[int] = None,
+                 max_idle: Optional[float] = None) -> None:
+        self.directory = directory
+        self.capacity = capacity
+        self.max_idle = max_idle
+        # the games in memory, least recently used first
+        self.resident: OrderedDict[str, GameUniverse] = OrderedDict()
+        # game_id -> monotonic time of the last use
+        self.last_used: Dict[str, float] = {}
+        self.evicted = 0
+        self.rehydrated = 0
+        if directory is not None:
+            makedirs(join(directory, IDLE_DIR), exist_ok=True)
+            makedirs(join(directory, ARCHIVE_DIR), exist_ok=True)
+
+    def _fn(self, subdir: str, game_id: str) -> str:
+        'ValueError if game_id would name a file out of subdir'
+        assert self.directory is not None
+        if (not game_id or game_id.startswith('.') or sep in game_id or
+                (altsep is not None and altsep in game_id)):
+            raise ValueError(f'invalid game_id: {game_id!r}')
+        return join(self.directory, subdir, f'{game_id}.json')
+
+    def _write(self, subdir: str, json: Dict[str, Any]) -> None:
+        fn = self._fn(subdir, json['game_id'])
+        with open(f'{fn}.tmp', 'w') as fp:
+            fp.write(dumps(json))
+        replace(f'{fn}.tmp', fn)
+
+    def _touch(self, game_id: str) -> None:
+        self.resident.move_to_end(game_id)
+        self.last_used[game_id] = monotonic()
+
+    def _evict(self, game_id: str) -> None:
+        game_universe = self.resident.pop(game_id)
+        del self.last_used[game_id]
+        self._write(IDLE_DIR, dump(game_universe))
+        self.evicted += 1
+
+    def _shrink(self) -> None:
+        if self.directory is None or self.capacity is None:
+            return
+        while len(self.resident) > self.capacity:
+            self._evict(next(iter(self.resident)))
+
+    def __getitem__(self, game_id: str) -> GameUniverse:
+        if game_id in self.resident:
+            self._touch(game_id)
+            return self.resident[game_id]
+        if self.directory is None:
+            raise KeyError(game_id)
+
+        try:
+            fn = self._fn(IDLE_DIR, game_id)
+            with open(fn) as fp:
+                game_universe = load(loads(fp.read()))
+        except FileNotFoundError:
+            raise KeyError(game_id) from None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # not a game (or not one that can be read back)
+            LOGS.error('cannot rehydrate game %r: %r', game_id, e)
+            raise KeyError(game_id) from None
+        remove(fn)
+        self.rehydrated += 1
+        LOGS.info('rehydrated game %s', game_id)
+
+        self.resident[game_id] = game_universe
+        self._touch(game_id)
+        self._shrink()
+        return game_universe
+
+    def __setitem__(self, game_id: str, game_universe: GameUniverse) -> None:
+        self.resident[game_id] = game_universe
+        self._touch(game_id)
+        if self.directory is not None:
+            try:
+                remove(self._fn(IDLE_DIR, game_id))  # stale
+            except FileNotFoundError:
+                pass
+        self._shrink()
+
+    def __delitem__(self, game_id: str) -> None:
+        if game_id in self.resident:
+            del self.resident[game_id]
+            del self.last_used[game_id]
+        elif self.directory is None:
+            raise KeyError(game_id)
+        else:
+            try:
+                remove(self._fn(IDLE_DIR, game_id))
+            except (OSError, ValueError):
+                raise KeyError(game_id) from None
+
+    def _idle_ids(self) -> Iterator[str]:
+        if self.directory is None:
+            return
+        for fn in listdir(join(self.directory, IDLE_DIR)):
+            if fn.endswith('.json'):
+                yield fn[:-len('.json')]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from list(self.resident)
+        yield from self._idle_ids()
+
+    def __len__(self) -> int:
+        return len(self.resident) + sum(1 for _ in self._idle_ids())
+
+    def archive(self, game_id: str, result: str) -> None:
+        '''drop a finished game from memory; with a directory, keep its
+        compact form (with the result) in the archive'''
+        game_universe = self[game_id]
+        del self[game_id]
+        if self.directory is not None:
+            self._write(ARCHIVE_DIR, {**dump(game_universe), 'result': result})
+
+    def evict_idle(self) -> int:
+        'evict the games not used for max_idle seconds, return how many'
+        if self.directory is None or self.max_idle is None:
+            return 0
+        deadline = monotonic() - self.max_idle
+        evicted = 0
+        while self.resident:
+            game_id = next(iter(self.resident))
+            if self.last_used[game_id] > deadline:
+                break
+            self._evict(game_id)
+            evicted += 1
+        return evicted
@@ -0,0 +1,166 @@
+'''pondering: search the expected reply of the human while they think
+
+after a cpu move the engine also tells which reply it expects: if an engine
+is idle, it searches the position after that reply, and keeps the move in
+the cache; if the human does play it, the cpu answers from the cache (or
+waits for the search already running, instead of starting another)
+
+a pondering search never holds an engine needed elsewhere: it is cancelled
+if the human plays another move, if the game ends, and if a cpu move would
+wait for an engine (see make_room)
+'''
+
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
+from logging import getLogger
+from time import perf_counter
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+from chess.engine import EngineError
+from chess.engine import Limit
+from trio import CancelScope
+from trio import Event
+from trio import Nursery
+
+from ..triopubsub import Histogram
+from .engines import EnginePool
+from .movecache import MoveCache
+from .movecache import covers
+from .movecache import limit_key
+from .movecache import position
+from .scheduler import Scheduler
+from .types import Snapshot
+
+LOGS = getLogger(__name__)
+
+
+@dataclass
+class Prediction:
+    'the position expected after the reply of the human'
+    position: str
+    limit: Limit
+    start: float
+    done: Event = field(default_factory=Event)
+    end: Optional[float] = None
+    # whether the search found a move (and put it in the cache)
+    found: bool = False
+    # of the search
+    cancel_scope: CancelScope = field(default_factory=CancelScope)
+
+
+class Ponderer:
+    '''search the expected positions in the background, with the engines
+    left idle by the cpu moves
+
+    a game has a prediction at a time, checked (see wait) at its next cpu
+    move: a hit if the human played the expected reply and the search, with
+    at least the limit of the cpu move, found a move; the time saved is the
+    time the engine searched before the cpu move was asked'''
+
+    def __init__(self, nursery: Nursery, pool: EnginePool, cache: MoveCache,
+                 scheduler: Scheduler) -> None:
+        self.nursery = nursery
+        self.pool = pool
+        self.cache = cache
+        self.scheduler = scheduler
+        # game_id -> prediction
+        self.predictions: Dict[str, Prediction] = {}
+        # metrics
+        self.ponders = 0
+        self.skipped = 0  # no idle engine
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0  # to free an engine for a cpu move
+        self.saved = Histogram()
+
+    def ponder(self, snapshot: Snapshot, move: str, reply: str) -> None:
+        'after move (of the cpu) in snapshot, expect reply'
+        if self.pool.load() >= self.pool.size:
+            self.skipped += 1
+            return
+
+        board = snapshot.board()
+        try:
+            board.push_uci(move)
+            board.push_uci(reply)
+        except ValueError:
+            LOGS.exception('cannot ponder %s %s', move, reply)
+            return
+        if board.is_game_over():
+            return
+
+        expected = replace(snapshot, fen=board.fen(), ply=snapshot.ply + 2,
+                           last_move=reply, outcome=None)
+        prediction = Prediction(position(expected.fen),
+                                self.scheduler.limit(self.pool, expected),
+                                perf_counter())
+        self.predictions[snapshot.game_id] = prediction
+        self.ponders += 1
+        self.nursery.start_soon(self._search, expected, prediction)
+
+    async def _search(self, expected: Snapshot,
+                      prediction: Prediction) -> None:
+        limit = prediction.limit
+        try:
+            with prediction.cancel_scope:
+                result = await self.pool.play(expected.board(), limit)
+                if result.move is not None:
+                    ponder = result.ponder.uci() if result.ponder is not None else None
+                    self.cache.put(expected.fen, limit, (result.move.uci(), ponder))
+                    prediction.found = True
+        except EngineError:
+            LOGS.exception('cannot ponder')
+        finally:
+            prediction.end = perf_counter()
+            prediction.done.set()
+
+    async def wait(self, snapshot: Snapshot, limit: Limit) -> None:
+        '''before a cpu move with limit: if its position was pondered with
+        (at least) limit, wait for the search (the move is then in the
+        cache); otherwise stop the search, the cpu move needs another'''
+        prediction = self.predictions.pop(snapshot.game_id, None)
+        if prediction is None:
+            return
+        if (prediction.position != position(snapshot.fen) or
+                not covers(limit_key(prediction.limit), limit_key(limit))):
+            prediction.cancel_scope.cancel()
+            self.misses += 1
+            return
+        end = prediction.end if prediction.end is not None else perf_counter()
+        await prediction.done.wait()
+        if not prediction.found:  # failed or cancelled
+            self.misses += 1
+            return
+        self.hits += 1
+        self.saved.observe(end - prediction.start)
+
+    def make_room(self) -> None:
+        '''before the search of a cpu move: if it would wait for an engine,
+        cancel the oldest search still pondering'''
+        if self.pool.load() < self.pool.size:
+            return
+        for game_id, prediction in self.predictions.items():
+            if not prediction.done.is_set():
+                del self.predictions[game_id]
+                prediction.cancel_scope.cancel()
+                self.cancelled += 1
+                return
+
+    def forget(self, game_id: str) -> None:
+        'the game ended'
+        prediction = self.predictions.pop(game_id, None)
+        if prediction is not None:
+            prediction.cancel_scope.cancel()
+
+    def metrics(self) -> Dict[str, Any]:
+        checked = self.hits + self.misses
+        return {'ponders': self.ponders,
+                'skipped': self.skipped,
+                'hits': self.hits,
+                'misses': self.misses,
+                'cancelled': self.cancelled,
+                'hit_rate': self.hits / checked if checked else None,
+                'saved': self.saved.snapshot()}
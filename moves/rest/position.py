@@ -0,0 +1,88 @@
+'''the outcome of a game, computed once per position
+
+Board.is_game_over looks for a legal move and searches the repetitions in
+the move stack, and Board.outcome repeats it for every consumer; a Position
+computes the outcome once per move, and counts the positions as they are
+reached, so a repetition is a lookup
+
+the moves are validated with Board.parse_uci, that only checks the given
+move: generating all the legal moves costs ~5 times as much
+'''
+
+from collections import Counter
+from typing import Any
+from typing import Hashable
+from typing import Optional
+from typing import Tuple
+
+from chess import Board
+from chess import Move
+from chess import Outcome
+from chess import Termination
+
+
+def _discarded() -> None:
+    return None
+
+
+def _key(board: Board) -> Hashable:
+    'what makes two positions the same, for the repetitions'
+    return board._transposition_key()
+
+
+class Position:
+    '''the outcome of the current position of board; push the moves through
+    it to keep it up to date'''
+
+    def __init__(self, board: Board) -> None:
+        self.board = board
+        self.repetitions: Counter[Hashable] = Counter()
+
+        # the positions of the history
+        replay = board.root()
+        self.repetitions[_key(replay)] += 1
+        for move in board.move_stack:
+            replay.push(move)
+            self.repetitions[_key(replay)] += 1
+
+        self.ply = len(board.move_stack)
+        self.outcome = self._outcome()
+
+    def _outcome(self) -> Optional[Outcome]:
+        'same checks, and order, of Board.outcome()'
+        board = self.board
+        stuck = not any(board.generate_legal_moves())
+        if stuck and board.is_check():
+            return Outcome(Termination.CHECKMATE, not board.turn)
+        if board.is_insufficient_material():
+            return Outcome(Termination.INSUFFICIENT_MATERIAL, None)
+        if stuck:
+            return Outcome(Termination.STALEMATE, None)
+        if board.halfmove_clock >= 150:
+            return Outcome(Termination.SEVENTYFIVE_MOVES, None)
+        if self.repetitions[_key(board)] >= 5:
+            return Outcome(Termination.FIVEFOLD_REPETITION, None)
+        return None
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        'not worth sending to other processes: unpickled as None'
+        return _discarded, ()
+
+    def parse_uci(self, uci: str) -> Move:
+        'Board.parse_uci (ValueError if not legal)'
+        return self.board.parse_uci(uci)
+
+    def push(self, move: Move) -> None:
+        'push a legal move on the board'
+        self.board.push(move)
+        self.ply += 1
+        self.repetitions[_key(self.board)] += 1
+        self.outcome = self._outcome()
+
+
+def position(board: Board, current: Optional[Position]) -> Position:
+    'current, if it is still the position of board, or a new one'
+    if (current is not None and current.board is board and
+            current.ply == len(board.move_stack)):
+        return current
+    return Position(board)
@@ -2,6 +2,9 @@ from base64 import b64decode
 from json import dumps
 from json import loads
 from logging import getLogger
+from typing import Any
+from typing import Dict
+from typing import Set
 from typing import cast
 
 from async_generator import aclosing
@@ -12,7 +15,6 @@ from quart import request
 from quart import websocket
 from quart_cors import cors
 from quart_trio import QuartTrio
-from trio import open_nursery
 from vosk import KaldiRecognizer
 from vosk import Model
 
@@ -23,9 +25,15 @@ from ...configurations import CERTFILE
 from ...configurations import HOSTNAMES
 from ...configurations import KEYFILE
 from ...configurations import REST_PORT
-from ...triopubsub import Broker
+from ...triopubsub import PubSub
+from ..constants import CPU_METRICS_TOPIC
+from ..constants import GAMES_RETENTION
+from ..constants import GAMES_TOPIC
 from ..constants import INPUT_TOPIC
-from ..constants import OUTPUT_TOPIC
+from ..constants import OUTPUT_RETENTION
+from ..constants import OUTPUT_TOPICS
+from ..constants import WEBSOCKET_CAPACITY
+from ..constants import output_topic
 from ..types import OutputQueueElement
 from ..types import Result
 from .types import GamesOutput
@@ -59,11 +67,9 @@ def clean(raw: str) -> str:
             'otto': '8'}[raw]
 
 
-async def mk_app(broker: Broker) -> QuartTrio:
+async def mk_app(broker: PubSub) -> QuartTrio:
     # pub/sub "infrastructure"
-    topic_games_id = 'games'
-
-    broker.add_topic(topic_games_id, str)
+    broker.add_topic(GAMES_TOPIC, str, retention=GAMES_RETENTION)
 
     app = cast(QuartTrio, cors(QuartTrio(__name__),
                                allow_origin=[f'https://{hostname}'
@@ -71,14 +77,45 @@ async def mk_app(broker: Broker) -> QuartTrio:
                                allow_methods=['POST'],
                                allow_headers=['content-type']))
 
+    # the live games: filled by start_new_game and by following the games
+    # topic (when the front end runs in its own process, or is restarted),
+    # emptied by the ended games
+    game_ids: Set[str] = set()
+
+    @app.before_serving
+    async def track_games() -> None:
+        async def tracker() -> None:
+            async with aclosing(broker.subscribe_topic(GAMES_TOPIC,
+                                                       GamesOutput)) as games_outputs:  # type: ignore
+                async for games_output in games_outputs:
+                    if games_output.op == 'remove':
+                        game_ids.discard(games_output.game_id)
+                    else:
+                        game_ids.add(games_output.game_id)
+
+        async def ended() -> None:
+            async with aclosing(broker.subscribe_topic(OUTPUT_TOPICS,
+                                                       OutputQueueElement,
+                                                       send_old_messages=False)) as output_elements:  # type: ignore
+                async for output_element in output_elements:
+                    if output_element.result == Result.END_GAME:
+                        broker.send(GamesOutput('remove',
+                                                output_element.snapshot.game_id,
+                                                full=True),
+                                    GAMES_TOPIC)
+
+        app.nursery.start_soon(tracker)
+        app.nursery.start_soon(ended)
+
     @app.websocket('/games')
     async def games() -> None:
         LOGS.info('games()')
 
         await websocket.accept()
 
-        async with aclosing(broker.subscribe_topic(topic_games_id,
-                                                   GamesOutput)) as games_outputs:  # type: ignore
+        async with aclosing(broker.subscribe_topic(GAMES_TOPIC,
+                                                   GamesOutput,
+                                                   capacity=WEBSOCKET_CAPACITY)) as games_outputs:  # type: ignore
             async for games_output in games_outputs:
                 LOGS.info('games [games_output: %s]', games_output)
                 await websocket.send(games_output.json())
@@ -97,37 +134,39 @@ async def mk_app(broker: Broker) -> QuartTrio:
 
         game_id = None
 
-        # attach a "temporary" subscription to the topic to retrieve the
-        # game_id
-        # TODO: create a "id generator" topic/service/something?
-        async def get_game_id() -> None:
-            nonlocal game_id
+        # attach a "temporary" subscription to the output topic of the new
+        # game (added here, the game engine finds it in place) to wait for
+        # its creation; it is in place before the request is sent, so the
+        # answer cannot be missed (even with a remote broker)
+        assert input_element.game_id is not None
+        topic_id = output_topic(input_element.game_id)
+        broker.add_topic(topic_id, OutputQueueElement,
+                         retention=OUTPUT_RETENTION)
+        async with broker.tmp_subscription(topic_id,
+                                           OutputQueueElement,
+                                           send_old_messages=False) as subscription_id:
+            broker.send(input_element, INPUT_TOPIC)
 
-            async with aclosing(broker.subscribe_topic(OUTPUT_TOPIC,
-                                                       OutputQueueElement,
-                                                       send_old_messages=False)) as game_id_messages:  # type: ignore
+            async with aclosing(broker.subscribe(topic_id,
+                                                 subscription_id,
+                                                 OutputQueueElement)) as game_id_messages:  # type: ignore
                 async for game_id_message in game_id_messages:
                     output_element = game_id_message
                     LOGS.info('output_element: %s', output_element)
-                    if output_element.result != Result.GAME_CREATED:
-                        continue
-                    game_id = output_element.game_universe.game_id
-                    break
-
-        async def send_start_game() -> None:
-            broker.send(input_element, INPUT_TOPIC)
-
-        async with open_nursery() as nursery:
-            nursery.start_soon(get_game_id)
-            nursery.start_soon(send_start_game)
+                    if output_element.result == Result.GAME_CREATED:
+                        game_id = input_element.game_id
+                        break
 
         if game_id is None:
+            await broker.finish_topic(topic_id)
             raise Exception('no game_id!')
 
+        game_ids.add(game_id)
+
         full = all([input_element.white is not None,
                     input_element.black is not None])
 
-        broker.send(GamesOutput('add', game_id, full=full), topic_games_id)
+        broker.send(GamesOutput('add', game_id, full=full), GAMES_TOPIC)
 
         return game_id
 
@@ -136,23 +175,30 @@ async def mk_app(broker: Broker) -> QuartTrio:
         getLogger('VITO').info('register(%s)', game_id)
 
 
-        if game_id not in {message.game_id
-                           for message in broker.topics[topic_games_id].messages}:
-            raise Exception('unknown game_id')
+        if game_id not in game_ids:
+            # maybe announced before the ones the games topic retains
+            try:
+                await broker.fetch_records(output_topic(game_id),
+                                           OutputQueueElement)
+            except KeyError:
+                raise Exception('unknown game_id') from None
+
+        # a reconnecting client sends the offset after the last one received
+        offset = websocket.args.get('offset', type=int)
 
         await websocket.accept()
 
-        async with aclosing(broker.subscribe_topic(OUTPUT_TOPIC,
-                                                   OutputQueueElement)) as output_elements:  # type: ignore
-            async for output_element in output_elements:
+        async with aclosing(broker.subscribe_topic_records(output_topic(game_id),
+                                                           OutputQueueElement,
+                                                           offset=offset,
+                                                           capacity=WEBSOCKET_CAPACITY)) as records:  # type: ignore
+            async for record in records:
+                output_element = record.message
                 getLogger('VITO').info('output_element: %s',
                                        output_element.move)
 
-                if game_id != output_element.game_universe.game_id:
-                    continue
-
                 register_output = RegisterOutput.from_output_queue_element(
-                    output_element)
+                    output_element, record.offset)
 
                 await websocket.send(register_output.json())
 
@@ -258,10 +304,24 @@ async def mk_app(broker: Broker) -> QuartTrio:
         LOGS.info('player_games_history [ret: %s]', ret)
         return ret
 
+    @app.route('/metrics', methods=['GET'])
+    async def metrics() -> Dict[str, Any]:
+        '''queue depths, latencies and throughput of the broker (and the
+        latest metrics of the cpu players, if running)'''
+        metrics = await broker.fetch_metrics()
+        try:
+            records = await broker.fetch_records(CPU_METRICS_TOPIC, dict)
+        except KeyError:
+            pass
+        else:
+            if records:
+                metrics['cpu'] = records[-1].message
+        return metrics
+
     return app
 
 
-async def rest(broker: Broker) -> None:
+async def rest(broker: PubSub) -> None:
     'rest/ws server, expose the game engine to users'
 
     config = Config()
@@ -52,7 +52,8 @@ class StartNewGameInput:
         (white, black) = self._players()
         return InputQueueElement(command=Command.NEW_GAME,
                                  white=white,
-                                 black=black)
+                                 black=black,
+                                 game_id=str(uuid4()))
 
 
 @dataclass()
@@ -88,30 +89,33 @@ class RegisterOutput:
     game_ended: bool
     winner: Optional[str]  # it's the player id (or None in case of draw)
     error: Optional[str]
+    offset: Optional[int] = None  # to resume with /register?offset=offset+1
 
     @classmethod
     def from_output_queue_element(
-            cls, output_element: OutputQueueElement) -> 'RegisterOutput':
-        board = output_element.game_universe.board
-        outcome = board.outcome()
+            cls, output_element: OutputQueueElement,
+            offset: Optional[int] = None) -> 'RegisterOutput':
+        snapshot = output_element.snapshot
+        outcome = snapshot.outcome  # computed once, by the engine
         game_ended = outcome is not None
         winner: Optional[str] = None
         if outcome is not None:
             if outcome.winner == WHITE:
-                winner = output_element.game_universe.white.player_id
+                winner = snapshot.white.player_id
             elif outcome.winner == BLACK:
-                assert output_element.game_universe.black is not None
-                winner = output_element.game_universe.black.player_id
+                assert snapshot.black is not None
+                winner = snapshot.black.player_id
             else:
                 winner = None
 
         return RegisterOutput(move=output_element.move,
-                              table=str(board),
+                              table=str(snapshot.board()),
                               game_ended=game_ended,
                               winner=winner,
                               error=str(output_element.error)
                                     if output_element.error is not None
-                                    else None)
+                                    else None,
+                              offset=offset)
 
     def json(self) -> str:
         return dumps(asdict(self))
@@ -6,12 +6,12 @@ from async_generator import aclosing
 from chess import BLACK
 from chess import WHITE
 
-from ..triopubsub import Broker
-from .constants import OUTPUT_TOPIC
+from ..triopubsub import PubSub
+from .constants import OUTPUT_TOPICS
 from .types import OutputQueueElement
 from .types import PlayerType
 from .types import Result
-from typing import TypedDict, Dict
+from typing import TypedDict, Dict, Iterable, List, Tuple
 
 LOGS = getLogger(__name__)
 
@@ -28,22 +28,28 @@ GamesHistory = Dict[str, PlayerGamesHistory]
 
 
 def store(player_id: str, *, is_victory: bool) -> None:
-    victories_delta = 1 if is_victory else 0
-    defeats_delta = 0 if is_victory else 1
-    draws_delta = 0 # not supported
+    store_many([(player_id, is_victory)])
 
+
+def store_many(results: Iterable[Tuple[str, bool]]) -> None:
+    'store a batch of (player_id, is_victory) reading/writing the file once'
     try:
         with open(DEFAULT_FN, 'r') as fp:
             json: GamesHistory = load(fp)
     except FileNotFoundError:
         json = {}
 
-    if player_id not in json:
-        json[player_id] = PlayerGamesHistory(victories=0, defeats=0, draws=0)
+    for player_id, is_victory in results:
+        victories_delta = 1 if is_victory else 0
+        defeats_delta = 0 if is_victory else 1
+        draws_delta = 0 # not supported
+
+        if player_id not in json:
+            json[player_id] = PlayerGamesHistory(victories=0, defeats=0, draws=0)
 
-    json[player_id]['victories'] += victories_delta
-    json[player_id]['defeats'] += defeats_delta
-    json[player_id]['draws'] += draws_delta
+        json[player_id]['victories'] += victories_delta
+        json[player_id]['defeats'] += defeats_delta
+        json[player_id]['draws'] += draws_delta
 
     with open(DEFAULT_FN, 'w') as fp:
         dump(json, fp)
@@ -59,30 +65,38 @@ def load_player(player_id: str) -> PlayerGamesHistory:
     return json.get(player_id, PlayerGamesHistory(victories=0, defeats=0, draws=0))
 
 
-async def save(broker: Broker) -> None:
+async def save(broker: PubSub) -> None:
     '"passive" element: wait for outputs and handle them'
 
-    async with aclosing(broker.subscribe_topic(OUTPUT_TOPIC,
-                                               OutputQueueElement)) as output_elements:  # type: ignore
+    async with aclosing(broker.subscribe_topic_batches(OUTPUT_TOPICS,
+                                                       OutputQueueElement)) as batches:  # type: ignore
         # main loop
-        async for output_element in output_elements:
-            LOGS.info('output_element: %s', output_element)
+        async for batch in batches:
+            results: List[Tuple[str, bool]] = []
+
+            for output_element in batch:
+                LOGS.info('output_element: %s', output_element)
+
+                if output_element is None or output_element.result != Result.END_GAME:
+                    continue
 
-            if output_element is None or output_element.result != Result.END_GAME:
-                continue
+                snapshot = output_element.snapshot
+                assert snapshot.black is not None
 
-            game_universe = output_element.game_universe
-            assert game_universe.black is not None
+                outcome = snapshot.outcome
+                if outcome is None:
+                    continue  # abandoned: no winner, no loser
 
-            outcome = game_universe.board.outcome()
-            assert outcome is not None
+                LOGS.info('[outcome: %s]', outcome)
 
-            LOGS.info('[outcome: %s]', outcome)
+                if snapshot.white.player_type == PlayerType.HUMAN:
+                    results.append((snapshot.white.player_id,
+                                    outcome.winner == WHITE))
 
-            if game_universe.white.player_type == PlayerType.HUMAN:
-                store(game_universe.white.player_id,
-                      is_victory=outcome.winner == WHITE)
+                if snapshot.black.player_type == PlayerType.HUMAN:
+                    results.append((snapshot.black.player_id,
+                                    outcome.winner == BLACK))
 
-            if game_universe.black.player_type == PlayerType.HUMAN:
-                store(game_universe.black.player_id,
-                      is_victory=outcome.winner == BLACK)
+            # one read/write of the history file per batch
+            if results:
+                store_many(results)
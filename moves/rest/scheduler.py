@@ -0,0 +1,65 @@
+'''how long the engines think, for each cpu move
+
+a move has to be played within the slo (seconds): when all the engines are
+busy a search waits for the ones ahead of it, so the more searches are
+queued, the less each of them can think; the opening and the endgame get
+a fraction of the time of the middlegame
+'''
+
+from typing import Any
+from typing import Dict
+
+from chess.engine import Limit
+
+from ..triopubsub import Histogram
+from .engines import EnginePool
+from .types import Snapshot
+
+# the first moves (usually in book) are played quickly
+OPENING_MOVES = 8
+# at most these many pieces (pawns and kings apart): an endgame
+ENDGAME_PIECES = 6
+PHASE_FACTORS = {'opening': .5,
+                 'middlegame': 1.,
+                 'endgame': .75}
+
+
+def phase(snapshot: Snapshot) -> str:
+    'opening, middlegame or endgame'
+    fields = snapshot.fen.split(' ')
+    if int(fields[5]) <= OPENING_MOVES:
+        return 'opening'
+    placement = fields[0]
+    pieces = sum(placement.count(piece) for piece in 'NBRQnbrq')
+    if pieces <= ENDGAME_PIECES:
+        return 'endgame'
+    return 'middlegame'
+
+
+class Scheduler:
+    '''the limits of the searches: at most slo seconds, split among the
+    searches queued for the engines, but not less than min_time'''
+
+    def __init__(self, slo: float, min_time: float) -> None:
+        self.slo = slo
+        self.min_time = min_time
+        # metrics
+        self.budgets = Histogram()
+        self.degraded = 0  # the searches shortened by the load
+
+    def limit(self, pool: EnginePool, snapshot: Snapshot) -> Limit:
+        # the engines are busy for the searches ahead: this one starts
+        # after rounds - 1 of them
+        rounds = pool.load() // pool.size + 1
+        budget = self.slo * PHASE_FACTORS[phase(snapshot)]
+        if self.slo / rounds < budget:
+            self.degraded += 1
+            budget = self.slo / rounds
+        budget = round(max(budget, self.min_time), 3)
+        self.budgets.observe(budget)
+        return Limit(time=budget)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'slo': self.slo,
+                'budgets': self.budgets.snapshot(),
+                'degraded': self.degraded}
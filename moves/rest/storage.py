@@ -1,62 +1,634 @@
 # load and save messages from file
 
+from builtins import open as builtins_open
+from contextlib import contextmanager
+from contextlib import nullcontext
+from enum import Enum
+from enum import auto
+from io import SEEK_END
 from io import StringIO
+from itertools import groupby
+from json import dumps
+from json import loads
+from mmap import ACCESS_READ
+from mmap import mmap
+from operator import itemgetter
+from os import fstat
+from os import fsync
+from os import listdir
+from os import remove
+from os import replace
+from os.path import basename
+from os.path import dirname
+from os.path import exists
+from os.path import join
+from os.path import splitext
+from re import escape
+from re import fullmatch
+from threading import Condition
+from threading import Lock
+from threading import Thread
+from time import perf_counter
+from typing import IO
 from typing import Any
-from typing import DefaultDict
+from typing import Callable
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Sequence
+from typing import Tuple
 from typing import TypeVar
 from typing import Union
 from typing import overload
 
-from jsonlines import Reader
-from jsonlines import Writer
-from jsonlines import open
-
 from ..triopubsub import Broker
+from ..triopubsub import Histogram
 from ..triopubsub import Topic
+from ..triopubsub import matches
+from .codec import JSON
+from .codec import Buffer
+from .codec import Codec
+from .codec import JsonCodec
 
 T = TypeVar('T')
+R = TypeVar('R')
 
-# storage format: a journal, append-only "jsonl" format
+# storage format: a journal, append-only "jsonl" format, of [message, topic_id]
+# (and of [offset, topic_id, OFFSET], see below)
 DEFAULT_FN = 'storage.jsonl'
 
+DEFAULT_COMMIT_COUNT = 1024
+DEFAULT_COMMIT_INTERVAL = .1
+# lines written between two compactions
+DEFAULT_COMPACT_EVERY = 65536
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+# the topic of the tombstones: a line [topic_id, FINISHED] makes the lines of
+# topic_id before it obsolete
+FINISHED = '#finished'
+# a line [offset, topic_id, OFFSET] gives the offset of the next line of
+# topic_id: a compaction writes it before the retained messages of a topic,
+# so the refilled topic keeps its offsets (and the cursors of the clients)
+OFFSET = '#offset'
+
+# [message, topic_id], or [offset, topic_id, OFFSET]
+Line = Tuple[Any, ...]
+
+# topic_id -> [start, end) byte ranges of its lines in a segment
+SegmentIndex = Dict[str, List[List[int]]]
+# topic_id -> (segment, start, end) of its lines not read yet
+Index = Dict[str, List[Tuple[int, int, int]]]
+
+
+class Durability(Enum):
+    '''what a commit waits for'''
+    NONE = auto()  # nothing: the lines stay in the file buffer
+    FLUSH = auto()  # the lines are handed to the os (safe if the process dies)
+    FSYNC = auto()  # the lines are on disk (safe if the machine dies)
+
+
+class _Compaction:
+    '''marks, in the pending lines, where the journal is rewritten as
+    the snapshot'''
+
+    def __init__(self, snapshot: List[Line], unread: Index) -> None:
+        self.snapshot = snapshot
+        self.unread = unread
+
+
+def _add_range(index: SegmentIndex, topic_id: str, start: int, end: int) -> None:
+    ranges = index.setdefault(topic_id, [])
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = end
+    else:
+        ranges.append([start, end])
+
+
+def _copy(views: List[Buffer]) -> List[bytes]:
+    return [bytes(view) for view in views]
+
+
+class Journal:
+    '''append-only journal of (message, topic_id) lines, with group commit
+
+    write only buffers the lines; they are serialized, written and
+    flushed/fsynced (see Durability) in groups, every commit_count lines or
+    every commit_interval seconds, by a background thread, so the broker
+    callbacks never wait for the disk.
+    commit_interval=None: no thread, write commits every commit_count lines
+
+    on disk the journal is split in segments of about segment_size bytes
+    (storage.jsonl -> storage.000001.jsonl, storage.000002.jsonl, ...).
+    A full segment is sealed with the byte ranges of the lines of each topic
+    (storage.000001.idx), so read loads the lines of a topic without
+    parsing the rest. A compaction writes a snapshot segment
+    (storage.000003.snapshot.jsonl) and then drops, or moves to archive_dir,
+    the segments before it.
+    A StringIO journal is a single segment, compacted in place.
+
+    the lines are framed by codec (see moves.rest.codec): json lines by
+    default, BINARY to journal the dataclasses in moves.rest.types
+
+    finish writes a tombstone: the lines of a finished topic are neither
+    read nor copied by the compactions any more'''
+
+    def __init__(self, fn_io: Union[str, StringIO],
+                 durability: Durability = Durability.FLUSH,
+                 commit_count: int = DEFAULT_COMMIT_COUNT,
+                 commit_interval: Optional[float] = DEFAULT_COMMIT_INTERVAL,
+                 segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 archive_dir: Optional[str] = None,
+                 codec: Codec = JSON) -> None:
+        if commit_count < 1:
+            raise ValueError(f'commit_count must be at least 1, not {commit_count}')
+        if isinstance(fn_io, StringIO) and not isinstance(codec, JsonCodec):
+            raise ValueError('a StringIO journal can only hold json lines')
+
+        self.fn = fn_io if isinstance(fn_io, str) else None
+        self.io = fn_io if isinstance(fn_io, StringIO) else None
+        self.durability = durability
+        self.commit_count = commit_count
+        self.commit_interval = commit_interval
+        self.segment_size = segment_size
+        self.archive_dir = archive_dir
+        self.codec = codec
+
+        # segment -> file name
+        self.segments: Dict[int, str] = {}
+        # the lines of the topics not read yet
+        self.index: Index = {}
+        # the segment being written
+        self.seq = 0
+        self.fp: IO[Any]
+        self.size = 0
+        self.segment_index: SegmentIndex = {}
+        self._open()
+        self._forget_finished()
+
+        # lines waiting for a commit (guarded by condition)
+        self.pending: List[Any] = []
+        self.condition = Condition()
+        # a commit at a time (the background one, or the final one); take
+        # it before condition
+        self.commit_lock = Lock()
+        self.closed = False
+        self.compaction_pending = False
+        # lines written since the last compaction request
+        self.written = 0
+
+        # metrics
+        self.commits = 0
+        self.lines = 0
+        self.commit_time = Histogram()
+        self.compactions = 0
+        self.compaction_time = Histogram()
+        self.snapshot_lines = 0
+
+        self.thread: Optional[Thread] = None
+        if commit_interval is not None:
+            self.thread = Thread(target=self._run, name='journal', daemon=True)
+            self.thread.start()
+
+    # segments
+
+    def _segment_fn(self, seq: int, snapshot: bool = False) -> str:
+        assert self.fn is not None
+        root, ext = splitext(self.fn)
+        return f'{root}.{seq:06d}{".snapshot" if snapshot else ""}{ext}'
+
+    def _index_fn(self, seq: int) -> str:
+        assert self.fn is not None
+        return f'{splitext(self.fn)[0]}.{seq:06d}.idx'
+
+    def _open(self) -> None:
+        'index the existing segments and start a new one'
+        if self.io is not None:
+            self.segments[0] = ''
+            self.segment_index = self._scan(0)
+            self.size = self.io.seek(0, SEEK_END)
+            self._add_to_index(0, self.segment_index)
+            self.fp = self.io
+            return
+
+        assert self.fn is not None
+        directory = dirname(self.fn) or '.'
+        root, ext = splitext(basename(self.fn))
+        snapshots = []
+        for name in listdir(directory) if exists(directory) else []:
+            match = fullmatch(rf'{escape(root)}\.(\d{{6}})(\.snapshot)?{escape(ext)}',
+                              name)
+            if match is not None:
+                seq = int(match.group(1))
+                self.segments[seq] = join(dirname(self.fn), name)
+                if match.group(2):
+                    snapshots.append(seq)
+        # the segments before the last snapshot are in the snapshot (they
+        # are left by a compaction interrupted before dropping them)
+        for seq in [seq for seq in self.segments if seq < max(snapshots, default=0)]:
+            self._drop(seq)
+        for seq in sorted(self.segments):
+            if exists(self._index_fn(seq)):
+                with builtins_open(self._index_fn(seq)) as fp:
+                    segment_index = loads(fp.read())
+            else:
+                # not sealed: the process died while writing it
+                segment_index = self._scan(seq)
+                self._seal(seq, segment_index)
+            self._add_to_index(seq, segment_index)
+        self._new_segment(max(self.segments, default=0) + 1)
+
+    def _forget_finished(self) -> None:
+        'drop from the index the lines before the tombstones (and these)'
+        tombstones = self.index.pop(FINISHED, [])
+        topic_ids = [topic_id
+                     for lines in self._read_ranges(tombstones,
+                                                    self.codec.decode_many)
+                     for topic_id, _ in lines]
+        for (seq, start, _), topic_id in zip(tombstones, topic_ids):
+            ranges = [r for r in self.index.get(topic_id, [])
+                      if (r[0], r[1]) > (seq, start)]
+            if ranges:
+                self.index[topic_id] = ranges
+            else:
+                self.index.pop(topic_id, None)
+
+    def _scan(self, seq: int) -> SegmentIndex:
+        'index a segment reading all its lines (and drop a truncated one)'
+        segment_index: SegmentIndex = {}
+        end = 0
+        with self._mapped(seq) as data:
+            spans = list(self.codec.split(data))
+            if spans:
+                end = spans[-1][1]
+                lines = self.codec.decode_many([data[:end]])
+                for (start, end), line in zip(spans, lines):
+                    _add_range(segment_index, line[1], start, end)
+            size = len(data)
+        if end < size and self.io is None:
+            with builtins_open(self.segments[seq], 'r+b') as fp:
+                fp.truncate(end)
+        return segment_index
+
+    def _add_to_index(self, seq: int, segment_index: SegmentIndex) -> None:
+        for topic_id, ranges in segment_index.items():
+            self.index.setdefault(topic_id, []).extend(
+                (seq, start, end) for start, end in ranges)
+
+    def _new_segment(self, seq: int) -> None:
+        self.seq = seq
+        self.segments[seq] = self._segment_fn(seq)
+        self.fp = builtins_open(self.segments[seq], 'ab')
+        self.size = 0
+        self.segment_index = {}
+
+    def _seal(self, seq: int, segment_index: SegmentIndex) -> None:
+        'write the index of a full segment'
+        tmp = f'{self._index_fn(seq)}.tmp'
+        with builtins_open(tmp, 'w') as fp:
+            fp.write(dumps(segment_index))  # dump is way slower
+            if self.durability is Durability.FSYNC:
+                fp.flush()
+                fsync(fp.fileno())
+        replace(tmp, self._index_fn(seq))
+
+    def _drop(self, seq: int) -> None:
+        'remove (or archive) a segment and its index'
+        fn = self.segments.pop(seq)
+        for path in [fn, self._index_fn(seq)]:
+            if not exists(path):
+                continue
+            if self.archive_dir is not None:
+                replace(path, join(self.archive_dir, basename(path)))
+            else:
+                remove(path)
+
+    @contextmanager
+    def _mapped(self, seq: int) -> Iterator[Buffer]:
+        '''the content of a segment, as a memoryview of its memory map: the
+        frames are sliced and decoded without copying them
+
+        the views must not outlive the with block'''
+        if self.io is not None:
+            yield self.io.getvalue().encode('ascii')
+            return
+        with builtins_open(self.segments[seq], 'rb') as fp:
+            if not fstat(fp.fileno()).st_size:
+                yield b''  # an empty file can not be mapped
+                return
+            with mmap(fp.fileno(), 0, access=ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    yield view
+
+    def _read_ranges(self, ranges: List[Tuple[int, int, int]],
+                     convert: Callable[[List[Buffer]], R]) -> Iterator[R]:
+        '''convert the ranges of each segment (convert must not keep the
+        views, see _mapped), mapping each segment once'''
+        for seq, group in groupby(ranges, key=itemgetter(0)):
+            with self._mapped(seq) as data:
+                views = [data[start:end] for _, start, end in group]
+                converted = convert(views)
+                del views
+            yield converted
+
+    def _write(self, fp: IO[Any], data: bytes) -> None:
+        # json is ascii only, so the offsets in a StringIO are byte offsets
+        fp.write(data.decode('ascii') if fp is self.io else data)
+
+    # api
+
+    def read(self, topic_id: str) -> List[Any]:
+        '''the journaled messages of topic_id; then they are forgotten: a
+        topic is read once, when added to the broker'''
+        return self.read_from(topic_id)[1]
+
+    def read_from(self, topic_id: str) -> Tuple[int, List[Any]]:
+        '''like read, with the offset of the first message (0 unless a
+        compaction dropped the ones before)'''
+        with (self.commit_lock if self.io is not None else nullcontext()):
+            with self.condition:
+                ranges = self.index.pop(topic_id, [])
+                offset = 0
+                messages: List[Any] = []
+                for lines in self._read_ranges(ranges, self.codec.decode_many):
+                    for line in lines:
+                        if len(line) == 3:  # OFFSET
+                            offset = line[0] - len(messages)
+                        else:
+                            messages.append(line[0])
+                return offset, messages
+
+    def write(self, lines: Sequence[Tuple[Any, str]]) -> None:
+        self._append(lines)
+        self.written += len(lines)
+
+    def finish(self, topic_id: str) -> None:
+        '''no more lines of topic_id will be written: forget the ones not read
+        yet, and write a tombstone (for the restarts, until a compaction drops
+        the lines)'''
+        with self.condition:
+            self.index.pop(topic_id, None)
+        self.write([(topic_id, FINISHED)])
+
+    def compact(self, snapshot: List[Line]) -> None:
+        '''rewrite the journal as the lines of the topics not read yet, then
+        snapshot (the lines that rebuild the state of the other topics),
+        then the lines written from now on
+
+        the rewrite happens in the background, like the commits: the
+        snapshot must not be changed afterwards'''
+        with self.condition:
+            unread = {topic_id: list(ranges)
+                      for topic_id, ranges in self.index.items()}
+        self._append([_Compaction(snapshot, unread)])
+        self.written = 0
+
+    def _append(self, lines: Sequence[Any]) -> None:
+        with self.condition:
+            if self.closed:
+                raise ValueError('journal closed')
+            self.pending.extend(lines)
+            if isinstance(lines[-1], _Compaction):
+                self.compaction_pending = True
+            commit_now = self._commit_now()
+            if commit_now and self.thread is not None:
+                self.condition.notify()
+        if commit_now and self.thread is None:
+            self.commit()
+
+    def commit(self) -> None:
+        'write and flush/fsync the pending lines (and do the compactions)'
+        with self.commit_lock:
+            with self.condition:
+                lines, self.pending = self.pending, []
+                self.compaction_pending = False
+
+            start = 0
+            for i, line in enumerate(lines):
+                if isinstance(line, _Compaction):
+                    # the lines before the compaction are in the snapshot
+                    self._compact(line)
+                    start = i + 1
+            self._commit(lines[start:])
+
+    def _commit(self, lines: List[Line]) -> None:
+        if not lines:
+            return
+
+        start = perf_counter()
+        chunks = []
+        for line in lines:
+            chunk = self.codec.encode(line)
+            _add_range(self.segment_index, line[1],
+                       self.size, self.size + len(chunk))
+            self.size += len(chunk)
+            chunks.append(chunk)
+        self._write(self.fp, b''.join(chunks))
+        if self.durability is not Durability.NONE:
+            self.fp.flush()
+        if self.durability is Durability.FSYNC and self.io is None:
+            fsync(self.fp.fileno())
+        if self.io is None and self.size >= self.segment_size:
+            self.fp.close()
+            self._seal(self.seq, self.segment_index)
+            self._new_segment(self.seq + 1)
+        self.commit_time.observe(perf_counter() - start)
+        self.commits += 1
+        self.lines += len(lines)
+
+    def _compact(self, compaction: _Compaction) -> None:
+        started = perf_counter()
+
+        # the unread lines are copied as they are
+        chunks = []
+        segment_index: SegmentIndex = {}
+        size = 0
+        for topic_id, ranges in compaction.unread.items():
+            for copies in self._read_ranges(ranges, _copy):
+                for chunk in copies:
+                    _add_range(segment_index, topic_id, size, size + len(chunk))
+                    size += len(chunk)
+                    chunks.append(chunk)
+        for line in compaction.snapshot:
+            chunk = self.codec.encode(line)
+            _add_range(segment_index, line[1], size, size + len(chunk))
+            size += len(chunk)
+            chunks.append(chunk)
+        data = b''.join(chunks)
+
+        if self.io is not None:
+            seq = 0
+            self.io.seek(0)
+            self.io.truncate()
+            self._write(self.io, data)
+            self.size = size
+            self.segment_index = segment_index
+        else:
+            self.fp.close()
+            self._seal(self.seq, self.segment_index)
+            # write aside and rename: a crash leaves the old segments or the
+            # snapshot (that makes the old segments obsolete)
+            seq = self.seq + 1
+            fn = self._segment_fn(seq, snapshot=True)
+            with builtins_open(f'{fn}.tmp', 'wb') as fp:
+                fp.write(data)
+                fp.flush()
+                if self.durability is Durability.FSYNC:
+                    fsync(fp.fileno())
+            replace(f'{fn}.tmp', fn)
+            self.segments[seq] = fn
+            self._seal(seq, segment_index)
+
+        with self.condition:
+            # the unread topics now are in the snapshot (if still unread)
+            for topic_id in compaction.unread:
+                if topic_id in self.index:
+                    self.index[topic_id] = [(seq, start, end) for start, end
+                                            in segment_index[topic_id]]
+            for old in [old for old in self.segments if old < seq]:
+                self._drop(old)
+        if self.io is None:
+            self._new_segment(seq + 1)
+
+        self.compaction_time.observe(perf_counter() - started)
+        self.compactions += 1
+        self.snapshot_lines = len(compaction.snapshot)
+
+    def _commit_now(self) -> bool:
+        return self.compaction_pending or len(self.pending) >= self.commit_count
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.closed or self._commit_now(),
+                    timeout=self.commit_interval)
+                if self.closed:
+                    return
+            self.commit()
+
+    def close(self) -> None:
+        'commit what is left, stop the background thread and seal the segment'
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.commit()
+        self.fp.flush()
+        if self.io is None:
+            self.fp.close()
+            if self.size:
+                self._seal(self.seq, self.segment_index)
+            else:
+                remove(self.segments.pop(self.seq))
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.condition:
+            pending = len(self.pending)
+            unread = len(self.index)
+        return {'durability': self.durability.name,
+                'pending': pending,
+                'commits': self.commits,
+                'lines': self.lines,
+                'commit_time': self.commit_time.snapshot(),
+                'compactions': self.compactions,
+                'compaction_time': self.compaction_time.snapshot(),
+                'snapshot_lines': self.snapshot_lines,
+                'segments': len(self.segments),
+                'unread_topics': unread}
+
 
 @overload
-def load_broker(fn_io: str = DEFAULT_FN) -> Broker: ...
+def load_broker(fn_io: str = DEFAULT_FN,
+                broker: Optional[Broker] = None, *,
+                durability: Durability = Durability.FLUSH,
+                commit_count: int = DEFAULT_COMMIT_COUNT,
+                commit_interval: Optional[float] = DEFAULT_COMMIT_INTERVAL,
+                compact_every: Optional[int] = DEFAULT_COMPACT_EVERY,
+                segment_size: int = DEFAULT_SEGMENT_SIZE,
+                archive_dir: Optional[str] = None,
+                codec: Codec = JSON,
+                exclude: Sequence[str] = ()) -> Broker: ...
 
 
 @overload
 def load_broker(
     fn_io: StringIO,
-    broker: Optional[Broker] = None) -> Broker: ...
+    broker: Optional[Broker] = None, *,
+    durability: Durability = Durability.FLUSH,
+    commit_count: int = DEFAULT_COMMIT_COUNT,
+    commit_interval: Optional[float] = DEFAULT_COMMIT_INTERVAL,
+    compact_every: Optional[int] = DEFAULT_COMPACT_EVERY,
+    segment_size: int = DEFAULT_SEGMENT_SIZE,
+    archive_dir: Optional[str] = None,
+    codec: Codec = JSON,
+    exclude: Sequence[str] = ()) -> Broker: ...
 
 
 def load_broker(fn_io: Union[str, StringIO] = DEFAULT_FN,
-                broker: Optional[Broker] = None) -> Broker:
-    old_messages = DefaultDict[str, List[Any]](list)
-    try:
-        with (open(fn_io, 'r')
-              if isinstance(fn_io, str)
-              else Reader(fn_io)) as reader:
-            for message, topic_id in reader:
-                old_messages[topic_id].append(message)
-    except OSError:
-        pass
+                broker: Optional[Broker] = None, *,
+                durability: Durability = Durability.FLUSH,
+                commit_count: int = DEFAULT_COMMIT_COUNT,
+                commit_interval: Optional[float] = DEFAULT_COMMIT_INTERVAL,
+                compact_every: Optional[int] = DEFAULT_COMPACT_EVERY,
+                segment_size: int = DEFAULT_SEGMENT_SIZE,
+                archive_dir: Optional[str] = None,
+                codec: Codec = JSON,
+                exclude: Sequence[str] = ()) -> Broker:
+    '''the journal (see Journal) is closed with the broker; the journaled
+    messages of a topic are read when the topic is added
+
+    every compact_every lines (None: never) the journal is compacted to a
+    snapshot of the retained messages of each topic (and of the journaled
+    messages of the topics not added yet), so the removed topics and the
+    messages dropped by the retention are not read again at startup (the
+    refilled topics keep their offsets, see OFFSET); the finished topics (see Broker.finish_topic) are dropped from the journal
+
+    the topics matching a pattern of exclude (see matches) are not journaled'''
+    journal = Journal(fn_io, durability, commit_count, commit_interval,
+                      segment_size, archive_dir, codec)
+
+    def journaled(topic_id: str) -> bool:
+        return not any(matches(pattern, topic_id) for pattern in exclude)
 
     def on_add_topic(topic_id: str, topic: Topic[T]) -> None:
-        'pre-fill topic with old messages'
-        for old_message in old_messages[topic_id]:
+        'pre-fill topic with old messages (with their offsets)'
+        if not journaled(topic_id):
+            return
+        offset, old_messages = journal.read_from(topic_id)
+        topic.next_offset = offset
+        for old_message in old_messages:
             topic.send(old_message)
 
-    def on_send(message: Any, topic_id: str) -> None:
-        'keep track of the message sent'
-        with (open(fn_io, 'a')
-              if isinstance(fn_io, str)
-              else Writer(fn_io)) as writer:
-            writer.write((message, topic_id))
+    def snapshot() -> List[Line]:
+        lines: List[Line] = []
+        for topic_id, topic in b.topics.items():
+            if topic.finished or not journaled(topic_id):
+                continue
+            messages = topic.messages
+            offset = topic.next_offset - len(messages)
+            if offset:
+                lines.append((offset, topic_id, OFFSET))
+            lines.extend((message, topic_id) for message in messages)
+        return lines
+
+    def on_send_many(messages: Sequence[Any], topic_id: str) -> None:
+        'keep track of the messages sent'
+        if not journaled(topic_id):
+            return
+        journal.write([(message, topic_id) for message in messages])
+        if compact_every is not None and journal.written >= compact_every:
+            journal.compact(snapshot())
+
+    def on_finish_topic(topic_id: str) -> None:
+        if journaled(topic_id):
+            journal.finish(topic_id)
 
     b = broker if broker is not None else Broker()
     b.register_on_add_topic(on_add_topic)
-    b.register_on_send(on_send)
+    b.register_on_send_many(on_send_many)
+    b.register_on_finish_topic(on_finish_topic)
+    b.register_on_aclose(journal.close)
     return b
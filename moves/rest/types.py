@@ -4,6 +4,8 @@ import typing
 
 import chess
 
+from .position import Position
+
 
 class PlayerType(enum.Enum):
     CPU = enum.auto()
@@ -26,6 +28,48 @@ class GameUniverse:
     white: Player
     black: typing.Optional[Player]
 
+    # the legal moves and outcome of board, kept by the game engine
+    position: typing.Optional[Position] = dataclasses.field(default=None,
+                                                            repr=False,
+                                                            compare=False)
+
+    def snapshot(self) -> 'Snapshot':
+        'the game as it is now'
+        board = self.board
+        return Snapshot(game_id=self.game_id,
+                        white=self.white,
+                        black=self.black,
+                        fen=board.fen(),
+                        ply=len(board.move_stack),
+                        last_move=board.peek().uci() if board.move_stack else None,
+                        outcome=self.position.outcome
+                                if self.position is not None
+                                else None)
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    '''a game after a move: immutable, so the outputs can be retained,
+    replayed and shared without copies'''
+
+    game_id: str
+    white: Player
+    black: typing.Optional[Player]
+    fen: str
+    # the moves played so far
+    ply: int
+    last_move: typing.Optional[str] = None
+    # None if the game is not over (or was abandoned)
+    outcome: typing.Optional[chess.Outcome] = None
+
+    @property
+    def turn(self) -> chess.Color:
+        return self.fen.split(' ', 2)[1] == 'w'
+
+    def board(self) -> chess.Board:
+        'a new board in the position (without the moves that led there)'
+        return chess.Board(self.fen)
+
 
 class Command(enum.Enum):
     NEW_GAME = enum.auto()
@@ -47,7 +91,7 @@ class InputQueueElement:
     white: typing.Optional[Player] = None
     black: typing.Optional[Player] = None
 
-    # available only if command is not NEW_GAME
+    # for NEW_GAME, the id to assign (if None, the game engine generates it)
     game_id: typing.Optional[str] = None
 
     # available only if command is MOVE
@@ -66,7 +110,7 @@ class Result(enum.Enum):
 class OutputQueueElement:
     result: Result
 
-    game_universe: GameUniverse
+    snapshot: Snapshot
 
     # available only with result==ERROR
     error: typing.Optional[Exception] = None
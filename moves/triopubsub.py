@@ -1,14 +1,32 @@
 from __future__ import annotations
 
+from bisect import bisect_left
+from collections import deque
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from enum import Enum
+from enum import auto
+from heapq import merge
+from itertools import dropwhile
+from itertools import islice
 from math import inf
+from sys import getsizeof
+from time import perf_counter
+from time import time
 from typing import Any
+from typing import AsyncContextManager
 from typing import AsyncIterable
 from typing import AsyncIterator
+from typing import Callable
+from typing import Deque
 from typing import Dict
 from typing import Generic
+from typing import Hashable
+from typing import Iterable
 from typing import List
+from typing import Optional
 from typing import Protocol
+from typing import Sequence
 from typing import Set
 from typing import Type
 from typing import TypeVar
@@ -16,27 +34,243 @@ from typing import cast
 from uuid import uuid4
 
 from async_generator import aclosing
+from trio import EndOfChannel
+from trio import WouldBlock
 from trio import open_memory_channel
 from trio import sleep
 from trio.abc import AsyncResource
+from trio.lowlevel import current_task
+from trio.to_thread import run_sync
 
 T = TypeVar('T')
 
 
-class Subscription(Generic[T], AsyncResource):
+def is_pattern(topic_id: str) -> bool:
+    return '*' in topic_id
+
+
+def matches(pattern: str, topic_id: str) -> bool:
+    '''topic ids are "/" separated paths (e.g. output/<game_id>); a "*" in
+    the pattern matches a whole segment (e.g. output/*)'''
+    pattern_segments = pattern.split('/')
+    segments = topic_id.split('/')
+    return (len(pattern_segments) == len(segments) and
+            all(pattern_segment in ('*', segment)
+                for pattern_segment, segment in zip(pattern_segments,
+                                                    segments)))
+
+
+@dataclass(frozen=True)
+class Retention:
+    '''how much history a topic keeps to replay to future subscribers
+
+    every limit is optional (None means "unbounded"); when more than one is
+    set the oldest messages are dropped until all of them are satisfied
+    '''
+
+    max_count: Optional[int] = None
+    max_age: Optional[float] = None  # seconds
+    max_bytes: Optional[int] = None
+    # for max_bytes and the metrics; the default (shallow, so meaningless
+    # for the metrics) is only used with max_bytes
+    sizeof: Callable[[Any], int] = getsizeof
+
+    @property
+    def sized(self) -> bool:
+        'whether the messages are measured (see Topic.history_bytes)'
+        return self.max_bytes is not None or self.sizeof is not getsizeof
+
+
+KEEP_ALL = Retention()
+KEEP_NONE = Retention(max_count=0)
+
+# the send callbacks are timed once every CALLBACK_SAMPLING sends: a
+# perf_counter pair per callback per send is too much for the hot path
+CALLBACK_SAMPLING = 64
+
+
+@dataclass(frozen=True)
+class Record(Generic[T]):
+    '''a message, as retained in the topic history
+
+    offset is the per-topic sequence number: monotonically increasing, it
+    survives the eviction of older records and can be used to resume
+    '''
+
+    message: T
+    offset: int
+    timestamp: float
+    size: int
+    key: Optional[Hashable] = None  # the routing key
+
+
+class Histogram:
+    'distribution of some observations (e.g. seconds), in exponential buckets'
+
+    # 1us .. 10s, 2 buckets per decade (+ the overflow bucket)
+    BOUNDS = tuple(10 ** (e / 2) for e in range(-12, 3))
+
     def __init__(self) -> None:
-        self.s, self.r = open_memory_channel[T](inf)
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> Optional[float]:
+        'an upper bound of the q-quantile'
+        if not self.count:
+            return None
+        seen = 0
+        for bound, n in zip(self.BOUNDS, self.buckets):
+            seen += n
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(.5),
+                'p90': self.quantile(.9),
+                'p99': self.quantile(.99)}
+
+
+class Overflow(Enum):
+    'what to do when a message arrives and the subscription queue is full'
+
+    DROP_OLDEST = auto()
+    DROP_NEWEST = auto()
+    COALESCE = auto()  # forget all the queued messages, keep the latest
+    DISCONNECT = auto()  # stop sending: the consumer sees the end of stream
+
+
+class Subscription(Generic[T], AsyncResource):
+    def __init__(self, cursor: int = 0,
+                 key: Optional[Hashable] = None,
+                 capacity: float = inf,
+                 overflow: Overflow = Overflow.DISCONNECT) -> None:
+        if capacity < 1:
+            raise ValueError(f'capacity must be at least 1, not {capacity}')
+
+        self.s, self.r = open_memory_channel[Record[T]](capacity)
+        # offset of the next message to consume
+        self.cursor = cursor
+        # receive only the messages with this routing key (None: all)
+        self.key = key
+        self.overflow = overflow
+        self.dropped = 0
+        self.disconnected = False
+
+        # metrics
+        self.created = time()
+        self.consumer: Optional[str] = None  # the name of the consuming task
+        self.queued = 0
+        self.high_water = 0
+        self.delivered = 0
+        # from send to receive (only for the messages sent after the
+        # subscription: the replayed ones are old by definition)
+        self.latency = Histogram()
 
 #     async def send(self, message: T) -> None:
 #         return await self.s.send(message)
 
-    def _send_nowait(self, message: T) -> None:
-        return self.s.send_nowait(message)
+    def _send_nowait(self, record: Record[T]) -> None:
+        if self.disconnected:
+            self.dropped += 1
+            return
+        try:
+            self.s.send_nowait(record)
+        except WouldBlock:
+            self._overflow(record)
+        else:
+            self.queued += 1
+            if self.queued > self.high_water:
+                self.high_water = self.queued
+
+    def _overflow(self, record: Record[T]) -> None:
+        'the queue is full: apply the overflow policy'
+        if self.overflow == Overflow.DROP_NEWEST:
+            self.dropped += 1
+        elif self.overflow == Overflow.DROP_OLDEST:
+            self.r.receive_nowait()
+            self.dropped += 1
+            self.s.send_nowait(record)
+        elif self.overflow == Overflow.COALESCE:
+            while True:
+                try:
+                    self.r.receive_nowait()
+                except WouldBlock:
+                    break
+                self.dropped += 1
+                self.queued -= 1
+            self.s.send_nowait(record)
+            self.queued += 1
+        else:
+            self.dropped += 1
+            self.disconnected = True
+            self.s.close()
+
+    def _received(self, records: List[Record[T]]) -> None:
+        'bookkeeping of the records handed to the consumer'
+        now = time()
+        for record in records:
+            if record.timestamp >= self.created:
+                self.latency.observe(now - record.timestamp)
+        self.queued -= len(records)
+        self.delivered += len(records)
+        self.cursor = records[-1].offset + 1
+
+    async def subscribe_records(self) -> AsyncIterator[Record[T]]:
+        self.consumer = current_task().name
+        async with self.r.clone() as r:
+            async for record in r:
+                self._received([record])
+                yield record
 
     async def subscribe(self) -> AsyncIterator[T]:
+        async with aclosing(cast(AsyncResource,
+                                 self.subscribe_records())) as aiter:
+            async for record in cast(AsyncIterable[Record[T]], aiter):
+                yield record.message
+
+    async def subscribe_record_batches(self) -> AsyncIterator[List[Record[T]]]:
+        'wait for a record, then drain everything already queued'
+        self.consumer = current_task().name
         async with self.r.clone() as r:
-            async for message in r:
-                yield message
+            async for record in r:
+                batch = [record]
+                while True:
+                    try:
+                        batch.append(r.receive_nowait())
+                    except (WouldBlock, EndOfChannel):
+                        break
+                self._received(batch)
+                yield batch
+
+    async def subscribe_batches(self) -> AsyncIterator[List[T]]:
+        async with aclosing(cast(AsyncResource,
+                                 self.subscribe_record_batches())) as aiter:
+            async for batch in cast(AsyncIterable[List[Record[T]]], aiter):
+                yield [record.message for record in batch]
+
+    def metrics(self) -> Dict[str, Any]:
+        return {'consumer': self.consumer,
+                'key': None if self.key is None else str(self.key),
+                'depth': self.queued,
+                'high_water': self.high_water,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'disconnected': self.disconnected,
+                'latency': self.latency.snapshot()}
 
     async def aclose(self) -> None:
         await self.s.aclose()
@@ -44,42 +278,216 @@ class Subscription(Generic[T], AsyncResource):
 
 
 class Topic(Generic[T], AsyncResource):
-    def __init__(self) -> None:
+    def __init__(self, retention: Retention = KEEP_ALL,
+                 key: Optional[Callable[[T], Hashable]] = None) -> None:
         self.subscriptions: Dict[str, Subscription[T]] = {}
-        self.messages: List[T] = []
+        # routing: subscriptions that get everything + key -> subscriptions
+        self.unkeyed_subscriptions: Dict[str, Subscription[T]] = {}
+        self.keyed_subscriptions: Dict[Hashable,
+                                       Dict[str, Subscription[T]]] = {}
+        self.retention = retention
+        self.key = key
+        # ring buffer: append on the right, evict from the left
+        self.history: Deque[Record[T]] = deque()
+        self.history_bytes = 0
+        self.next_offset = 0
         self.aclosing = False
+        # remove the topic when the last subscription leaves
+        self.finished = False
+        # subscriptions shared with other topics (by a pattern): the broker
+        # owns (and closes) them
+        self.shared_subscriptions: Set[str] = set()
+
+        # metrics
+        self.created = time()
+        self.messages_out = 0  # deliveries to the subscriptions
+
+    @property
+    def messages(self) -> List[T]:
+        'the retained messages, oldest first'
+        self._evict(time())
+        return [record.message for record in self.history]
+
+    def _evict(self, now: float) -> None:
+        'drop the oldest messages until the retention policy is honored'
+        retention = self.retention
+        history = self.history
+        while history and (
+                (retention.max_count is not None and
+                 len(history) > retention.max_count) or
+                (retention.max_bytes is not None and
+                 self.history_bytes > retention.max_bytes) or
+                (retention.max_age is not None and
+                 now - history[0].timestamp > retention.max_age)):
+            self.history_bytes -= history.popleft().size
+
+    def replay(self, *,
+               offset: Optional[int] = None,
+               since: Optional[float] = None,
+               key: Optional[Hashable] = None) -> Iterable[Record[T]]:
+        '''the retained records with offset >= offset and timestamp >= since
+        (and with the given routing key, if any)
+
+        if the requested offset was already evicted the replay starts from
+        the oldest retained record
+        '''
+        self._evict(time())
+        records: Iterable[Record[T]] = self.history
+        if offset is not None and self.history:
+            records = islice(records,
+                             max(0, offset - self.history[0].offset),
+                             None)
+        if since is not None:
+            records = dropwhile(lambda record: record.timestamp < since,
+                                records)
+        if key is not None:
+            records = (record for record in records if record.key == key)
+        return records
 
     def add_subscription(self, subscription_id: str, *,
-                         send_old_messages: bool = True) -> Subscription[T]:
+                         send_old_messages: bool = True,
+                         offset: Optional[int] = None,
+                         since: Optional[float] = None,
+                         key: Optional[Hashable] = None,
+                         capacity: float = inf,
+                         overflow: Overflow = Overflow.DISCONNECT) -> Subscription[T]:
+        '''offset/since select the old messages to send (and win over
+        send_old_messages); with a key only the messages with that routing
+        key are sent; with a finite capacity overflow decides what to do
+        with the messages for a slow consumer'''
         if self.aclosing:
             raise BrokenPipeError()
         if subscription_id in self.subscriptions:
             raise KeyError(subscription_id)
+        if key is not None and self.key is None:
+            raise ValueError('topic without routing key')
 
-        subscription = Subscription[T]()
+        subscription = Subscription[T](self.next_offset, key,
+                                       capacity, overflow)
 
         # send old messages
-        if send_old_messages:
-            for message in list(self.messages):
-                subscription._send_nowait(message)
+        if offset is not None or since is not None or send_old_messages:
+            records = list(self.replay(offset=offset, since=since, key=key))
+            if records:
+                subscription.cursor = records[0].offset
+            for record in records:
+                subscription._send_nowait(record)
+
+        self.attach_subscription(subscription_id, subscription)
+        return subscription
 
+    def attach_subscription(self, subscription_id: str,
+                            subscription: Subscription[T], *,
+                            shared: bool = False) -> None:
+        'start sending the new messages to subscription'
         self.subscriptions[subscription_id] = subscription
-        return subscription
+        if subscription.key is None:
+            self.unkeyed_subscriptions[subscription_id] = subscription
+        else:
+            self.keyed_subscriptions.setdefault(
+                subscription.key, {})[subscription_id] = subscription
+        if shared:
+            self.shared_subscriptions.add(subscription_id)
 
-    async def remove_subscription(self, subscription_id: str) -> None:
+    def detach_subscription(self, subscription_id: str) -> Subscription[T]:
+        'stop sending the new messages to the subscription (but do not close it)'
         subscription = self.subscriptions[subscription_id]
         del self.subscriptions[subscription_id]
+        if subscription.key is None:
+            del self.unkeyed_subscriptions[subscription_id]
+        else:
+            keyed = self.keyed_subscriptions[subscription.key]
+            del keyed[subscription_id]
+            if not keyed:
+                del self.keyed_subscriptions[subscription.key]
+        self.shared_subscriptions.discard(subscription_id)
+        return subscription
+
+    async def remove_subscription(self, subscription_id: str) -> None:
+        subscription = self.detach_subscription(subscription_id)
         await subscription.aclose()
 
-    def send(self, message: T) -> None:
-        # save messages for future subscribers
-        self.messages.append(message)
+    @property
+    def idle(self) -> bool:
+        'no subscriptions of its own (the shared ones do not count)'
+        return len(self.subscriptions) == len(self.shared_subscriptions)
+
+    def _record(self, message: T, now: float) -> Record[T]:
+        '''assign the offset, compute size (if measured, see
+        Retention.sized) and key, and retain the message'''
+        size = self.retention.sizeof(message) if self.retention.sized else 0
+        key = self.key(message) if self.key is not None else None
+        record = Record(message, self.next_offset, now, size, key)
+        self.next_offset += 1
 
-        for subscription in list(self.subscriptions.values()):
-            subscription._send_nowait(message)
+        # save messages for future subscribers
+        if self.retention.max_count != 0:
+            self.history.append(record)
+            self.history_bytes += size
+
+        return record
+
+    def send(self, message: T) -> int:
+        'return the offset assigned to the message'
+        now = time()
+        record = self._record(message, now)
+        self._evict(now)
+        key = record.key
+
+        # fan out only to the interested subscriptions
+        subscriptions = list(self.unkeyed_subscriptions.values())
+        if key is not None and key in self.keyed_subscriptions:
+            subscriptions.extend(self.keyed_subscriptions[key].values())
+        for subscription in subscriptions:
+            subscription._send_nowait(record)
+        self.messages_out += len(subscriptions)
+
+        return record.offset
+
+    def send_many(self, messages: Sequence[T]) -> List[int]:
+        '''send a batch of messages with a single pass over the subscriptions;
+        return the offsets assigned to the messages'''
+        now = time()
+        records = [self._record(message, now) for message in messages]
+        self._evict(now)
+
+        for subscription in list(self.unkeyed_subscriptions.values()):
+            for record in records:
+                subscription._send_nowait(record)
+            self.messages_out += len(records)
+
+        if self.keyed_subscriptions:
+            by_key: Dict[Hashable, List[Record[T]]] = {}
+            for record in records:
+                if record.key in self.keyed_subscriptions:
+                    by_key.setdefault(record.key, []).append(record)
+            for key, keyed_records in by_key.items():
+                for subscription in list(self.keyed_subscriptions[key].values()):
+                    for record in keyed_records:
+                        subscription._send_nowait(record)
+                    self.messages_out += len(keyed_records)
+
+        return [record.offset for record in records]
+
+    def metrics(self) -> Dict[str, Any]:
+        self._evict(time())
+        uptime = time() - self.created
+        return {'messages_in': self.next_offset,
+                'messages_in_per_second': (self.next_offset / uptime
+                                           if uptime else None),
+                'messages_out': self.messages_out,
+                'history_messages': len(self.history),
+                'history_bytes': (self.history_bytes
+                                  if self.retention.sized
+                                  else None),
+                'subscriptions': {subscription_id: subscription.metrics()
+                                  for subscription_id, subscription
+                                  in self.subscriptions.items()}}
 
     async def aclose(self) -> None:
         self.aclosing = True
+        for subscription_id in list(self.shared_subscriptions):
+            self.detach_subscription(subscription_id)
         subscription_ids = list(self.subscriptions.keys())
         if subscription_ids:
             for subscription_id in subscription_ids:
@@ -101,28 +509,119 @@ class SendCallback(Generic[T_contra], Protocol):
     def __call__(self, message: T_contra, topic_id: str) -> None: ...
 
 
+class SendManyCallback(Generic[T_contra], Protocol):
+    def __call__(self, messages: Sequence[T_contra], topic_id: str) -> None: ...
+
+
+class PubSub(Protocol):
+    '''the broker API used by the actors: both a Broker and a remote one
+    (see triopubsub_unix) implement it'''
+
+    def add_topic(self, topic_id: str, _cls: Type[T], *,
+                  retention: Retention = ...,
+                  key: Optional[Callable[[T], Hashable]] = ...) -> object: ...
+
+    def send(self, message: T, topic_id: str) -> object: ...
+
+    def send_many(self, messages: Sequence[T], topic_id: str) -> object: ...
+
+    async def finish_topic(self, topic_id: str) -> None: ...
+
+    async def fetch_metrics(self) -> Dict[str, Any]: ...
+
+    async def fetch_records(self, topic_id: str, _cls: Type[T], *,
+                            offset: Optional[int] = ...,
+                            key: Optional[Hashable] = ...) -> List[Record[T]]: ...
+
+    def subscribe(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[T]: ...
+
+    def tmp_subscription(self, topic_id: str, _cls: Type[T], *,
+                         send_old_messages: bool = ...,
+                         offset: Optional[int] = ...,
+                         since: Optional[float] = ...,
+                         key: Optional[Hashable] = ...,
+                         capacity: float = ...,
+                         overflow: Overflow = ...) -> AsyncContextManager[str]: ...
+
+    def subscribe_topic(self, topic_id: str, _cls: Type[T], *,
+                        send_old_messages: bool = ...,
+                        offset: Optional[int] = ...,
+                        since: Optional[float] = ...,
+                        key: Optional[Hashable] = ...,
+                        capacity: float = ...,
+                        overflow: Overflow = ...) -> AsyncIterator[T]: ...
+
+    def subscribe_topic_records(self, topic_id: str, _cls: Type[T], *,
+                                send_old_messages: bool = ...,
+                                offset: Optional[int] = ...,
+                                since: Optional[float] = ...,
+                                key: Optional[Hashable] = ...,
+                                capacity: float = ...,
+                                overflow: Overflow = ...) -> AsyncIterator[Record[T]]: ...
+
+    def subscribe_topic_batches(self, topic_id: str, _cls: Type[T], *,
+                                send_old_messages: bool = ...,
+                                offset: Optional[int] = ...,
+                                since: Optional[float] = ...,
+                                key: Optional[Hashable] = ...,
+                                capacity: float = ...,
+                                overflow: Overflow = ...) -> AsyncIterator[List[T]]: ...
+
+
 class Broker(AsyncResource):
-    def __init__(self) -> None:
+    def __init__(self, callback_sampling: int = CALLBACK_SAMPLING) -> None:
         self.topics: Dict[str, Topic[Any]] = {}
         self.send_callbacks: Set[SendCallback[Any]] = set()
+        self.send_many_callbacks: Set[SendManyCallback[Any]] = set()
+        # callback name -> execution time (of a send every callback_sampling)
+        self.callback_times: Dict[str, Histogram] = {}
+        self.callback_sampling = callback_sampling
+        self.sends = 0
         self.add_topic_callbacks: Set[AddTopicCallback[Any]] = set()
+        self.finish_topic_callbacks: Set[Callable[[str], None]] = set()
+        self.aclose_callbacks: List[Callable[[], None]] = []
+        # pattern -> subscription_id -> subscription, attached to every
+        # matching topic (present and future)
+        self.pattern_subscriptions: Dict[str, Dict[str, Subscription[Any]]] = {}
 
     def register_on_add_topic(self, callback: AddTopicCallback[T]) -> None:
         'register a callback to be called when a topic is created'
         self.add_topic_callbacks.add(callback)
 
+    def register_on_finish_topic(self, callback: Callable[[str], None]) -> None:
+        'register a callback to be called when a topic is finished'
+        self.finish_topic_callbacks.add(callback)
+
     def register_on_send(self, callback: SendCallback[T]) -> None:
         'register a callback to be called when a message is sent to a topic'
         self.send_callbacks.add(callback)
 
-    def add_topic(self, topic_id: str, _cls: Type[T]) -> Topic[T]:
+    def register_on_send_many(self, callback: SendManyCallback[T]) -> None:
+        '''register a callback to be called once per batch of messages sent to
+        a topic (a single send is a batch of one)'''
+        self.send_many_callbacks.add(callback)
+
+    def register_on_aclose(self, callback: Callable[[], None]) -> None:
+        '''register a callback to be called (in a worker thread, it can block)
+        when the broker is closed, after all the topics are removed'''
+        self.aclose_callbacks.append(callback)
+
+    def add_topic(self, topic_id: str, _cls: Type[T], *,
+                  retention: Retention = KEEP_ALL,
+                  key: Optional[Callable[[T], Hashable]] = None) -> Topic[T]:
+        '''key extracts the routing key of the messages (see add_subscription)'''
         if topic_id in self.topics:
             raise KeyError(topic_id)
 
-        topic = Topic[T]()
+        topic = Topic[T](retention, key)
         self.topics[topic_id] = topic
         for callback in self.add_topic_callbacks:
             callback(topic_id, topic)
+        for pattern, subscriptions in self.pattern_subscriptions.items():
+            if matches(pattern, topic_id):
+                for subscription_id, subscription in subscriptions.items():
+                    topic.attach_subscription(subscription_id, subscription,
+                                              shared=True)
         return topic
 
     def add_subscription(
@@ -131,50 +630,257 @@ class Broker(AsyncResource):
             subscription_id: str,
             _cls: Type[T],
             *,
-            send_old_messages: bool = True) -> Subscription[T]:
+            send_old_messages: bool = True,
+            offset: Optional[int] = None,
+            since: Optional[float] = None,
+            key: Optional[Hashable] = None,
+            capacity: float = inf,
+            overflow: Overflow = Overflow.DISCONNECT) -> Subscription[T]:
+        '''topic_id can be a pattern (see matches): the subscription then
+        receives the messages of all the matching topics, also the ones
+        added later'''
+        if is_pattern(topic_id):
+            return self._add_pattern_subscription(
+                topic_id, subscription_id, send_old_messages=send_old_messages,
+                offset=offset, since=since, key=key,
+                capacity=capacity, overflow=overflow)
+
         return self.topics[topic_id].add_subscription(
-            subscription_id, send_old_messages=send_old_messages)
+            subscription_id, send_old_messages=send_old_messages,
+            offset=offset, since=since, key=key,
+            capacity=capacity, overflow=overflow)
+
+    def _add_pattern_subscription(
+            self,
+            pattern: str,
+            subscription_id: str,
+            *,
+            send_old_messages: bool,
+            offset: Optional[int],
+            since: Optional[float],
+            key: Optional[Hashable],
+            capacity: float,
+            overflow: Overflow) -> Subscription[Any]:
+        if subscription_id in self.pattern_subscriptions.get(pattern, {}):
+            raise KeyError(subscription_id)
+        if offset is not None:
+            raise ValueError('offsets are per topic, not per pattern')
+        if key is not None:
+            raise ValueError('routing keys are per topic, not per pattern')
+
+        subscription = Subscription[Any](0, None, capacity, overflow)
+        topics = [topic for topic_id, topic in self.topics.items()
+                  if matches(pattern, topic_id)]
+
+        # send old messages, from all the topics, in order of arrival
+        if since is not None or send_old_messages:
+            for record in merge(*(topic.replay(since=since)
+                                  for topic in topics),
+                                key=lambda record: record.timestamp):
+                subscription._send_nowait(record)
+
+        for topic in topics:
+            topic.attach_subscription(subscription_id, subscription,
+                                      shared=True)
+        self.pattern_subscriptions.setdefault(
+            pattern, {})[subscription_id] = subscription
+        return subscription
+
+    def _subscription(self, topic_id: str, subscription_id: str) -> Subscription[Any]:
+        if is_pattern(topic_id):
+            return self.pattern_subscriptions[topic_id][subscription_id]
+        return self.topics[topic_id].subscriptions[subscription_id]
 
     async def remove_subscription(self, topic_id: str, subscription_id: str) -> None:
-        await self.topics[topic_id].remove_subscription(subscription_id)
+        if is_pattern(topic_id):
+            subscriptions = self.pattern_subscriptions[topic_id]
+            subscription = subscriptions.pop(subscription_id)
+            if not subscriptions:
+                del self.pattern_subscriptions[topic_id]
+            for topic in self.topics.values():
+                if subscription_id in topic.shared_subscriptions:
+                    topic.detach_subscription(subscription_id)
+            await subscription.aclose()
+            return
+
+        topic = self.topics[topic_id]
+        await topic.remove_subscription(subscription_id)
+        if topic.finished and topic.idle:
+            await self.remove_topic(topic_id)
 
     async def remove_topic(self, topic_id: str) -> None:
         topic = self.topics[topic_id]
         del self.topics[topic_id]
         await topic.aclose()
 
-    def send(self, message: T, topic_id: str) -> None:
-        self.topics[topic_id].send(message)
+    async def finish_topic(self, topic_id: str) -> None:
+        '''no more messages will be sent to the topic: remove it (and release
+        its history) as soon as it has no subscriptions of its own'''
+        topic = self.topics[topic_id]
+        topic.finished = True
+        for callback in self.finish_topic_callbacks:
+            callback(topic_id)
+        if topic.idle:
+            await self.remove_topic(topic_id)
+
+    def send(self, message: T, topic_id: str) -> int:
+        'return the offset assigned to the message'
+        offset = self.topics[topic_id].send(message)
+        self._call_back([message], topic_id)
+        return offset
+
+    def send_many(self, messages: Sequence[T], topic_id: str) -> List[int]:
+        'return the offsets assigned to the messages'
+        offsets = self.topics[topic_id].send_many(messages)
+        self._call_back(messages, topic_id)
+        return offsets
+
+    def _call_back(self, messages: Sequence[T], topic_id: str) -> None:
+        'run the send callbacks, timing them once every callback_sampling sends'
+        timed = self.sends % self.callback_sampling == 0
+        self.sends += 1
+        if not timed:
+            for callback in self.send_callbacks:
+                for message in messages:
+                    callback(message, topic_id)
+            for many_callback in self.send_many_callbacks:
+                many_callback(messages, topic_id)
+            return
+
         for callback in self.send_callbacks:
-            callback(message, topic_id)
+            start = perf_counter()
+            for message in messages:
+                callback(message, topic_id)
+            self._callback_time(callback, perf_counter() - start)
+        for many_callback in self.send_many_callbacks:
+            start = perf_counter()
+            many_callback(messages, topic_id)
+            self._callback_time(many_callback, perf_counter() - start)
+
+    def _callback_time(self, callback: Callable[..., None],
+                       seconds: float) -> None:
+        name = getattr(callback, '__qualname__', repr(callback))
+        if name not in self.callback_times:
+            self.callback_times[name] = Histogram()
+        self.callback_times[name].observe(seconds)
+
+    def metrics(self) -> Dict[str, Any]:
+        '''a snapshot of the broker metrics: per topic throughput and
+        history size, per subscription queue depth and latency, and the
+        execution time of the send callbacks (sampled, see CALLBACK_SAMPLING)'''
+        return {'topics': {topic_id: topic.metrics()
+                           for topic_id, topic in self.topics.items()},
+                'patterns': {pattern: {subscription_id: subscription.metrics()
+                                       for subscription_id, subscription
+                                       in subscriptions.items()}
+                             for pattern, subscriptions
+                             in self.pattern_subscriptions.items()},
+                'callbacks': {name: histogram.snapshot()
+                              for name, histogram
+                              in self.callback_times.items()}}
+
+    async def fetch_metrics(self) -> Dict[str, Any]:
+        'same as metrics (for the PubSub protocol)'
+        return self.metrics()
+
+    async def fetch_records(self, topic_id: str, _cls: Type[T], *,
+                            offset: Optional[int] = None,
+                            key: Optional[Hashable] = None) -> List[Record[T]]:
+        'the retained records of the topic (see Topic.replay)'
+        return list(self.topics[topic_id].replay(offset=offset, key=key))
 
     async def subscribe(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[T]:
         async with aclosing(cast(AsyncResource,
-                                 self.topics[topic_id].subscriptions[subscription_id].subscribe())) as aiter:
+                                 self._subscription(topic_id, subscription_id).subscribe())) as aiter:
             async for message in cast(AsyncIterable[T], aiter):
                 yield message
 
+    async def subscribe_records(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[Record[T]]:
+        async with aclosing(cast(AsyncResource,
+                                 self._subscription(topic_id, subscription_id).subscribe_records())) as aiter:
+            async for record in cast(AsyncIterable[Record[T]], aiter):
+                yield record
+
+    async def subscribe_batches(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[List[T]]:
+        async with aclosing(cast(AsyncResource,
+                                 self._subscription(topic_id, subscription_id).subscribe_batches())) as aiter:
+            async for batch in cast(AsyncIterable[List[T]], aiter):
+                yield batch
+
     @asynccontextmanager
     async def tmp_subscription(self, topic_id: str, _cls: Type[T], *,
-                               send_old_messages: bool = True) -> AsyncIterator[str]:
+                               send_old_messages: bool = True,
+                               offset: Optional[int] = None,
+                               since: Optional[float] = None,
+                               key: Optional[Hashable] = None,
+                               capacity: float = inf,
+                               overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[str]:
         subscription_id = str(uuid4())
 
         self.add_subscription(topic_id, subscription_id, _cls,
-                              send_old_messages=send_old_messages)
+                              send_old_messages=send_old_messages,
+                              offset=offset, since=since, key=key,
+                              capacity=capacity, overflow=overflow)
         try:
             yield subscription_id
         finally:
             await self.remove_subscription(topic_id, subscription_id)
 
     async def subscribe_topic(self, topic_id: str, _cls: Type[T], *,
-                              send_old_messages: bool = True) -> AsyncIterator[T]:
+                              send_old_messages: bool = True,
+                              offset: Optional[int] = None,
+                              since: Optional[float] = None,
+                              key: Optional[Hashable] = None,
+                              capacity: float = inf,
+                              overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[T]:
         async with self.tmp_subscription(topic_id, _cls,
-                                         send_old_messages=send_old_messages) as subscription_id:
+                                         send_old_messages=send_old_messages,
+                                         offset=offset, since=since,
+                                         key=key, capacity=capacity,
+                                         overflow=overflow) as subscription_id:
             async with aclosing(cast(AsyncResource,
                                      self.subscribe(topic_id, subscription_id, _cls))) as aiter:
                 async for message in cast(AsyncIterable[T], aiter):
                     yield message
 
+    async def subscribe_topic_records(self, topic_id: str, _cls: Type[T], *,
+                                      send_old_messages: bool = True,
+                                      offset: Optional[int] = None,
+                                      since: Optional[float] = None,
+                                      key: Optional[Hashable] = None,
+                                      capacity: float = inf,
+                                      overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[Record[T]]:
+        '''like subscribe_topic, but yield the records: the consumer can keep
+        track of the last offset seen and resume from offset + 1'''
+        async with self.tmp_subscription(topic_id, _cls,
+                                         send_old_messages=send_old_messages,
+                                         offset=offset, since=since,
+                                         key=key, capacity=capacity,
+                                         overflow=overflow) as subscription_id:
+            async with aclosing(cast(AsyncResource,
+                                     self.subscribe_records(topic_id, subscription_id, _cls))) as aiter:
+                async for record in cast(AsyncIterable[Record[T]], aiter):
+                    yield record
+
+    async def subscribe_topic_batches(self, topic_id: str, _cls: Type[T], *,
+                                      send_old_messages: bool = True,
+                                      offset: Optional[int] = None,
+                                      since: Optional[float] = None,
+                                      key: Optional[Hashable] = None,
+                                      capacity: float = inf,
+                                      overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[List[T]]:
+        '''like subscribe_topic, but yield all the messages queued so far in a
+        single batch'''
+        async with self.tmp_subscription(topic_id, _cls,
+                                         send_old_messages=send_old_messages,
+                                         offset=offset, since=since,
+                                         key=key, capacity=capacity,
+                                         overflow=overflow) as subscription_id:
+            async with aclosing(cast(AsyncResource,
+                                     self.subscribe_batches(topic_id, subscription_id, _cls))) as aiter:
+                async for batch in cast(AsyncIterable[List[T]], aiter):
+                    yield batch
+
     async def aclose(self) -> None:
         topic_ids = list(self.topics.keys())
         if topic_ids:
@@ -182,3 +888,8 @@ class Broker(AsyncResource):
                 await self.remove_topic(topic_id)
         else:
             await sleep(0)
+        for pattern, subscriptions in list(self.pattern_subscriptions.items()):
+            for subscription_id in list(subscriptions):
+                await self.remove_subscription(pattern, subscription_id)
+        for callback in self.aclose_callbacks:
+            await run_sync(callback)
@@ -0,0 +1,524 @@
+'''triopubsub over a local unix socket
+
+a Broker lives in one process (serve_broker) and the other processes talk to
+it through a RemoteBroker (open_remote_broker), that exposes the same
+add_topic/send/subscribe_topic API.
+
+the wire format is a sequence of frames: a 4 bytes big endian length and a
+pickle payload. unpickling a frame can run arbitrary code, so every peer
+that can connect is trusted as much as the broker process itself: the socket
+is only accessible to its owner (mode 0600), keep it in a directory that
+other users cannot write to. every connection starts with a "hello" frame:
+- ('publish',): the connection is then used to send add_topic/send_many/
+  finish_topic frames; a frame that cannot be handled (e.g. a send_many to a
+  missing topic) is answered with ('error', exception), a ('sync',) frame with
+  ('synced',) when all the previous frames were handled
+- ('subscribe', topic_id, options): the server replies with ('ok',) or
+  ('error', exception), then streams ('records', [Record, ...]) frames
+- ('metrics',): the server replies with the Broker.metrics() snapshot
+- ('records', topic_id, offset, key): the server replies with the retained
+  records of the topic, or with ('error', exception)
+
+topic key functions travel by reference, so they must be importable (no
+lambdas)
+'''
+
+from __future__ import annotations
+
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
+from logging import getLogger
+from math import inf
+from os import chmod
+from os import unlink
+from pickle import HIGHEST_PROTOCOL
+from pickle import dumps
+from pickle import loads
+from socket import AF_UNIX
+from socket import SOCK_STREAM
+from typing import Any
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Hashable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Type
+from typing import TypeVar
+from typing import cast
+from uuid import uuid4
+
+from async_generator import aclosing
+from trio import TASK_STATUS_IGNORED
+from trio import BrokenResourceError
+from trio import ClosedResourceError
+from trio import EndOfChannel
+from trio import Event
+from trio import MemoryReceiveChannel
+from trio import MemorySendChannel
+from trio import SocketListener
+from trio import SocketStream
+from trio import WouldBlock
+from trio import open_memory_channel
+from trio import open_nursery
+from trio import open_unix_socket
+from trio import serve_listeners
+from trio.abc import AsyncResource
+from trio.abc import Stream
+from trio.socket import socket
+
+from .triopubsub import KEEP_ALL
+from .triopubsub import Broker
+from .triopubsub import Overflow
+from .triopubsub import Record
+from .triopubsub import Retention
+
+LOGS = getLogger(__name__)
+
+T = TypeVar('T')
+
+_HEADER = 4
+
+
+async def _send_frames(stream: Stream, frames: Sequence[Any]) -> None:
+    'send some frames with a single write'
+    data = bytearray()
+    for frame in frames:
+        payload = dumps(frame, HIGHEST_PROTOCOL)
+        data += len(payload).to_bytes(_HEADER, 'big')
+        data += payload
+    await stream.send_all(bytes(data))
+
+
+class _FrameReader:
+    def __init__(self, stream: Stream) -> None:
+        self.stream = stream
+        self.buffer = bytearray()
+
+    async def _fill(self, n: int) -> bool:
+        'False if the stream ended before n bytes were available'
+        while len(self.buffer) < n:
+            data = await self.stream.receive_some()
+            if not data:
+                return False
+            self.buffer += data
+        return True
+
+    async def read(self) -> Optional[Any]:
+        'the next frame, or None at the end of the stream'
+        if not await self._fill(_HEADER):
+            return None
+        size = int.from_bytes(self.buffer[:_HEADER], 'big')
+        if not await self._fill(_HEADER + size):
+            return None
+        payload = bytes(self.buffer[_HEADER:_HEADER + size])
+        del self.buffer[:_HEADER + size]
+        return loads(payload)
+
+
+# server side
+
+
+async def _publisher(broker: Broker, stream: Stream,
+                     reader: _FrameReader) -> None:
+    while True:
+        frame = await reader.read()
+        if frame is None:
+            return
+
+        try:
+            if frame[0] == 'sync':
+                await _send_frames(stream, [('synced',)])
+            elif frame[0] == 'add_topic':
+                _, topic_id, retention, key = frame
+                # idempotent: every process declares the topics it uses
+                if topic_id not in broker.topics:
+                    broker.add_topic(topic_id, object,
+                                     retention=retention, key=key)
+            elif frame[0] == 'send_many':
+                _, topic_id, messages = frame
+                broker.send_many(messages, topic_id)
+            elif frame[0] == 'finish_topic':
+                _, topic_id = frame
+                if topic_id in broker.topics:
+                    await broker.finish_topic(topic_id)
+            else:
+                raise ValueError(f'unknown frame: {frame[0]}')
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            # the messages are dropped: tell the client (see RemoteBroker.sync)
+            LOGS.error('cannot handle frame %s: %r', frame[0], e)
+            await _send_frames(stream, [('error', e)])
+
+
+async def _subscriber(broker: Broker, stream: Stream, reader: _FrameReader,
+                      topic_id: str, options: Dict[str, Any]) -> None:
+    subscription_id = str(uuid4())
+    try:
+        subscription = broker.add_subscription(topic_id, subscription_id,
+                                               object, **options)
+    except (KeyError, ValueError, TypeError, BrokenPipeError) as e:
+        await _send_frames(stream, [('error', e)])
+        return
+
+    try:
+        await _send_frames(stream, [('ok',)])
+
+        async with open_nursery() as nursery:
+            async def watch_eof() -> None:
+                'the client closed the subscription'
+                await reader.read()
+                nursery.cancel_scope.cancel()
+            nursery.start_soon(watch_eof)
+
+            async with aclosing(cast(AsyncResource,
+                                     subscription.subscribe_record_batches())) as aiter:
+                async for batch in cast(AsyncIterable[List[Record[Any]]],
+                                        aiter):
+                    await _send_frames(stream, [('records', batch)])
+
+            # the subscription ended (disconnected or topic removed)
+            nursery.cancel_scope.cancel()
+    except (BrokenResourceError, ClosedResourceError):
+        pass
+    finally:
+        try:
+            await broker.remove_subscription(topic_id, subscription_id)
+        except KeyError:
+            pass  # already removed with its topic
+
+
+async def _handle(broker: Broker, stream: SocketStream) -> None:
+    'serve a connection; its errors never reach the other connections'
+    async with stream:
+        try:
+            await _handle_hello(broker, stream)
+        except (BrokenResourceError, ClosedResourceError):
+            pass  # the client went away
+        except Exception:
+            LOGS.exception('dropping a connection')
+
+
+async def _handle_hello(broker: Broker, stream: SocketStream) -> None:
+    reader = _FrameReader(stream)
+    hello = await reader.read()
+    if hello is None:
+        return
+    if hello[0] == 'publish':
+        await _publisher(broker, stream, reader)
+    elif hello[0] == 'subscribe':
+        _, topic_id, options = hello
+        await _subscriber(broker, stream, reader, topic_id, options)
+    elif hello[0] == 'metrics':
+        await _send_frames(stream, [broker.metrics()])
+    elif hello[0] == 'records':
+        _, topic_id, offset, key = hello
+        try:
+            records = await broker.fetch_records(topic_id, object,
+                                                 offset=offset, key=key)
+        except KeyError as e:
+            await _send_frames(stream, [('error', e)])
+        else:
+            await _send_frames(stream, [('records', records)])
+    else:
+        LOGS.error('unknown hello: %s', hello[0])
+
+
+async def serve_broker(broker: Broker, path: str, *,
+                       task_status: Any = TASK_STATUS_IGNORED) -> None:
+    '''expose broker on the unix socket at path (until cancelled); only the
+    owner can connect (see the trust boundary above)'''
+    try:
+        unlink(path)  # stale socket of a previous run
+    except FileNotFoundError:
+        pass
+
+    sock = socket(AF_UNIX, SOCK_STREAM)
+    await sock.bind(path)
+    # nobody can connect before listen, so there is no window with the
+    # default permissions
+    chmod(path, 0o600)
+    sock.listen()
+    try:
+        await serve_listeners(partial(_handle, broker),
+                              [SocketListener(sock)],
+                              task_status=task_status)
+    finally:
+        unlink(path)
+
+
+# client side
+
+
+class RemoteBroker(AsyncResource):
+    '''the client of serve_broker, use it with open_remote_broker
+
+    add_topic/send/send_many only enqueue the request: a background task
+    sends the queue, in order, with a write per batch. tmp_subscription
+    waits for the server to handle the queue and to register the
+    subscription, so it sees the topics added before and receives all the
+    messages sent afterwards
+
+    the requests that the server cannot handle (e.g. a send to a missing
+    topic) are logged, and raised by the next sync
+    '''
+
+    def __init__(self, path: str,
+                 s: MemorySendChannel[Tuple[Any, ...]]) -> None:
+        self.path = path
+        self.s = s
+        self.subscriptions: Dict[str, _FrameReader] = {}
+        self.syncs: Deque[Event] = deque()
+        self.errors: List[Exception] = []
+        self.closed = False
+
+    def add_topic(self, topic_id: str, _cls: Type[T], *,
+                  retention: Retention = KEEP_ALL,
+                  key: Optional[Callable[[T], Hashable]] = None) -> None:
+        'create the topic on the server (if it does not exist yet)'
+        self.s.send_nowait(('add_topic', topic_id, retention, key))
+
+    def send(self, message: T, topic_id: str) -> None:
+        self.s.send_nowait(('send_many', topic_id, [message]))
+
+    def send_many(self, messages: Sequence[T], topic_id: str) -> None:
+        self.s.send_nowait(('send_many', topic_id, list(messages)))
+
+    async def finish_topic(self, topic_id: str) -> None:
+        self.s.send_nowait(('finish_topic', topic_id))
+
+    async def sync(self) -> None:
+        '''wait for the server to handle everything sent so far; raise the
+        first error of the requests sent since the previous sync'''
+        await self._sync()
+        if self.errors:
+            error, *_ = self.errors
+            self.errors.clear()
+            raise error
+
+    async def _sync(self) -> None:
+        'BrokenPipeError if the connection is closed'
+        if self.closed:
+            raise BrokenPipeError()
+        event = Event()
+        self.syncs.append(event)
+        self.s.send_nowait(('sync',))
+        await event.wait()
+        if self.closed:
+            raise BrokenPipeError()
+
+    async def _sync_reader(self, stream: Stream) -> None:
+        reader = _FrameReader(stream)
+        try:
+            while True:
+                frame = await reader.read()
+                if frame is None:
+                    break
+                if frame[0] == 'error':
+                    LOGS.error('the broker dropped a request: %r', frame[1])
+                    self.errors.append(frame[1])
+                else:
+                    self.syncs.popleft().set()
+        except (BrokenResourceError, ClosedResourceError):
+            LOGS.error('the broker closed the connection')
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        'the connection is gone: wake up the pending syncs, that will fail'
+        self.closed = True
+        while self.syncs:
+            self.syncs.popleft().set()
+
+    async def _writer(self, stream: SocketStream,
+                      r: MemoryReceiveChannel[Tuple[Any, ...]]) -> None:
+        try:
+            await self._write(stream, r)
+        except (BrokenResourceError, ClosedResourceError):
+            LOGS.error('the broker closed the connection')
+            self._close()
+
+    async def _write(self, stream: SocketStream,
+                     r: MemoryReceiveChannel[Tuple[Any, ...]]) -> None:
+        async with r:
+            async for frame in r:
+                frames = [frame]
+                while True:
+                    try:
+                        frames.append(r.receive_nowait())
+                    except (WouldBlock, EndOfChannel):
+                        break
+
+                # merge consecutive sends to the same topic
+                merged: List[Tuple[Any, ...]] = []
+                for frame in frames:
+                    if (frame[0] == 'send_many' and merged and
+                            merged[-1][0] == 'send_many' and
+                            merged[-1][1] == frame[1]):
+                        merged[-1][2].extend(frame[2])
+                    else:
+                        merged.append(frame)
+
+                await _send_frames(stream, merged)
+
+        # let the server close the connection (and so stop _sync_reader)
+        await stream.send_eof()
+
+    async def fetch_metrics(self) -> Dict[str, Any]:
+        'the metrics of the served broker'
+        async with await open_unix_socket(self.path) as stream:
+            await _send_frames(stream, [('metrics',)])
+            metrics = await _FrameReader(stream).read()
+        if metrics is None:
+            raise BrokenPipeError()
+        return cast(Dict[str, Any], metrics)
+
+    async def fetch_records(self, topic_id: str, _cls: Type[T], *,
+                            offset: Optional[int] = None,
+                            key: Optional[Hashable] = None) -> List[Record[T]]:
+        'the retained records of the topic (after the queued requests)'
+        await self._sync()
+
+        async with await open_unix_socket(self.path) as stream:
+            await _send_frames(stream, [('records', topic_id, offset, key)])
+            reply = await _FrameReader(stream).read()
+        if reply is None:
+            raise BrokenPipeError()
+        if reply[0] == 'error':
+            raise reply[1]
+        return cast(List[Record[T]], reply[1])
+
+    async def _subscribe_record_batches(self, subscription_id: str) -> AsyncIterator[List[Record[Any]]]:
+        reader = self.subscriptions[subscription_id]
+        while True:
+            frame = await reader.read()
+            if frame is None:
+                return
+            yield frame[1]
+
+    async def subscribe_records(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[Record[T]]:
+        async with aclosing(cast(AsyncResource,
+                                 self._subscribe_record_batches(subscription_id))) as aiter:
+            async for batch in cast(AsyncIterable[List[Record[T]]], aiter):
+                for record in batch:
+                    yield record
+
+    async def subscribe(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[T]:
+        async with aclosing(cast(AsyncResource,
+                                 self._subscribe_record_batches(subscription_id))) as aiter:
+            async for batch in cast(AsyncIterable[List[Record[T]]], aiter):
+                for record in batch:
+                    yield record.message
+
+    async def subscribe_batches(self, topic_id: str, subscription_id: str, _cls: Type[T]) -> AsyncIterator[List[T]]:
+        async with aclosing(cast(AsyncResource,
+                                 self._subscribe_record_batches(subscription_id))) as aiter:
+            async for batch in cast(AsyncIterable[List[Record[T]]], aiter):
+                yield [record.message for record in batch]
+
+    @asynccontextmanager
+    async def tmp_subscription(self, topic_id: str, _cls: Type[T], *,
+                               send_old_messages: bool = True,
+                               offset: Optional[int] = None,
+                               since: Optional[float] = None,
+                               key: Optional[Hashable] = None,
+                               capacity: float = inf,
+                               overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[str]:
+        await self._sync()
+
+        stream = await open_unix_socket(self.path)
+        async with stream:
+            reader = _FrameReader(stream)
+            await _send_frames(stream, [('subscribe', topic_id,
+                                         dict(send_old_messages=send_old_messages,
+                                              offset=offset, since=since,
+                                              key=key, capacity=capacity,
+                                              overflow=overflow))])
+            reply = await reader.read()
+            if reply is None:
+                raise BrokenPipeError()
+            if reply[0] == 'error':
+                raise reply[1]
+
+            subscription_id = str(uuid4())
+            self.subscriptions[subscription_id] = reader
+            try:
+                yield subscription_id
+            finally:
+                del self.subscriptions[subscription_id]
+
+    async def subscribe_topic(self, topic_id: str, _cls: Type[T], *,
+                              send_old_messages: bool = True,
+                              offset: Optional[int] = None,
+                              since: Optional[float] = None,
+                              key: Optional[Hashable] = None,
+                              capacity: float = inf,
+                              overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[T]:
+        async with self.tmp_subscription(topic_id, _cls,
+                                         send_old_messages=send_old_messages,
+                                         offset=offset, since=since,
+                                         key=key, capacity=capacity,
+                                         overflow=overflow) as subscription_id:
+            async with aclosing(cast(AsyncResource,
+                                     self.subscribe(topic_id, subscription_id, _cls))) as aiter:
+                async for message in cast(AsyncIterable[T], aiter):
+                    yield message
+
+    async def subscribe_topic_records(self, topic_id: str, _cls: Type[T], *,
+                                      send_old_messages: bool = True,
+                                      offset: Optional[int] = None,
+                                      since: Optional[float] = None,
+                                      key: Optional[Hashable] = None,
+                                      capacity: float = inf,
+                                      overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[Record[T]]:
+        async with self.tmp_subscription(topic_id, _cls,
+                                         send_old_messages=send_old_messages,
+                                         offset=offset, since=since,
+                                         key=key, capacity=capacity,
+                                         overflow=overflow) as subscription_id:
+            async with aclosing(cast(AsyncResource,
+                                     self.subscribe_records(topic_id, subscription_id, _cls))) as aiter:
+                async for record in cast(AsyncIterable[Record[T]], aiter):
+                    yield record
+
+    async def subscribe_topic_batches(self, topic_id: str, _cls: Type[T], *,
+                                      send_old_messages: bool = True,
+                                      offset: Optional[int] = None,
+                                      since: Optional[float] = None,
+                                      key: Optional[Hashable] = None,
+                                      capacity: float = inf,
+                                      overflow: Overflow = Overflow.DISCONNECT) -> AsyncIterator[List[T]]:
+        async with self.tmp_subscription(topic_id, _cls,
+                                         send_old_messages=send_old_messages,
+                                         offset=offset, since=since,
+                                         key=key, capacity=capacity,
+                                         overflow=overflow) as subscription_id:
+            async with aclosing(cast(AsyncResource,
+                                     self.subscribe_batches(topic_id, subscription_id, _cls))) as aiter:
+                async for batch in cast(AsyncIterable[List[T]], aiter):
+                    yield batch
+
+    async def aclose(self) -> None:
+        'stop accepting messages; the queued ones are still sent'
+        await self.s.aclose()
+
+
+@asynccontextmanager
+async def open_remote_broker(path: str) -> AsyncIterator[RemoteBroker]:
+    'connect to the broker served at path'
+    stream = await open_unix_socket(path)
+    await _send_frames(stream, [('publish',)])
+
+    s, r = open_memory_channel[Tuple[Any, ...]](inf)
+    broker = RemoteBroker(path, s)
+    async with stream, open_nursery() as nursery:
+        nursery.start_soon(broker._writer, stream, r)
+        nursery.start_soon(broker._sync_reader, stream)
+        try:
+            yield broker
+        finally:
+            await broker.aclose()
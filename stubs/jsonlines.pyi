@@ -1,4 +1,5 @@
 from io import StringIO
+from typing import IO
 from typing import Any
 from typing import ContextManager
 from typing import Iterable
@@ -13,10 +14,14 @@ class Reader(Iterable[Any], ContextManager['Reader']):
 
 
 class Writer(ContextManager['Writer']):
-    def __init__(self, fn: StringIO) -> None: ...
+    def __init__(self, fn: IO[str]) -> None: ...
+
+    def close(self) -> None: ...
 
     def write(self, obj: Any) -> None: ...
 
+    def write_all(self, iterable: Iterable[Any]) -> None: ...
+
 
 @overload
 def open(_fn: str, _mode: Literal['r'], / ) -> ContextManager[Reader]: ...
@@ -0,0 +1,50 @@
+from os.path import join
+from random import Random
+from struct import pack
+from tempfile import TemporaryDirectory
+from typing import List
+from typing import Tuple
+from unittest import TestCase
+
+from chess import Board
+from chess import Move
+from chess.polyglot import zobrist_hash
+
+from moves.rest.book import OpeningBook
+
+
+def write_book(path: str, entries: List[Tuple[Board, str, int]]) -> None:
+    'a polyglot book of (position, move, weight)'
+    records = []
+    for board, uci, weight in entries:
+        move = Move.from_uci(uci)
+        raw_move = move.to_square | move.from_square << 6
+        records.append(pack('>QHHI', zobrist_hash(board), raw_move, weight, 0))
+    with open(path, 'wb') as fp:
+        fp.write(b''.join(sorted(records)))
+
+
+def after(*moves: str) -> Board:
+    board = Board()
+    for move in moves:
+        board.push_uci(move)
+    return board
+
+
+class TestOpeningBook(TestCase):
+    def test_move(self) -> None:
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'book.bin')
+            write_book(path, [(after(), 'e2e4', 1),
+                              (after(), 'd2d4', 1),
+                              (after('e2e4'), 'e7e5', 1)])
+            book = OpeningBook(path, Random(0))
+            try:
+                self.assertSetEqual({Move.from_uci('e2e4'),
+                                     Move.from_uci('d2d4')},
+                                    {book.move(after()) for _ in range(16)})
+                self.assertEqual(Move.from_uci('e7e5'), book.move(after('e2e4')))
+                self.assertIsNone(book.move(after('a2a3')))
+                self.assertDictEqual({'hits': 17, 'misses': 1}, book.metrics())
+            finally:
+                book.close()
@@ -0,0 +1,89 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from chess import Board
+from chess import Move as ChessMove
+from chess import Outcome
+from chess import Termination
+
+from moves.rest.codec import BINARY
+from moves.rest.codec import JSON
+from moves.rest.storage import Journal
+from moves.rest.types import Command
+from moves.rest.types import GameUniverse
+from moves.rest.types import InputQueueElement
+from moves.rest.types import Move
+from moves.rest.types import OutputQueueElement
+from moves.rest.types import Player
+from moves.rest.types import PlayerType
+from moves.rest.types import Result
+
+
+class TestCodec(TestCase):
+    def test_values(self) -> None:
+        for value in [None, True, False, 0, -1, 300, -2**70, 1.5, '', 'foo',
+                      'e7e8q', '0000', 'àè', b'\x00', [1, [2]], (1, 'a'),
+                      {'k': [None]}, Command.MOVE, PlayerType.CPU,
+                      ChessMove.from_uci('a7a8n'),
+                      Outcome(Termination.CHECKMATE, False),
+                      Outcome(Termination.STALEMATE, None)]:
+            with self.subTest(value=value):
+                self.assertEqual(value, BINARY.decode(BINARY.encode(value)))
+                self.assertIs(type(value),
+                              type(BINARY.decode(BINARY.encode(value))))
+
+    def test_elements(self) -> None:
+        white = Player('pid1', PlayerType.HUMAN, 'name')
+        black = Player('pid2', PlayerType.CPU)
+        board = Board()
+        for uci in ['e2e4', 'e7e5', 'g1f3']:
+            board.push_uci(uci)
+        game_universe = GameUniverse('game_id', board, white, black)
+
+        input_element = InputQueueElement(Command.MOVE, game_id='game_id',
+                                          move=Move('g1f3', 'pid1'))
+        self.assertEqual(input_element,
+                         BINARY.decode(BINARY.encode(input_element)))
+
+        # the history too, not only the position
+        decoded = BINARY.decode(BINARY.encode(game_universe))
+        self.assertEqual(board.fen(), decoded.board.fen())
+        self.assertListEqual(board.move_stack, decoded.board.move_stack)
+
+        output_element = OutputQueueElement(Result.MOVE,
+                                            game_universe.snapshot(),
+                                            move='g1f3')
+        self.assertEqual(output_element,
+                         BINARY.decode(BINARY.encode(output_element)))
+
+        error = OutputQueueElement(Result.ERROR, game_universe.snapshot(),
+                                   error=ValueError('illegal'))
+        decoded = BINARY.decode(BINARY.encode(error))
+        self.assertIsInstance(decoded.error, ValueError)
+        self.assertEqual(('illegal', ), decoded.error.args)
+
+    def test_split(self) -> None:
+        for codec in [JSON, BINARY]:
+            with self.subTest(codec=codec):
+                frames = [codec.encode(['x' * i, i]) for i in range(200)]
+                data = b''.join(frames)
+                # a truncated last frame is skipped
+                spans = list(codec.split(data + frames[-1][:-1]))
+                self.assertListEqual(frames,
+                                     [data[start:end] for start, end in spans])
+
+    def test_binary_journal(self) -> None:
+        element = InputQueueElement(Command.NEW_GAME,
+                                    white=Player('pid1', PlayerType.HUMAN))
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'journal.bin')
+            journal = Journal(fn, commit_interval=None, codec=BINARY)
+            journal.write([(element, 'input'), ('foo', 'other')])
+            journal.close()
+
+            journal = Journal(fn, commit_interval=None, codec=BINARY)
+            try:
+                self.assertListEqual([element], journal.read('input'))
+            finally:
+                journal.close()
@@ -0,0 +1,210 @@
+from typing import List
+from unittest import TestCase
+
+from chess import Board
+from chess import Move
+from chess.engine import EngineError
+from chess.engine import EngineTerminatedError
+from chess.engine import Limit
+from chess.engine import PlayResult
+from trio import Event
+from trio import open_nursery
+from trio import sleep_forever
+from trio.testing import wait_all_tasks_blocked
+
+from moves.rest.engines import MAX_ENGINES
+from moves.rest.engines import SEARCH_RETRIES
+from moves.rest.engines import EnginePool
+
+from ._support_for_tests import timeout
+from ._support_for_tests import trio_test
+
+
+class FakeEngine:
+    '''plays the first legal move, when allowed to (and expects the first
+    legal reply)'''
+
+    def __init__(self, go: Event) -> None:
+        self.go = go
+        self.searches = 0
+        self.pings = 0
+        self.quitted = False
+        self.killed = False
+
+    async def play(self, board: Board, limit: Limit) -> PlayResult:
+        await self.go.wait()
+        self.searches += 1
+        move = next(iter(board.legal_moves))
+        board.push(move)
+        return PlayResult(move, next(iter(board.legal_moves), None),
+                          info={'nodes': 1000})
+
+    async def ping(self) -> None:
+        self.pings += 1
+
+    async def quit(self) -> None:
+        self.quitted = True
+
+    def kill(self) -> None:
+        self.killed = True
+
+
+class DeadEngine(FakeEngine):
+    'crashed'
+
+    async def play(self, board: Board, limit: Limit) -> PlayResult:
+        raise EngineTerminatedError('engine process died unexpectedly')
+
+    async def ping(self) -> None:
+        raise EngineTerminatedError('engine process died unexpectedly')
+
+
+class WedgedEngine(FakeEngine):
+    'never answers'
+
+    async def play(self, board: Board, limit: Limit) -> PlayResult:
+        await sleep_forever()
+        raise AssertionError('unreachable')
+
+
+class StuckEngine(FakeEngine):
+    'never quits'
+
+    async def quit(self) -> None:
+        await sleep_forever()
+
+
+class TestEnginePool(TestCase):
+    def test_size(self) -> None:
+        self.assertEqual(1, EnginePool(0).size)
+        self.assertEqual(MAX_ENGINES, EnginePool(MAX_ENGINES + 1).size)
+
+    @trio_test
+    @timeout(5)
+    async def test_play(self) -> None:
+        go = Event()
+        engines: List[FakeEngine] = []
+
+        async def opener() -> FakeEngine:
+            engines.append(FakeEngine(go))
+            return engines[-1]
+
+        moves: List[Move] = []
+
+        async with EnginePool(1, opener) as pool:
+            async def play() -> None:
+                result = await pool.play(Board(), Limit(time=1))
+                assert result.move is not None
+                moves.append(result.move)
+
+            self.assertListEqual([], engines)  # opened on demand
+            async with open_nursery() as nursery:
+                nursery.start_soon(play)
+                nursery.start_soon(play)
+                await wait_all_tasks_blocked()
+
+                metrics = pool.metrics()
+                self.assertEqual(1, metrics['busy'])
+                self.assertEqual(1, metrics['waiting'])
+                go.set()
+
+            self.assertEqual(1, len(engines))
+            self.assertEqual(2, engines[0].searches)
+            metrics = pool.metrics()
+            self.assertEqual(2, metrics['searches']['count'])
+            self.assertEqual(2000, metrics['nodes'])
+            self.assertIsNotNone(metrics['nps'])
+        self.assertTrue(engines[0].quitted)
+        self.assertListEqual([Move.from_uci('g1h3')] * 2, moves)
+
+    @trio_test
+    @timeout(5)
+    async def test_restart(self) -> None:
+        # a dead engine, a wedged one, then a working one
+        engines: List[FakeEngine] = []
+        go = Event()
+        go.set()
+
+        async def opener() -> FakeEngine:
+            cls = [DeadEngine, WedgedEngine, FakeEngine][len(engines)]
+            engines.append(cls(go))
+            return engines[-1]
+
+        async with EnginePool(1, opener, grace=.1) as pool:
+            result = await pool.play(Board(), Limit(time=.1))
+            self.assertEqual(Move.from_uci('g1h3'), result.move)
+
+            metrics = pool.metrics()
+            self.assertEqual(1, metrics['failures'])
+            self.assertEqual(1, metrics['timeouts'])
+            self.assertEqual(2, metrics['restarts'])
+            self.assertEqual([True, True, False],
+                             [engine.killed for engine in engines])
+            self.assertListEqual([engines[2]], pool.engines)
+
+    @trio_test
+    @timeout(5)
+    async def test_give_up(self) -> None:
+        engines: List[FakeEngine] = []
+
+        async def opener() -> FakeEngine:
+            engines.append(DeadEngine(Event()))
+            return engines[-1]
+
+        async with EnginePool(1, opener) as pool:
+            with self.assertRaises(EngineError):
+                await pool.play(Board(), Limit(time=.1))
+        self.assertEqual(SEARCH_RETRIES + 1, len(engines))
+
+    @trio_test
+    @timeout(5)
+    async def test_ready(self) -> None:
+        # checked at every search
+        engines: List[FakeEngine] = []
+        go = Event()
+        go.set()
+
+        async def opener() -> FakeEngine:
+            engines.append(FakeEngine(go))
+            return engines[-1]
+
+        async with EnginePool(1, opener, check_interval=0) as pool:
+            await pool.play(Board(), Limit(time=.1))
+            await pool.play(Board(), Limit(time=.1))
+            self.assertEqual(1, engines[0].pings)
+
+            # it dies while idle: replaced before the search
+            engines[0].ping = DeadEngine(go).ping  # type: ignore
+            await pool.play(Board(), Limit(time=.1))
+            self.assertEqual(2, len(engines))
+            self.assertTrue(engines[0].killed)
+            self.assertEqual(1, pool.metrics()['restarts'])
+
+    @trio_test
+    @timeout(5)
+    async def test_open_failure(self) -> None:
+        async def opener() -> FakeEngine:
+            raise FileNotFoundError('stockfish')
+
+        async with EnginePool(1, opener) as pool:
+            with self.assertRaises(EngineError):
+                await pool.play(Board(), Limit(time=.1))
+            self.assertEqual(1, pool.metrics()['open_failures'])
+            self.assertListEqual([], pool.engines)
+
+    @trio_test
+    @timeout(5)
+    async def test_quit(self) -> None:
+        engines: List[FakeEngine] = []
+        go = Event()
+        go.set()
+
+        async def opener() -> FakeEngine:
+            engines.append(StuckEngine(go))
+            return engines[-1]
+
+        async with EnginePool(1, opener, quit_deadline=.1) as pool:
+            await pool.play(Board(), Limit(time=.1))
+        # killed after the deadline
+        self.assertTrue(engines[0].killed)
+        self.assertListEqual([], pool.engines)
@@ -0,0 +1,71 @@
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from chess import Board
+from chess.engine import Limit
+
+from moves.rest.movecache import MoveCache
+
+
+def fen(*moves: str) -> str:
+    board = Board()
+    for move in moves:
+        board.push_uci(move)
+    return board.fen()
+
+
+class TestMoveCache(TestCase):
+    def test_get_put(self) -> None:
+        cache = MoveCache(2)
+        self.assertIsNone(cache.get(fen(), Limit(time=5)))
+        cache.put(fen(), Limit(time=5), ('e2e4', 'e7e5'))
+        self.assertEqual(('e2e4', 'e7e5'), cache.get(fen(), Limit(time=5)))
+        # a shorter search is answered, a longer one or with another
+        # limit is not
+        self.assertEqual(('e2e4', 'e7e5'), cache.get(fen(), Limit(time=1)))
+        self.assertIsNone(cache.get(fen(), Limit(time=10)))
+        self.assertIsNone(cache.get(fen(), Limit(depth=5)))
+        # nor replaced by a shorter one
+        cache.put(fen(), Limit(time=1), ('d2d4', None))
+        self.assertEqual(('e2e4', 'e7e5'), cache.get(fen(), Limit(time=5)))
+
+        # the same position, after a knight went back and forth (the clocks
+        # differ)
+        self.assertEqual(('e2e4', 'e7e5'),
+                         cache.get(fen('g1f3', 'g8f6', 'f3g1', 'f6g8'),
+                                   Limit(time=5)))
+
+        self.assertDictEqual({'size': 1,
+                              'capacity': 2,
+                              'hits': 4,
+                              'misses': 3,
+                              'hit_rate': 4 / 7,
+                              'evicted': 0},
+                             cache.metrics())
+
+    def test_capacity(self) -> None:
+        cache = MoveCache(2)
+        cache.put(fen(), Limit(time=5), ('e2e4', None))
+        cache.put(fen('e2e4'), Limit(time=5), ('e7e5', None))
+        cache.get(fen(), Limit(time=5))  # e2e4 is now the least recently used
+        cache.put(fen('d2d4'), Limit(time=5), ('d7d5', None))
+
+        self.assertIsNone(cache.get(fen('e2e4'), Limit(time=5)))
+        self.assertIsNotNone(cache.get(fen(), Limit(time=5)))
+        self.assertEqual(1, cache.evicted)
+
+    def test_save(self) -> None:
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'moves.json')
+            cache = MoveCache(2, path)
+            self.assertEqual(0, len(cache.entries))
+            cache.put(fen(), Limit(time=5), ('e2e4', 'e7e5'))
+            cache.put(fen('e2e4'), Limit(time=5), ('e7e5', None))
+            cache.save()
+
+            # a smaller one keeps the most recently used
+            loaded = MoveCache(1, path)
+            self.assertEqual(('e7e5', None),
+                             loaded.get(fen('e2e4'), Limit(time=5)))
+            self.assertIsNone(loaded.get(fen(), Limit(time=5)))
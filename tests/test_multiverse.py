@@ -0,0 +1,97 @@
+from json import loads
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from chess import Board
+
+from moves.rest.multiverse import ARCHIVE_DIR
+from moves.rest.multiverse import IDLE_DIR
+from moves.rest.multiverse import Multiverse
+from moves.rest.types import GameUniverse
+from moves.rest.types import Player
+from moves.rest.types import PlayerType
+
+
+def game(game_id: str, *moves: str) -> GameUniverse:
+    board = Board()
+    for move in moves:
+        board.push_uci(move)
+    return GameUniverse(game_id, board,
+                        Player('pid1', PlayerType.HUMAN, 'name'),
+                        Player('pid2', PlayerType.CPU))
+
+
+class TestMultiverse(TestCase):
+    def test_capacity(self) -> None:
+        with TemporaryDirectory() as tmp:
+            games = Multiverse(tmp, capacity=2)
+            games['a'] = game('a', 'e2e4', 'e7e5')
+            games['b'] = game('b')
+            games['a']  # b is now the least recently used
+            games['c'] = game('c')
+
+            self.assertListEqual(['a', 'c'], list(games.resident))
+            self.assertListEqual(['b.json'], listdir(join(tmp, IDLE_DIR)))
+            self.assertSetEqual({'a', 'b', 'c'}, set(games))
+            self.assertEqual(3, len(games))
+
+            # rehydrated on demand (evicting a)
+            b = games['b']
+            self.assertEqual(game('b'), b)
+            self.assertListEqual(['c', 'b'], list(games.resident))
+
+            a = games['a']
+            self.assertEqual(game('a', 'e2e4', 'e7e5').board.fen(),
+                             a.board.fen())
+            self.assertListEqual(game('a', 'e2e4', 'e7e5').board.move_stack,
+                                 a.board.move_stack)
+            self.assertEqual(game('a').white, a.white)
+            self.assertEqual(2, games.rehydrated)
+
+            with self.assertRaises(KeyError):
+                games['nope']
+            self.assertIsNone(games.get('nope'))
+
+    def test_evict_idle(self) -> None:
+        with TemporaryDirectory() as tmp:
+            games = Multiverse(tmp, max_idle=0)
+            games['a'] = game('a')
+            self.assertEqual(1, games.evict_idle())
+            self.assertListEqual([], list(games.resident))
+            self.assertEqual(game('a'), games['a'])
+
+        # without a directory nothing is evicted
+        games = Multiverse(max_idle=0)
+        games['a'] = game('a')
+        self.assertEqual(0, games.evict_idle())
+        self.assertListEqual(['a'], list(games.resident))
+
+    def test_archive(self) -> None:
+        with TemporaryDirectory() as tmp:
+            games = Multiverse(tmp, capacity=0)
+            games['mate'] = game('mate', 'f2f3', 'e7e5', 'g2g4', 'd8h4')
+            games.archive('mate', '0-1')
+
+            self.assertEqual(0, len(games))
+            with open(join(tmp, ARCHIVE_DIR, 'mate.json')) as fp:
+                archived = loads(fp.read())
+            self.assertEqual('0-1', archived['result'])
+            self.assertEqual('f2f3 e7e5 g2g4 d8h4', archived['moves'])
+
+    def test_invalid(self) -> None:
+        with TemporaryDirectory() as tmp:
+            games = Multiverse(tmp)
+            games['a'] = game('a')
+            games.archive('a', '1-0')
+            with open(join(tmp, IDLE_DIR, 'broken.json'), 'w') as fp:
+                fp.write('{"not": "a game"')
+
+            for game_id in [f'../{ARCHIVE_DIR}/a', '..', '', 'broken']:
+                with self.assertRaises(KeyError):
+                    games[game_id]
+            for game_id in [f'../{ARCHIVE_DIR}/a', '..', '']:
+                with self.assertRaises(KeyError):
+                    del games[game_id]
+            self.assertListEqual(['a.json'], listdir(join(tmp, ARCHIVE_DIR)))
@@ -0,0 +1,138 @@
+from dataclasses import replace
+from typing import List
+from unittest import TestCase
+
+from chess import Board
+from chess.engine import Limit
+from trio import Event
+from trio import open_nursery
+from trio.testing import wait_all_tasks_blocked
+
+from moves.rest.engines import EnginePool
+from moves.rest.movecache import MoveCache
+from moves.rest.ponder import Ponderer
+from moves.rest.scheduler import Scheduler
+from moves.rest.types import GameUniverse
+from moves.rest.types import Player
+from moves.rest.types import PlayerType
+from moves.rest.types import Snapshot
+
+from ._support_for_tests import timeout
+from ._support_for_tests import trio_test
+from .test_engines import FakeEngine
+
+SNAPSHOT = GameUniverse(game_id='game_id',
+                        board=Board(),
+                        white=Player('pid1', PlayerType.CPU),
+                        black=Player('pid2', PlayerType.HUMAN)).snapshot()
+
+
+def after(*moves: str) -> Snapshot:
+    board = SNAPSHOT.board()
+    for move in moves:
+        board.push_uci(move)
+    return replace(SNAPSHOT, fen=board.fen(), ply=len(moves),
+                   last_move=moves[-1])
+
+
+class TestPonderer(TestCase):
+    @trio_test
+    @timeout(5)
+    async def test_ponder(self) -> None:
+        engines: List[FakeEngine] = []
+
+        async def opener() -> FakeEngine:
+            engines.append(FakeEngine(Event()))
+            return engines[-1]
+
+        cache = MoveCache(16)
+        scheduler = Scheduler(slo=1, min_time=.1)
+        async with EnginePool(1, opener) as pool:
+            async with open_nursery() as nursery:
+                ponderer = Ponderer(nursery, pool, cache, scheduler)
+
+                # the human plays the expected reply while the engine is
+                # still searching it
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                await wait_all_tasks_blocked()
+                async with open_nursery() as waiting:
+                    waiting.start_soon(ponderer.wait, after('g1h3', 'g8h6'),
+                                       Limit(time=.1))
+                    await wait_all_tasks_blocked()
+                    engines[0].go.set()
+                self.assertEqual(('h3g5', 'h8g8'),
+                                 cache.get(after('g1h3', 'g8h6').fen,
+                                           Limit(time=.1)))
+
+                # the human plays another move
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                await ponderer.wait(after('g1h3', 'g8f6'), Limit(time=.1))
+                await wait_all_tasks_blocked()
+
+                # the cpu move wants a longer search than the pondered one
+                engines[0].go = Event()
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                await wait_all_tasks_blocked()
+                await ponderer.wait(after('g1h3', 'g8h6'), Limit(time=60))
+                await wait_all_tasks_blocked()
+                self.assertEqual(0, pool.load())
+                engines[0].go.set()
+
+                # no idle engine
+                engines[0].go = Event()
+                nursery.start_soon(pool.play, Board(), Limit(time=1))
+                await wait_all_tasks_blocked()
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                engines[0].go.set()
+
+        metrics = ponderer.metrics()
+        self.assertEqual(3, metrics['ponders'])
+        self.assertEqual(1, metrics['skipped'])
+        self.assertEqual(1, metrics['hits'])
+        self.assertEqual(2, metrics['misses'])
+        self.assertEqual(1 / 3, metrics['hit_rate'])
+        self.assertEqual(1, metrics['saved']['count'])
+
+    @trio_test
+    @timeout(5)
+    async def test_cancel(self) -> None:
+        engines: List[FakeEngine] = []
+
+        async def opener() -> FakeEngine:
+            engines.append(FakeEngine(Event()))  # searches until cancelled
+            return engines[-1]
+
+        async with EnginePool(1, opener) as pool:
+            async with open_nursery() as nursery:
+                ponderer = Ponderer(nursery, pool, MoveCache(16),
+                                    Scheduler(slo=1, min_time=.1))
+
+                # the human plays another move
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                await wait_all_tasks_blocked()
+                await ponderer.wait(after('g1h3', 'g8f6'), Limit(time=.1))
+                await wait_all_tasks_blocked()
+                self.assertEqual(0, pool.load())
+
+                # the game ends
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                await wait_all_tasks_blocked()
+                ponderer.forget(SNAPSHOT.game_id)
+                await wait_all_tasks_blocked()
+                self.assertEqual(0, pool.load())
+
+                # a cpu move would wait for the engine
+                ponderer.ponder(SNAPSHOT, 'g1h3', 'g8h6')
+                await wait_all_tasks_blocked()
+                ponderer.make_room()
+                await wait_all_tasks_blocked()
+                self.assertEqual(0, pool.load())
+
+        # the searches are stopped, the engine reused (checked first)
+        self.assertEqual(1, len(engines))
+        self.assertFalse(engines[0].killed)
+        self.assertEqual(2, engines[0].pings)
+        self.assertEqual(1, ponderer.metrics()['cancelled'])
+        self.assertEqual(3, pool.metrics()['cancelled'])
+        self.assertEqual(0, pool.metrics()['restarts'])
+        self.assertEqual(0, engines[0].searches)
@@ -0,0 +1,62 @@
+from pickle import dumps
+from pickle import loads
+from random import Random
+from unittest import TestCase
+
+from chess import Board
+
+from moves.rest.position import Position
+from moves.rest.position import position
+
+
+class TestPosition(TestCase):
+    def test_outcome(self) -> None:
+        games = {
+            'checkmate': 'f2f3 e7e5 g2g4 d8h4',
+            'stalemate': ('e2e3 a7a5 d1h5 a8a6 h5a5 h7h5 h2h4 a6h6 a5c7 f7f6 '
+                          'c7d7 e8f7 d7b7 d8d3 b7b8 d3h7 b8c8 f7g6 c8e6'),
+            'fivefold': ' '.join(['g1f3 g8f6 f3g1 f6g8'] * 4),
+        }
+        for name, moves in games.items():
+            with self.subTest(name=name):
+                board = Board()
+                game_position = Position(board)
+                for uci in moves.split():
+                    self.assertIsNone(game_position.outcome)
+                    game_position.push(game_position.parse_uci(uci))
+                    self.assertEqual(board.outcome(), game_position.outcome)
+                self.assertIsNotNone(game_position.outcome)
+        self.assertIsNotNone(Position(Board('8/8/8/4k3/8/8/8/4K3 w - - 0 1')).outcome)
+
+    def test_random_games(self) -> None:
+        random = Random(42)
+        for _ in range(20):
+            board = Board()
+            game_position = Position(board)
+            while game_position.outcome is None and len(board.move_stack) < 200:
+                game_position.push(random.choice(list(board.legal_moves)))
+                self.assertEqual(board.outcome(), game_position.outcome)
+
+    def test_parse_uci(self) -> None:
+        board = Board('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1')
+        game_position = Position(board)
+        self.assertEqual('e1g1', game_position.parse_uci('e1g1').uci())
+        # castling as king takes rook
+        self.assertEqual('e1g1', game_position.parse_uci('e1h1').uci())
+        for uci in ['e1e3', 'nope', '']:
+            with self.subTest(uci=uci), self.assertRaises(ValueError):
+                game_position.parse_uci(uci)
+
+    def test_position(self) -> None:
+        board = Board()
+        board.push_uci('e2e4')
+        game_position = position(board, None)
+        self.assertIs(game_position, position(board, game_position))
+        # pushed behind its back: rebuilt, with the history
+        board.push_uci('e7e5')
+        rebuilt = position(board, game_position)
+        self.assertIsNot(game_position, rebuilt)
+        self.assertEqual(2, rebuilt.ply)
+        self.assertIsNone(position(Board(), rebuilt).outcome)
+        # not sent to other processes
+        self.assertIsNone(loads(dumps(rebuilt)))
@@ -1,37 +1,67 @@
 from __future__ import annotations
 
+from functools import partial
 from math import inf
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
 from typing import List
 from typing import Optional
 from unittest import TestCase
+from uuid import NAMESPACE_URL
+from uuid import uuid5
 
 from async_generator import aclosing
+from chess import BLACK
 from chess import Board
 from trio import BrokenResourceError
+from trio import Event
 from trio import open_memory_channel
 from trio import open_nursery
+from trio.testing import wait_all_tasks_blocked
 
+from moves.rest import mk_games
+from moves.rest.book import OpeningBook
+from moves.rest.codec import BINARY
+from moves.rest.constants import CPU_METRICS_TOPIC
 from moves.rest.constants import INPUT_TOPIC
-from moves.rest.constants import OUTPUT_TOPIC
+from moves.rest.constants import OUTPUT_TOPICS
+from moves.rest.constants import output_topic
+from moves.rest.cpu import Dispatcher
+from moves.rest.cpu import coalesce
 from moves.rest.cpu import cpu
+from moves.rest.game_engine import game_engine
+from moves.rest.game_engine import recover
+from moves.rest.game_engine import shard_of
+from moves.rest.game_engine import valid_game_id
+from moves.rest.multiverse import ARCHIVE_DIR
+from moves.rest.multiverse import IDLE_DIR
+from moves.rest.multiverse import Multiverse
+from moves.rest.rest import mk_app
+from moves.rest.storage import load_broker
+from moves.rest.types import Command
 from moves.rest.types import GameUniverse
 from moves.rest.types import InputQueueElement
+from moves.rest.types import Move
 from moves.rest.types import OutputQueueElement
 from moves.rest.types import Player
 from moves.rest.types import PlayerType
 from moves.rest.types import Result
 from moves.triopubsub import Broker
+from moves.triopubsub import Retention
 
 from ._support_for_tests import atake
 from ._support_for_tests import timeout
 from ._support_for_tests import trio_test
+from .test_book import write_book
+from .test_engines import FakeEngine
 
 
 async def run(n: int,
               outputs: List[Optional[OutputQueueElement]]) -> List[InputQueueElement]:
     b = Broker()
     b.add_topic(INPUT_TOPIC, InputQueueElement)
-    b.add_topic(OUTPUT_TOPIC, OutputQueueElement)
+    b.add_topic(output_topic('game_id'), OutputQueueElement)
 
     acc: List[InputQueueElement] = []
     async with open_nursery() as nursery:
@@ -39,7 +69,7 @@ async def run(n: int,
 
         async def producer() -> None:
             for output in outputs:
-                b.send(output, OUTPUT_TOPIC)
+                b.send(output, output_topic('game_id'))
         nursery.start_soon(producer)
 
         async def consumer() -> None:
@@ -49,10 +79,15 @@ async def run(n: int,
     return acc
 
 
-GAME_UNIVERSE = GameUniverse(game_id='game_id',
-                             board=Board(),
-                             white=Player('pid1', PlayerType.HUMAN, 'pname1'),
-                             black=Player('pid2', PlayerType.HUMAN, 'pname2'))
+def named_id(name: str) -> str:
+    'a valid game_id (see valid_game_id), the same for the same name'
+    return str(uuid5(NAMESPACE_URL, name))
+
+
+SNAPSHOT = GameUniverse(game_id='game_id',
+                        board=Board(),
+                        white=Player('pid1', PlayerType.HUMAN, 'pname1'),
+                        black=Player('pid2', PlayerType.HUMAN, 'pname2')).snapshot()
 
 
 class TestRest(TestCase):
@@ -60,12 +95,712 @@ class TestRest(TestCase):
     @timeout(5)
     async def test_cpu(self) -> None:
         outputs = [OutputQueueElement(result=Result.GAME_CREATED,
-                                      game_universe=GAME_UNIVERSE),
+                                      snapshot=SNAPSHOT),
                    None]
         expected: List[InputQueueElement] = []
         actual: List[InputQueueElement] = await run(0, outputs)
         self.assertListEqual(expected, actual)
 
+    def test_coalesce(self) -> None:
+        other = GameUniverse(game_id='other',
+                             board=Board(),
+                             white=Player('pid1', PlayerType.HUMAN, 'pname1'),
+                             black=Player('pid2', PlayerType.CPU, 'pname2')).snapshot()
+        created = OutputQueueElement(result=Result.GAME_CREATED,
+                                     snapshot=SNAPSHOT)
+        moved = OutputQueueElement(result=Result.MOVE,
+                                   snapshot=SNAPSHOT,
+                                   move='e2e4')
+        error = OutputQueueElement(result=Result.ERROR,
+                                   snapshot=SNAPSHOT,
+                                   error=Exception('wrong turn'))
+        other_created = OutputQueueElement(result=Result.GAME_CREATED,
+                                           snapshot=other)
+
+        self.assertEqual(([other_created, moved], False),
+                         coalesce([created, other_created, moved, error]))
+        self.assertEqual(([created], True),
+                         coalesce([created, None, other_created]))
+
+    @trio_test
+    @timeout(5)
+    async def test_dispatcher(self) -> None:
+        other = GameUniverse(game_id='other',
+                             board=Board(),
+                             white=Player('pid1', PlayerType.HUMAN, 'pname1'),
+                             black=Player('pid2', PlayerType.CPU, 'pname2')).snapshot()
+        created = OutputQueueElement(result=Result.GAME_CREATED,
+                                     snapshot=SNAPSHOT)
+        moved = OutputQueueElement(result=Result.MOVE,
+                                   snapshot=SNAPSHOT,
+                                   move='e2e4')
+        moved_again = OutputQueueElement(result=Result.MOVE,
+                                         snapshot=SNAPSHOT,
+                                         move='e7e5')
+        other_created = OutputQueueElement(result=Result.GAME_CREATED,
+                                           snapshot=other)
+
+        go = Event()
+        started: List[OutputQueueElement] = []
+
+        async def run(output_element: OutputQueueElement) -> None:
+            started.append(output_element)
+            await go.wait()
+
+        async with open_nursery() as nursery:
+            dispatcher = Dispatcher(nursery, run)
+            for output_element in [created, other_created, moved, moved_again]:
+                dispatcher.dispatch(output_element)
+            await wait_all_tasks_blocked()
+
+            # both games are running (in any order), the moves of game_id wait
+            self.assertCountEqual([created, other_created], started)
+            self.assertDictEqual({'running': 2, 'pending': 1},
+                                 dispatcher.metrics())
+            go.set()
+
+        # only the latest move waited
+        self.assertCountEqual([created, other_created], started[:2])
+        self.assertListEqual([moved_again], started[2:])
+        self.assertDictEqual({'running': 0, 'pending': 0},
+                             dispatcher.metrics())
+
+    @trio_test
+    @timeout(5)
+    async def test_cpu_engines(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        go = Event()
+        go.set()
+
+        async def opener() -> FakeEngine:
+            return FakeEngine(go)
+
+        games = [GameUniverse(game_id=game_id,
+                              board=Board(),
+                              white=Player('pid1', PlayerType.CPU, 'cpu'),
+                              black=Player('pid2', PlayerType.HUMAN, 'pname2')).snapshot()
+                 for game_id in ['a', 'b']]
+        for snapshot in games:
+            b.add_topic(output_topic(snapshot.game_id), OutputQueueElement)
+
+        async with open_nursery() as nursery:
+            nursery.start_soon(partial(cpu, engines=2, opener=opener), b)
+            await wait_all_tasks_blocked()
+
+            for snapshot in games:
+                b.send(OutputQueueElement(result=Result.GAME_CREATED,
+                                          snapshot=snapshot),
+                       output_topic(snapshot.game_id))
+            inputs = await atake(2, b.subscribe_topic(INPUT_TOPIC,
+                                                      InputQueueElement))
+            b.send(None, output_topic('a'))
+
+        self.assertSetEqual({('a', 'g1h3'), ('b', 'g1h3')},
+                            {(i.game_id, i.move.move) for i in inputs
+                             if i.move is not None})
+        metrics = (await b.fetch_records(CPU_METRICS_TOPIC, dict))[-1].message
+        self.assertEqual(2, metrics['engines']['searches']['count'])
+        self.assertEqual(0, metrics['games']['running'])
+
+    @trio_test
+    @timeout(5)
+    async def test_cpu_cache(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        go = Event()
+        go.set()
+
+        async def opener() -> FakeEngine:
+            return FakeEngine(go)
+
+        async with open_nursery() as nursery:
+            nursery.start_soon(partial(cpu, opener=opener), b)
+            await wait_all_tasks_blocked()
+
+            for n, game_id in enumerate(['a', 'b'], 1):
+                b.add_topic(output_topic(game_id), OutputQueueElement)
+                snapshot = GameUniverse(game_id=game_id,
+                                        board=Board(),
+                                        white=Player('pid1', PlayerType.CPU, 'cpu'),
+                                        black=Player('pid2', PlayerType.HUMAN)).snapshot()
+                b.send(OutputQueueElement(result=Result.GAME_CREATED,
+                                          snapshot=snapshot),
+                       output_topic(game_id))
+                inputs = await atake(n, b.subscribe_topic(INPUT_TOPIC,
+                                                          InputQueueElement))
+            b.send(None, output_topic('a'))
+
+        # b is in the same position of a: no search
+        self.assertListEqual([('a', 'g1h3'), ('b', 'g1h3')],
+                             [(i.game_id, i.move.move) for i in inputs
+                              if i.move is not None])
+        metrics = (await b.fetch_records(CPU_METRICS_TOPIC, dict))[-1].message
+        self.assertEqual(1, metrics['engines']['searches']['count'])
+        self.assertEqual(1, metrics['cache']['hits'])
+        self.assertEqual(1, metrics['cache']['misses'])
+
+    @trio_test
+    @timeout(5)
+    async def test_cpu_book(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        b.add_topic(output_topic('game_id'), OutputQueueElement)
+
+        async def opener() -> FakeEngine:
+            raise AssertionError('in book: no engine needed')
+
+        snapshot = GameUniverse(game_id='game_id',
+                                board=Board(),
+                                white=Player('pid1', PlayerType.CPU, 'cpu'),
+                                black=Player('pid2', PlayerType.HUMAN)).snapshot()
+        with TemporaryDirectory() as tmp:
+            write_book(join(tmp, 'book.bin'), [(Board(), 'e2e4', 1)])
+            async with open_nursery() as nursery:
+                nursery.start_soon(partial(cpu, opener=opener,
+                                           book=OpeningBook(join(tmp, 'book.bin'))),
+                                   b)
+                await wait_all_tasks_blocked()
+
+                b.send(OutputQueueElement(result=Result.GAME_CREATED,
+                                          snapshot=snapshot),
+                       output_topic('game_id'))
+                inputs = await atake(1, b.subscribe_topic(INPUT_TOPIC,
+                                                          InputQueueElement))
+                b.send(None, output_topic('game_id'))
+
+        move = inputs[0].move
+        assert move is not None
+        self.assertEqual('e2e4', move.move)
+        metrics = (await b.fetch_records(CPU_METRICS_TOPIC, dict))[-1].message
+        self.assertEqual(1, metrics['book']['hits'])
+
+    @trio_test
+    @timeout(5)
+    async def test_cpu_ponder(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        b.add_topic(output_topic('game_id'), OutputQueueElement)
+        go = Event()
+        go.set()
+
+        async def opener() -> FakeEngine:
+            return FakeEngine(go)
+
+        board = Board()
+        game = GameUniverse(game_id='game_id',
+                            board=board,
+                            white=Player('pid1', PlayerType.CPU, 'cpu'),
+                            black=Player('pid2', PlayerType.HUMAN))
+        async with open_nursery() as nursery:
+            nursery.start_soon(partial(cpu, opener=opener, ponder=True), b)
+            await wait_all_tasks_blocked()
+
+            b.send(OutputQueueElement(result=Result.GAME_CREATED,
+                                      snapshot=game.snapshot()),
+                   output_topic('game_id'))
+            await atake(1, b.subscribe_topic(INPUT_TOPIC, InputQueueElement))
+
+            # the expected reply
+            board.push_uci('g1h3')
+            board.push_uci('g8h6')
+            b.send(OutputQueueElement(result=Result.MOVE,
+                                      snapshot=game.snapshot(),
+                                      move='g8h6'),
+                   output_topic('game_id'))
+            inputs = await atake(2, b.subscribe_topic(INPUT_TOPIC,
+                                                      InputQueueElement))
+            b.send(None, output_topic('game_id'))
+
+        self.assertListEqual(['g1h3', 'h3g5'],
+                             [i.move.move for i in inputs if i.move is not None])
+        metrics = (await b.fetch_records(CPU_METRICS_TOPIC, dict))[-1].message
+        self.assertEqual(1, metrics['ponder']['hits'])
+        self.assertEqual(1, metrics['cache']['hits'])
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_topics(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        white = Player('pid1', PlayerType.HUMAN)
+        black = Player('pid2', PlayerType.HUMAN)
+        try:
+            async with open_nursery() as nursery:
+                nursery.start_soon(game_engine, b)
+
+                async with b.tmp_subscription(OUTPUT_TOPICS,
+                                              OutputQueueElement) as s:
+                    b.send(InputQueueElement(command=Command.NEW_GAME,
+                                             white=white, black=black),
+                           INPUT_TOPIC)
+                    [created] = await atake(1, b.subscribe(OUTPUT_TOPICS, s,
+                                                           OutputQueueElement))
+                    self.assertEqual(Result.GAME_CREATED, created.result)
+                    game_id = created.snapshot.game_id
+                    self.assertIn(output_topic(game_id), b.topics)
+
+                    # fool's mate
+                    b.send_many([InputQueueElement(command=Command.MOVE,
+                                                   game_id=game_id,
+                                                   move=Move(move, player.player_id))
+                                 for move, player in [('f2f3', white),
+                                                      ('e7e5', black),
+                                                      ('g2g4', white),
+                                                      ('d8h4', black)]],
+                                INPUT_TOPIC)
+                    outputs = await atake(4, b.subscribe(OUTPUT_TOPICS, s,
+                                                         OutputQueueElement))
+                    self.assertListEqual([Result.MOVE] * 3 + [Result.END_GAME],
+                                         [o.result for o in outputs])
+                    # each output keeps the position after its move
+                    self.assertListEqual([(1, 'f2f3'), (2, 'e7e5'),
+                                          (3, 'g2g4'), (4, 'd8h4')],
+                                         [(o.snapshot.ply, o.snapshot.last_move)
+                                          for o in outputs])
+                    self.assertEqual(Board('rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/'
+                                           'PPPPP2P/RNBQKBNR w KQkq - 1 3'),
+                                     outputs[-1].snapshot.board())
+                    self.assertEqual(BLACK, outputs[-1].snapshot.outcome.winner)
+
+                # nobody is following the ended game: its topic is gone
+                self.assertNotIn(output_topic(game_id), b.topics)
+
+                b.send(None, INPUT_TOPIC)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_recovery(self) -> None:
+        white = Player('pid1', PlayerType.HUMAN)
+        black = Player('pid2', PlayerType.HUMAN)
+
+        def moves(game_id: str, *moves: str) -> List[InputQueueElement]:
+            return [InputQueueElement(command=Command.MOVE,
+                                      game_id=game_id,
+                                      move=Move(move, player.player_id))
+                    for move, player in zip(moves, [white, black] * 4)]
+
+        # the inputs of a previous run: a game in progress (with a rejected
+        # move), an ended one, an abandoned one, the moves of an unknown game
+        live, mate, abandoned, unknown = map(named_id, ['live', 'mate',
+                                                        'abandoned', 'unknown'])
+        inputs = [
+            InputQueueElement(command=Command.NEW_GAME, white=white,
+                              black=black, game_id=live),
+            InputQueueElement(command=Command.NEW_GAME, white=white,
+                              black=black, game_id=mate),
+            InputQueueElement(command=Command.NEW_GAME, white=white,
+                              black=black, game_id=abandoned),
+            *moves(live, 'e2e4', 'e7e5'),
+            *moves(mate, 'f2f3', 'e7e5', 'g2g4', 'd8h4'),
+            *moves(abandoned, 'e2e4'),
+            InputQueueElement(command=Command.END_GAME, game_id=abandoned),
+            *moves(live, 'g1f3', 'g1f3'),  # wrong turn
+            *moves(live, 'g1f3', 'a7a1'),  # illegal
+            *moves(unknown, 'e2e4'),
+            None]
+
+        games, ended = recover(inputs)
+        self.assertSetEqual({live, mate, abandoned}, set(games))
+        self.assertSetEqual({mate, abandoned}, ended)
+        self.assertListEqual(['e2e4', 'e7e5', 'g1f3'],
+                             [move.uci() for move in games[live].board.move_stack])
+
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        b.send_many(inputs, INPUT_TOPIC)
+        try:
+            async with open_nursery() as nursery:
+                async with b.tmp_subscription(OUTPUT_TOPICS,
+                                              OutputQueueElement) as s:
+                    nursery.start_soon(partial(game_engine, recover_games=True),
+                                       b)
+                    await wait_all_tasks_blocked()
+
+                    b.send_many(moves(live, 'h7h6', 'b8c6'), INPUT_TOPIC)
+                    [error, output] = await atake(2, b.subscribe(OUTPUT_TOPICS, s,
+                                                                 OutputQueueElement))
+                    # no outputs for the recovered inputs, only for the new
+                    self.assertEqual(Result.ERROR, error.result)
+                    self.assertEqual(Result.MOVE, output.result)
+                    self.assertEqual('b8c6', output.move)
+                    self.assertEqual(4, output.snapshot.ply)
+
+                    self.assertIn(output_topic(live), b.topics)
+                    self.assertNotIn(output_topic(mate), b.topics)
+                    self.assertNotIn(output_topic(abandoned), b.topics)
+
+                b.send(None, INPUT_TOPIC)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_restore(self) -> None:
+        white = Player('pid1', PlayerType.HUMAN)
+        black = Player('pid2', PlayerType.HUMAN)
+
+        def move(game_id: str, move: str, player: Player) -> InputQueueElement:
+            return InputQueueElement(command=Command.MOVE, game_id=game_id,
+                                     move=Move(move, player.player_id))
+
+        idle, old = named_id('idle'), named_id('old')
+
+        # the input topic retains only the last inputs of the previous run
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement,
+                    retention=Retention(max_count=3))
+        try:
+            async with open_nursery() as nursery:
+                async with b.tmp_subscription(OUTPUT_TOPICS,
+                                              OutputQueueElement) as s:
+                    nursery.start_soon(game_engine, b)
+                    await wait_all_tasks_blocked()
+                    b.send_many([
+                        InputQueueElement(command=Command.NEW_GAME, white=white,
+                                          black=black, game_id=idle),
+                        move(idle, 'e2e4', white),
+                        InputQueueElement(command=Command.NEW_GAME, white=white,
+                                          black=black, game_id=old),
+                        move(old, 'e2e4', white),
+                        move(old, 'e7e5', black),
+                        None],
+                        INPUT_TOPIC)
+                    await atake(5, b.subscribe(OUTPUT_TOPICS, s,
+                                               OutputQueueElement))
+
+            # old is rebuilt at once from its outputs, idle at its next input
+            async with open_nursery() as nursery:
+                async with b.tmp_subscription(OUTPUT_TOPICS,
+                                              OutputQueueElement,
+                                              send_old_messages=False) as s:
+                    nursery.start_soon(partial(game_engine, recover_games=True),
+                                       b)
+                    await wait_all_tasks_blocked()
+
+                    b.send_many([move(idle, 'e7e5', black),
+                                 move(old, 'g1f3', white)],
+                                INPUT_TOPIC)
+                    outputs = await atake(2, b.subscribe(OUTPUT_TOPICS, s,
+                                                         OutputQueueElement))
+                    self.assertCountEqual(
+                        [(idle, Result.MOVE, 2), (old, Result.MOVE, 3)],
+                        [(o.snapshot.game_id, o.result, o.snapshot.ply)
+                         for o in outputs])
+
+                b.send(None, INPUT_TOPIC)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_rehydrate(self) -> None:
+        white = Player('pid1', PlayerType.HUMAN)
+        black = Player('pid2', PlayerType.HUMAN)
+
+        game = named_id('game')
+
+        def move(move: str, player: Player) -> InputQueueElement:
+            return InputQueueElement(command=Command.MOVE, game_id=game,
+                                     move=Move(move, player.player_id))
+
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'storage.jsonl')
+
+            def mk_broker() -> Broker:
+                b = load_broker(fn, codec=BINARY)
+                # only the last input is retained: the game is not recovered
+                # from the inputs, but read back from the disk
+                b.add_topic(INPUT_TOPIC, InputQueueElement,
+                            retention=Retention(max_count=1))
+                return b
+
+            # the game is evicted to disk as soon as it is idle
+            b = mk_broker()
+            try:
+                async with open_nursery() as nursery:
+                    async with b.tmp_subscription(OUTPUT_TOPICS,
+                                                  OutputQueueElement) as s:
+                        nursery.start_soon(partial(
+                            game_engine, games=Multiverse(tmp, max_idle=0)), b)
+                        await wait_all_tasks_blocked()
+                        b.send_many([InputQueueElement(command=Command.NEW_GAME,
+                                                       white=white, black=black,
+                                                       game_id=game),
+                                     move('e2e4', white)],
+                                    INPUT_TOPIC)
+                        await atake(2, b.subscribe(OUTPUT_TOPICS, s,
+                                                   OutputQueueElement))
+                    b.send(None, INPUT_TOPIC)
+            finally:
+                await b.aclose()
+            self.assertListEqual([f'{game}.json'], listdir(join(tmp, IDLE_DIR)))
+
+            # after a restart the output topic of the game is added again
+            # when the game is read back
+            b = mk_broker()
+            try:
+                async with open_nursery() as nursery:
+                    async with b.tmp_subscription(OUTPUT_TOPICS,
+                                                  OutputQueueElement,
+                                                  send_old_messages=False) as s:
+                        nursery.start_soon(partial(
+                            game_engine, recover_games=True,
+                            games=Multiverse(tmp, max_idle=0)), b)
+                        await wait_all_tasks_blocked()
+                        b.send(move('e7e5', black), INPUT_TOPIC)
+                        [output] = await atake(1, b.subscribe(OUTPUT_TOPICS, s,
+                                                              OutputQueueElement))
+                        self.assertEqual(Result.MOVE, output.result)
+                        self.assertEqual(2, output.snapshot.ply)
+                        # with the outputs of the previous run
+                        self.assertListEqual(
+                            [Result.GAME_CREATED, Result.MOVE, Result.MOVE],
+                            [record.message.result
+                             for record in await b.fetch_records(
+                                 output_topic(game), OutputQueueElement)])
+                    b.send(None, INPUT_TOPIC)
+            finally:
+                await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_shards(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement,
+                    key=partial(shard_of, shards=2))
+        white = Player('pid1', PlayerType.HUMAN)
+        black = Player('pid2', PlayerType.HUMAN)
+        game_ids = [named_id(name) for name in ['alpha', 'beta', 'gamma', 'delta']]
+        self.assertSetEqual({0, 1}, {shard_of(InputQueueElement(Command.MOVE,
+                                                                game_id=game_id), 2)
+                                     for game_id in game_ids})
+        try:
+            async with open_nursery() as nursery:
+                async with b.tmp_subscription(OUTPUT_TOPICS,
+                                              OutputQueueElement) as s:
+                    for shard in range(2):
+                        nursery.start_soon(partial(game_engine,
+                                                   shard=shard, shards=2),
+                                           b)
+                    await wait_all_tasks_blocked()
+
+                    for game_id in game_ids:
+                        b.send(InputQueueElement(command=Command.NEW_GAME,
+                                                 white=white, black=black,
+                                                 game_id=game_id),
+                               INPUT_TOPIC)
+                        b.send_many([InputQueueElement(command=Command.MOVE,
+                                                       game_id=game_id,
+                                                       move=Move(move, player.player_id))
+                                     for move, player in [('e2e4', white),
+                                                          ('e7e5', black)]],
+                                    INPUT_TOPIC)
+                    # without a game_id: the engine of the shard 0 picks one
+                    # of its own
+                    b.send(InputQueueElement(command=Command.NEW_GAME,
+                                             white=white, black=black),
+                           INPUT_TOPIC)
+
+                    outputs = await atake(13, b.subscribe(OUTPUT_TOPICS, s,
+                                                          OutputQueueElement))
+
+                # each game is handled once, in order
+                for game_id in game_ids:
+                    self.assertListEqual(
+                        [(Result.GAME_CREATED, None),
+                         (Result.MOVE, 'e2e4'),
+                         (Result.MOVE, 'e7e5')],
+                        [(o.result, o.move) for o in outputs
+                         if o.snapshot.game_id == game_id])
+                [created] = [o for o in outputs
+                             if o.snapshot.game_id not in game_ids]
+                self.assertEqual(0, shard_of(InputQueueElement(
+                    Command.MOVE, game_id=created.snapshot.game_id), 2))
+
+                nursery.cancel_scope.cancel()
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_end_game(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        white = Player('pid1', PlayerType.HUMAN)
+        black = Player('pid2', PlayerType.HUMAN)
+        abandoned, next_ = named_id('abandoned'), named_id('next')
+        with TemporaryDirectory() as tmp:
+            try:
+                async with open_nursery() as nursery:
+                    async with b.tmp_subscription(OUTPUT_TOPICS,
+                                                  OutputQueueElement) as s:
+                        nursery.start_soon(partial(game_engine,
+                                                   games=Multiverse(tmp)),
+                                           b)
+                        await wait_all_tasks_blocked()
+
+                        b.send_many([
+                            InputQueueElement(command=Command.NEW_GAME,
+                                              white=white, black=black,
+                                              game_id=abandoned),
+                            InputQueueElement(command=Command.END_GAME,
+                                              game_id=abandoned),
+                            # ignored: the game is over
+                            InputQueueElement(command=Command.MOVE,
+                                              game_id=abandoned,
+                                              move=Move('e2e4', white.player_id)),
+                            InputQueueElement(command=Command.NEW_GAME,
+                                              white=white, black=black,
+                                              game_id=next_)],
+                            INPUT_TOPIC)
+                        outputs = await atake(3, b.subscribe(OUTPUT_TOPICS, s,
+                                                             OutputQueueElement))
+                        self.assertListEqual(
+                            [(abandoned, Result.GAME_CREATED),
+                             (abandoned, Result.END_GAME),
+                             (next_, Result.GAME_CREATED)],
+                            [(o.snapshot.game_id, o.result)
+                             for o in outputs])
+
+                    self.assertListEqual([f'{abandoned}.json'],
+                                         listdir(join(tmp, ARCHIVE_DIR)))
+                    b.send(None, INPUT_TOPIC)
+            finally:
+                await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_invalid_ids(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        white = Player('pid1', PlayerType.HUMAN)
+        game = named_id('game')
+        with TemporaryDirectory() as tmp:
+            games = Multiverse(tmp)
+            with open(join(tmp, ARCHIVE_DIR, f'{game}.json'), 'w') as fp:
+                fp.write('{}')
+            with open(join(tmp, 'x.json'), 'w') as fp:
+                fp.write('not a game')
+            try:
+                async with open_nursery() as nursery:
+                    async with b.tmp_subscription(OUTPUT_TOPICS,
+                                                  OutputQueueElement) as s:
+                        nursery.start_soon(partial(game_engine, games=games), b)
+                        await wait_all_tasks_blocked()
+
+                        b.send_many([
+                            InputQueueElement(command=Command.MOVE,
+                                              game_id=game_id,
+                                              move=Move('e2e4', white.player_id))
+                            for game_id in [f'../{ARCHIVE_DIR}/{game}', '../x',
+                                            'a\x00b', 'unknown']] + [
+                            InputQueueElement(command=Command.NEW_GAME,
+                                              white=white, game_id='../next'),
+                            InputQueueElement(command=Command.NEW_GAME,
+                                              white=white)],
+                            INPUT_TOPIC)
+                        [created] = await atake(1, b.subscribe(OUTPUT_TOPICS, s,
+                                                               OutputQueueElement))
+                        self.assertEqual(Result.GAME_CREATED, created.result)
+
+                    # the archive is untouched
+                    self.assertListEqual([f'{game}.json'],
+                                         listdir(join(tmp, ARCHIVE_DIR)))
+                    b.send(None, INPUT_TOPIC)
+            finally:
+                await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_game_engine_missing(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        finished: List[str] = []
+        b.register_on_finish_topic(finished.append)
+        white = Player('pid1', PlayerType.HUMAN)
+        game = named_id('game')
+        try:
+            async with open_nursery() as nursery:
+                async with b.tmp_subscription(OUTPUT_TOPICS,
+                                              OutputQueueElement) as s:
+                    nursery.start_soon(game_engine, b)
+                    await wait_all_tasks_blocked()
+
+                    # looked up once, then dropped
+                    for _ in range(3):
+                        b.send(InputQueueElement(command=Command.MOVE,
+                                                 game_id=game,
+                                                 move=Move('e2e4',
+                                                           white.player_id)),
+                               INPUT_TOPIC)
+                        await wait_all_tasks_blocked()
+                    self.assertListEqual([output_topic(game)], finished)
+
+                    # until it is created
+                    b.send(InputQueueElement(command=Command.NEW_GAME,
+                                             white=white, game_id=game),
+                           INPUT_TOPIC)
+                    b.send(InputQueueElement(command=Command.MOVE,
+                                             game_id=game,
+                                             move=Move('e2e4',
+                                                       white.player_id)),
+                           INPUT_TOPIC)
+                    outputs = await atake(2, b.subscribe(OUTPUT_TOPICS, s,
+                                                         OutputQueueElement))
+                    self.assertListEqual([Result.GAME_CREATED, Result.MOVE],
+                                         [o.result for o in outputs])
+                b.send(None, INPUT_TOPIC)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_start_new_game(self) -> None:
+        b = Broker()
+        b.add_topic(INPUT_TOPIC, InputQueueElement)
+        # the patterns subscribed while the game is being created
+        patterns: List[str] = []
+        b.register_on_send(lambda message, topic_id:
+                           patterns.extend(b.pattern_subscriptions))
+        try:
+            async with open_nursery() as nursery:
+                nursery.start_soon(game_engine, b)
+                client = (await mk_app(b)).test_client()
+
+                response = await client.post('/start_new_game',
+                                             json={'user_id': 'pid1',
+                                                   'white': 'human',
+                                                   'black': 'human',
+                                                   'invited_user_id': None})
+                game_id = await response.get_data(as_text=True)
+                self.assertTrue(valid_game_id(game_id))
+                # waited on the topic of the game, not on all the games
+                self.assertListEqual([], patterns)
+                records = await b.fetch_records(output_topic(game_id),
+                                                OutputQueueElement)
+                self.assertListEqual([Result.GAME_CREATED],
+                                     [record.message.result
+                                      for record in records])
+                b.send(None, INPUT_TOPIC)
+        finally:
+            await b.aclose()
+
+    def test_mk_games(self) -> None:
+        with TemporaryDirectory() as tmp:
+            self.assertIsNone(mk_games(None))
+            games = mk_games(tmp)
+            assert games is not None
+            self.assertEqual(tmp, games.directory)
+
+            # a directory per shard: the engines never share a file
+            shards = [mk_games(tmp, shard, 2) for shard in range(2)]
+            self.assertListEqual([join(tmp, '0'), join(tmp, '1')],
+                                 [games.directory for games in shards
+                                  if games is not None])
+
     @trio_test
     @timeout(5)
     async def test_take_from_infinite_loop(self) -> None:
@@ -0,0 +1,70 @@
+from typing import List
+from unittest import TestCase
+
+from chess import Board
+from chess.engine import Limit
+from trio import Event
+from trio import open_nursery
+from trio.testing import wait_all_tasks_blocked
+
+from moves.rest.engines import EnginePool
+from moves.rest.scheduler import Scheduler
+from moves.rest.scheduler import phase
+from moves.rest.types import GameUniverse
+from moves.rest.types import Player
+from moves.rest.types import PlayerType
+from moves.rest.types import Snapshot
+
+from ._support_for_tests import timeout
+from ._support_for_tests import trio_test
+from .test_engines import FakeEngine
+
+
+def snapshot(board: Board) -> Snapshot:
+    return GameUniverse(game_id='game_id',
+                        board=board,
+                        white=Player('pid1', PlayerType.CPU),
+                        black=Player('pid2', PlayerType.HUMAN)).snapshot()
+
+
+OPENING = snapshot(Board())
+MIDDLEGAME = snapshot(Board(
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 9'))
+ENDGAME = snapshot(Board('8/5k2/3r4/8/8/4K3/4R3/8 w - - 0 60'))
+
+
+class TestScheduler(TestCase):
+    def test_phase(self) -> None:
+        self.assertEqual('opening', phase(OPENING))
+        self.assertEqual('middlegame', phase(MIDDLEGAME))
+        self.assertEqual('endgame', phase(ENDGAME))
+
+    @trio_test
+    @timeout(5)
+    async def test_limit(self) -> None:
+        go = Event()
+
+        async def opener() -> FakeEngine:
+            return FakeEngine(go)
+
+        scheduler = Scheduler(slo=4, min_time=.5)
+        async with EnginePool(1, opener) as pool:
+            self.assertEqual(Limit(time=2), scheduler.limit(pool, OPENING))
+            self.assertEqual(Limit(time=4), scheduler.limit(pool, MIDDLEGAME))
+            self.assertEqual(Limit(time=3), scheduler.limit(pool, ENDGAME))
+
+            limits: List[Limit] = []
+            async with open_nursery() as nursery:
+                for _ in range(9):
+                    nursery.start_soon(pool.play, Board(), Limit(time=1))
+                await wait_all_tasks_blocked()
+
+                # 1 search running, 8 waiting
+                limits.append(scheduler.limit(pool, MIDDLEGAME))
+                go.set()
+
+            # in 10 rounds the slo allows .4s: but at least .5s
+            self.assertListEqual([Limit(time=.5)], limits)
+            metrics = scheduler.metrics()
+            self.assertEqual(1, metrics['degraded'])
+            self.assertEqual(4, metrics['budgets']['count'])
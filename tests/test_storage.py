@@ -1,10 +1,20 @@
 from io import SEEK_END
 from io import StringIO
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
 from textwrap import dedent
+from time import sleep
 from unittest import TestCase
 
+from moves.rest.storage import Durability
+from moves.rest.storage import Journal
 from moves.rest.storage import load_broker
 from moves.triopubsub import Broker
+from moves.triopubsub import Retention
+
+from ._support_for_tests import timeout
+from ._support_for_tests import trio_test
 
 
 def dump(io: StringIO) -> str:
@@ -23,7 +33,8 @@ class TestRest(TestCase):
                                 ["bar", "topic_one"]
                                 [123, "topic_two"]
                                 '''))
-        broker = load_broker(io, Broker())
+        # commit every message, without a background thread
+        broker = load_broker(io, Broker(), commit_count=1, commit_interval=None)
 
         topic_one = broker.add_topic('topic_one', str)
         self.assertListEqual(['foo', 'bar'], topic_one.messages)
@@ -50,3 +61,242 @@ class TestRest(TestCase):
                                    [456, "topic_two"]
                                    ["baz", "topic_three"]
                                    '''), dump(io))
+
+    def test_journal_group_commit(self) -> None:
+        io = StringIO()
+        journal = Journal(io, Durability.NONE, commit_count=3,
+                          commit_interval=None)
+        journal.write([(1, 't'), (2, 't')])
+        self.assertEqual('', dump(io))
+        journal.write([(3, 't')])
+        self.assertEqual('[1, "t"]\n[2, "t"]\n[3, "t"]\n', dump(io))
+        journal.write([(4, 't')])
+        journal.close()
+        self.assertEqual('[1, "t"]\n[2, "t"]\n[3, "t"]\n[4, "t"]\n', dump(io))
+        self.assertEqual(2, journal.metrics()['commits'])
+
+    def test_journal_background_commit(self) -> None:
+        with TemporaryDirectory() as tmp:
+            journal = Journal(join(tmp, 'journal.jsonl'), Durability.FSYNC,
+                              commit_count=1000, commit_interval=.01)
+            try:
+                journal.write([('foo', 't'), ('bar', 't')])
+                # committed after commit_interval, even if not full
+                for _ in range(100):
+                    if journal.metrics()['lines'] == 2:
+                        break
+                    sleep(.01)
+                with open(join(tmp, 'journal.000001.jsonl')) as fp:
+                    self.assertEqual('["foo", "t"]\n["bar", "t"]\n', fp.read())
+            finally:
+                journal.close()
+            with self.assertRaises(ValueError):
+                journal.write([('baz', 't')])
+
+    def test_journal_segments(self) -> None:
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'journal.jsonl')
+            # a segment per commit
+            journal = Journal(fn, commit_count=2, commit_interval=None,
+                              segment_size=1)
+            journal.write([('foo', 'a'), (1, 'b')])
+            journal.write([('bar', 'a'), (2, 'b')])
+            journal.close()
+            self.assertListEqual(['journal.000001.idx', 'journal.000001.jsonl',
+                                  'journal.000002.idx', 'journal.000002.jsonl'],
+                                 sorted(listdir(tmp)))
+
+            journal = Journal(fn, commit_interval=None)
+            try:
+                self.assertListEqual(['foo', 'bar'], journal.read('a'))
+                # a topic is read once
+                self.assertListEqual([], journal.read('a'))
+                self.assertEqual(1, journal.metrics()['unread_topics'])
+            finally:
+                journal.close()
+
+    def test_journal_unsealed_segment(self) -> None:
+        with TemporaryDirectory() as tmp:
+            # the process died while writing the second line
+            with open(join(tmp, 'journal.000001.jsonl'), 'w') as fp:
+                fp.write('["foo", "a"]\n["ba')
+
+            journal = Journal(join(tmp, 'journal.jsonl'), commit_interval=None)
+            try:
+                self.assertListEqual(['foo'], journal.read('a'))
+            finally:
+                journal.close()
+            with open(join(tmp, 'journal.000001.jsonl')) as fp:
+                self.assertEqual('["foo", "a"]\n', fp.read())
+
+    @trio_test
+    @timeout(5)
+    async def test_load_broker_file(self) -> None:
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'storage.jsonl')
+            broker = load_broker(fn)
+            broker.add_topic('topic', str)
+            broker.send_many(['foo', 'bar'], 'topic')
+            # the pending messages are committed on close
+            await broker.aclose()
+
+            broker = load_broker(fn)
+            try:
+                topic = broker.add_topic('topic', str)
+                self.assertListEqual(['foo', 'bar'], topic.messages)
+            finally:
+                await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_load_broker_compaction(self) -> None:
+        io = StringIO(dedent('''\
+                                ["foo", "topic_one"]
+                                [123, "topic_two"]
+                                '''))
+        broker = load_broker(io, Broker(), commit_count=1,
+                             commit_interval=None, compact_every=3)
+        try:
+            broker.add_topic('topic_one', str, retention=Retention(max_count=2))
+            broker.send_many(['bar', 'baz'], 'topic_one')
+            self.assertEqual(dedent('''\
+                                       ["foo", "topic_one"]
+                                       [123, "topic_two"]
+                                       ["bar", "topic_one"]
+                                       ["baz", "topic_one"]
+                                       '''), dump(io))
+
+            # the third line triggers the compaction: the journal keeps the
+            # messages of topic_two (not added yet) and the ones topic_one
+            # retains, with the offset of the first one
+            broker.send('qux', 'topic_one')
+            self.assertEqual(dedent('''\
+                                       [123, "topic_two"]
+                                       [2, "topic_one", "#offset"]
+                                       ["baz", "topic_one"]
+                                       ["qux", "topic_one"]
+                                       '''), dump(io))
+
+            broker.send('quux', 'topic_one')
+            self.assertEqual(dedent('''\
+                                       [123, "topic_two"]
+                                       [2, "topic_one", "#offset"]
+                                       ["baz", "topic_one"]
+                                       ["qux", "topic_one"]
+                                       ["quux", "topic_one"]
+                                       '''), dump(io))
+        finally:
+            await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_load_broker_offsets(self) -> None:
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'storage.jsonl')
+            broker = load_broker(fn, commit_interval=None, compact_every=4)
+            broker.add_topic('topic', str, retention=Retention(max_count=2))
+            broker.send_many(['a', 'b', 'c', 'd', 'e'], 'topic')
+            await broker.aclose()
+
+            # the refilled topic goes on from its last offset, after a
+            # restart without compactions too
+            for expected, message in [(5, 'f'), (6, 'g')]:
+                broker = load_broker(fn, commit_interval=None, compact_every=4)
+                try:
+                    broker.add_topic('topic', str,
+                                     retention=Retention(max_count=2))
+                    records = await broker.fetch_records('topic', str)
+                    self.assertListEqual([expected - 2, expected - 1],
+                                         [record.offset for record in records])
+                    self.assertEqual(expected, broker.send(message, 'topic'))
+                finally:
+                    await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_load_broker_finish_topic(self) -> None:
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'storage.jsonl')
+            broker = load_broker(fn)
+            broker.add_topic('game', str)
+            broker.add_topic('other', str)
+            broker.send_many(['foo', 'bar'], 'game')
+            broker.send('baz', 'other')
+            await broker.finish_topic('game')
+            await broker.aclose()
+
+            broker = load_broker(fn)
+            try:
+                self.assertListEqual([], broker.add_topic('game', str).messages)
+                self.assertListEqual(['baz'],
+                                     broker.add_topic('other', str).messages)
+            finally:
+                await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_load_broker_exclude(self) -> None:
+        io = StringIO()
+        broker = load_broker(io, Broker(), commit_count=1,
+                             commit_interval=None, exclude=['metrics/*'])
+        try:
+            broker.add_topic('metrics/cpu', dict)
+            broker.add_topic('topic', str)
+            broker.send({'busy': 1}, 'metrics/cpu')
+            broker.send('foo', 'topic')
+            await broker.finish_topic('metrics/cpu')
+            self.assertEqual('["foo", "topic"]\n', dump(io))
+        finally:
+            await broker.aclose()
+
+    def test_journal_finish(self) -> None:
+        with TemporaryDirectory() as tmp:
+            fn = join(tmp, 'journal.jsonl')
+            journal = Journal(fn, commit_interval=None)
+            journal.write([('foo', 'a'), ('bar', 'b')])
+            journal.finish('a')
+            journal.write([('baz', 'a')])
+            journal.close()
+
+            # a is never read again: only the lines after the tombstone are
+            # left, and b is copied by the compaction
+            journal = Journal(fn, commit_interval=None)
+            self.assertEqual(2, journal.metrics()['unread_topics'])
+            journal.compact([])
+            journal.close()
+
+            journal = Journal(fn, commit_interval=None)
+            try:
+                self.assertListEqual(['baz'], journal.read('a'))
+                self.assertListEqual(['bar'], journal.read('b'))
+                self.assertEqual(0, journal.metrics()['unread_topics'])
+            finally:
+                journal.close()
+
+    def test_journal_compaction(self) -> None:
+        with TemporaryDirectory() as tmp, TemporaryDirectory() as archive:
+            fn = join(tmp, 'journal.jsonl')
+            journal = Journal(fn, commit_interval=None)
+            journal.write([('foo', 'a'), ('bar', 'b')])
+            journal.close()
+
+            journal = Journal(fn, commit_interval=.01, archive_dir=archive)
+            self.assertListEqual(['foo'], journal.read('a'))
+            journal.write([('baz', 'a')])
+            # b is still unread: it is copied in the snapshot
+            journal.compact([('baz', 'a')])
+            journal.write([('qux', 'a')])
+            journal.close()
+            self.assertEqual(1, journal.metrics()['compactions'])
+            self.assertListEqual(['journal.000001.idx', 'journal.000001.jsonl',
+                                  'journal.000002.idx', 'journal.000002.jsonl'],
+                                 sorted(listdir(archive)))
+            with open(join(tmp, 'journal.000003.snapshot.jsonl')) as fp:
+                self.assertEqual('["bar", "b"]\n["baz", "a"]\n', fp.read())
+
+            journal = Journal(fn, commit_interval=None)
+            try:
+                self.assertListEqual(['baz', 'qux'], journal.read('a'))
+                self.assertListEqual(['bar'], journal.read('b'))
+            finally:
+                journal.close()
@@ -1,10 +1,18 @@
+from dataclasses import replace
+from time import time
 from typing import Dict
 from typing import List
 from unittest import TestCase
+from unittest.mock import patch
 
 from trio import open_nursery
+from trio import sleep
 
+from moves.triopubsub import KEEP_NONE
 from moves.triopubsub import Broker
+from moves.triopubsub import Overflow
+from moves.triopubsub import Retention
+from moves.triopubsub import matches
 
 from ._support_for_tests import anext
 from ._support_for_tests import atake
@@ -219,3 +227,375 @@ class TestTriopubsub(TestCase):
                 await b.remove_topic('t')
         finally:
             await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_retention_max_count(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str, retention=Retention(max_count=2))
+            for m in ['m1', 'm2', 'm3']:
+                b.send(m, 't')
+            self.assertListEqual(['m2', 'm3'], topic.messages)
+
+            s = b.add_subscription('t', 's', str)
+            self.assertEqual(2, s.s.statistics().current_buffer_used)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_retention_keep_none(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str, retention=KEEP_NONE)
+            s1 = b.add_subscription('t', 's1', str)
+            b.send('m', 't')
+            self.assertListEqual([], topic.messages)
+            self.assertEqual(1, s1.s.statistics().current_buffer_used)
+
+            s2 = b.add_subscription('t', 's2', str)
+            self.assertEqual(0, s2.s.statistics().current_buffer_used)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_retention_max_bytes(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str, retention=Retention(max_bytes=5,
+                                                              sizeof=len))
+            for m in ['aa', 'bb', 'cc']:
+                b.send(m, 't')
+            self.assertListEqual(['bb', 'cc'], topic.messages)
+            self.assertEqual(4, topic.history_bytes)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_retention_max_age(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str, retention=Retention(max_age=60))
+            b.send('m1', 't')
+            b.send('m2', 't')
+            # age the first message
+            old = topic.history[0]
+            topic.history[0] = replace(old, timestamp=old.timestamp - 120)
+
+            self.assertListEqual(['m2'], topic.messages)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_offsets(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('t', str, retention=Retention(max_count=3))
+            self.assertListEqual([0, 1, 2, 3, 4],
+                                 [b.send(m, 't') for m in 'abcde'])
+
+            records = await atake(2, b.subscribe_topic_records('t', str,
+                                                               offset=3))
+            self.assertListEqual([(3, 'd'), (4, 'e')],
+                                 [(r.offset, r.message) for r in records])
+
+            # evicted offsets: start from the oldest retained
+            self.assertListEqual(['c', 'd'],
+                                 await atake(2, b.subscribe_topic('t', str,
+                                                                  offset=0)))
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_resume(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('t', str)
+            for m in 'abc':
+                b.send(m, 't')
+
+            s = b.add_subscription('t', 's', str)
+            self.assertEqual(0, s.cursor)
+            self.assertListEqual(['a', 'b'],
+                                 await atake(2, b.subscribe('t', 's', str)))
+            cursor = s.cursor
+            await b.remove_subscription('t', 's')
+            self.assertEqual(2, cursor)
+
+            b.send('d', 't')
+            self.assertListEqual(['c', 'd'],
+                                 await atake(2, b.subscribe_topic('t', str,
+                                                                  offset=cursor)))
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_since(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str)
+            for m in 'abc':
+                b.send(m, 't')
+            since = topic.history[1].timestamp
+            topic.history[0] = replace(topic.history[0],
+                                       timestamp=since - 1)
+
+            s = b.add_subscription('t', 's', str, since=since)
+            self.assertEqual(2, s.s.statistics().current_buffer_used)
+            self.assertEqual(1, s.cursor)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_keyed_subscriptions(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str, key=lambda m: m[0])
+            b.send('a1', 't')
+            b.send('b1', 't')
+
+            sa = b.add_subscription('t', 'sa', str, key='a')
+            sall = b.add_subscription('t', 'sall', str)
+            self.assertEqual(1, sa.s.statistics().current_buffer_used)
+            self.assertEqual(2, sall.s.statistics().current_buffer_used)
+
+            b.send('a2', 't')
+            b.send('b2', 't')
+            self.assertListEqual(['a1', 'a2'],
+                                 await atake(2, b.subscribe('t', 'sa', str)))
+            self.assertEqual(0, sa.s.statistics().current_buffer_used)
+            self.assertEqual(4, sall.s.statistics().current_buffer_used)
+
+            await b.remove_subscription('t', 'sa')
+            self.assertDictEqual({}, topic.keyed_subscriptions)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_keyed_subscriptions_need_a_key(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('t', str)
+            with self.assertRaises(ValueError):
+                b.add_subscription('t', 's', str, key='k')
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_overflow(self) -> None:
+        async def received(overflow: Overflow, dropped: int) -> List[str]:
+            b = Broker()
+            try:
+                b.add_topic('t', str)
+                s = b.add_subscription('t', 's', str,
+                                       capacity=2, overflow=overflow)
+                for m in 'abcde':
+                    b.send(m, 't')
+                self.assertEqual(dropped, s.dropped)
+                return await atake(s.s.statistics().current_buffer_used,
+                                   b.subscribe('t', 's', str))
+            finally:
+                await b.aclose()
+
+        self.assertListEqual(['a', 'b'],
+                             await received(Overflow.DROP_NEWEST, 3))
+        self.assertListEqual(['d', 'e'],
+                             await received(Overflow.DROP_OLDEST, 3))
+        self.assertListEqual(['e'],
+                             await received(Overflow.COALESCE, 4))
+
+    @trio_test
+    @timeout(5)
+    async def test_overflow_disconnect(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('t', str)
+            s = b.add_subscription('t', 's', str, capacity=2)
+            for m in 'abc':
+                b.send(m, 't')
+            self.assertTrue(s.disconnected)
+            b.send('d', 't')
+            self.assertEqual(2, s.dropped)
+
+            # the consumer gets what was queued, then the end of the stream
+            acc: List[str] = []
+            async for m in b.subscribe('t', 's', str):
+                acc.append(m)
+            self.assertListEqual(['a', 'b'], acc)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_send_many(self) -> None:
+        b = Broker()
+        try:
+            topic = b.add_topic('t', str, key=lambda m: m[0])
+            b.send('a0', 't')
+
+            sa = b.add_subscription('t', 'sa', str, key='a')
+            sall = b.add_subscription('t', 'sall', str)
+
+            callbacks: List[List[str]] = []
+            b.register_on_send_many(lambda ms, _: callbacks.append(list(ms)))
+
+            self.assertListEqual([1, 2, 3],
+                                 b.send_many(['a1', 'b1', 'a2'], 't'))
+            self.assertListEqual([['a1', 'b1', 'a2']], callbacks)
+            self.assertListEqual(['a0', 'a1', 'b1', 'a2'], topic.messages)
+
+            self.assertListEqual([['a0', 'a1', 'a2']],
+                                 await atake(1, b.subscribe_batches('t', 'sa', str)))
+            self.assertListEqual([['a0', 'a1', 'b1', 'a2']],
+                                 await atake(1, b.subscribe_batches('t', 'sall', str)))
+            self.assertEqual(4, sa.cursor)
+            self.assertEqual(4, sall.cursor)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_subscribe_topic_batches(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('t', str)
+            b.send('m1', 't')
+            b.send('m2', 't')
+
+            acc: List[List[str]] = []
+            async with open_nursery() as nursery:
+                async def consumer() -> None:
+                    acc.extend(await atake(2, b.subscribe_topic_batches('t',
+                                                                        str)))
+                nursery.start_soon(consumer)
+
+                async def producer() -> None:
+                    await sleep(0.1)
+                    b.send('m3', 't')
+                nursery.start_soon(producer)
+
+            self.assertListEqual([['m1', 'm2'], ['m3']], acc)
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_metrics(self) -> None:
+        b = Broker(callback_sampling=1)
+        try:
+            b.add_topic('t', str, retention=Retention(sizeof=len))
+            b.register_on_send(lambda m, t: None)
+            b.send('m1', 't')
+            s = b.add_subscription('t', 's', str)
+            b.send_many(['m2', 'm3'], 't')
+
+            await atake(2, b.subscribe('t', 's', str))
+
+            metrics = await b.fetch_metrics()
+            topic = metrics['topics']['t']
+            self.assertEqual(3, topic['messages_in'])
+            self.assertEqual(2, topic['messages_out'])
+            self.assertEqual(3, topic['history_messages'])
+            self.assertEqual(6, topic['history_bytes'])
+
+            subscription = topic['subscriptions']['s']
+            self.assertEqual(1, subscription['depth'])
+            self.assertEqual(3, subscription['high_water'])
+            self.assertEqual(2, subscription['delivered'])
+            # m1 was replayed: only m2 counts for the latency
+            self.assertEqual(1, subscription['latency']['count'])
+            self.assertEqual(1, s.s.statistics().current_buffer_used)
+
+            [callback] = metrics['callbacks'].values()
+            self.assertEqual(2, callback['count'])
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_metrics_sampling(self) -> None:
+        b = Broker(callback_sampling=3)
+        try:
+            t = b.add_topic('t', str)
+            b.register_on_send(lambda m, t: None)
+            for message in ['m1', 'm2', 'm3', 'm4']:
+                b.send(message, 't')
+
+            # the first and the fourth send are timed
+            metrics = await b.fetch_metrics()
+            [callback] = metrics['callbacks'].values()
+            self.assertEqual(2, callback['count'])
+
+            # no division by zero on a coarse clock
+            t.created = time()
+            with patch('moves.triopubsub.time', return_value=t.created):
+                self.assertIsNone(t.metrics()['messages_in_per_second'])
+        finally:
+            await b.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_pattern_subscriptions(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('out/1', str)
+            b.add_topic('other', str)
+            b.send('1a', 'out/1')
+            b.send('x', 'other')
+
+            b.add_subscription('out/*', 's', str)
+            # a topic added later is attached too
+            b.add_topic('out/2', str)
+            b.send('2a', 'out/2')
+            b.send('1b', 'out/1')
+
+            self.assertListEqual(['1a', '2a', '1b'],
+                                 await atake(3, b.subscribe('out/*', 's', str)))
+
+            # the topics do not own (nor close) the shared subscription
+            await b.remove_topic('out/1')
+            b.send('2b', 'out/2')
+            self.assertListEqual(['2b'],
+                                 await atake(1, b.subscribe('out/*', 's', str)))
+
+            await b.remove_subscription('out/*', 's')
+            self.assertDictEqual({}, b.pattern_subscriptions)
+            self.assertDictEqual({}, b.topics['out/2'].subscriptions)
+        finally:
+            await b.aclose()
+
+    def test_matches(self) -> None:
+        self.assertTrue(matches('out/*', 'out/1'))
+        self.assertFalse(matches('out/*', 'out'))
+        self.assertFalse(matches('out/*', 'out/1/x'))
+        self.assertFalse(matches('out/*', 'in/1'))
+        self.assertTrue(matches('*/1', 'in/1'))
+
+    @trio_test
+    @timeout(5)
+    async def test_finish_topic(self) -> None:
+        b = Broker()
+        try:
+            b.add_topic('t1', str)
+            b.add_subscription('t*', 'pattern', str)
+            await b.finish_topic('t1')
+            # the pattern subscription does not keep the topic alive
+            self.assertNotIn('t1', b.topics)
+
+            b.add_topic('t2', str)
+            b.add_subscription('t2', 's', str)
+            await b.finish_topic('t2')
+            self.assertIn('t2', b.topics)
+            await b.remove_subscription('t2', 's')
+            self.assertNotIn('t2', b.topics)
+        finally:
+            await b.aclose()
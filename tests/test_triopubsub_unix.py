@@ -0,0 +1,152 @@
+from os import stat
+from os.path import join
+from stat import S_IMODE
+from tempfile import TemporaryDirectory
+from typing import Any
+from typing import List
+from unittest import TestCase
+
+from trio import TASK_STATUS_IGNORED
+from trio import CancelScope
+from trio import open_nursery
+from trio import open_unix_socket
+from trio.testing import wait_all_tasks_blocked
+
+from moves.triopubsub import Broker
+from moves.triopubsub_unix import _send_frames
+from moves.triopubsub_unix import open_remote_broker
+from moves.triopubsub_unix import serve_broker
+
+from ._support_for_tests import atake
+from ._support_for_tests import timeout
+from ._support_for_tests import trio_test
+
+
+def first_letter(message: str) -> str:
+    return message[0]
+
+
+class TestTriopubsubUnix(TestCase):
+    @trio_test
+    @timeout(5)
+    async def test_send_subscribe(self) -> None:
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'broker.sock')
+            broker = Broker()
+            try:
+                async with open_nursery() as nursery:
+                    await nursery.start(serve_broker, broker, path)
+
+                    async with open_remote_broker(path) as remote:
+                        remote.add_topic('t', str, key=first_letter)
+                        remote.send('a1', 't')
+                        remote.send_many(['b1', 'a2'], 't')
+
+                        self.assertListEqual(['a1', 'b1', 'a2'],
+                                             await atake(3, remote.subscribe_topic('t', str)))
+                        self.assertListEqual(['a1', 'a2'],
+                                             await atake(2, remote.subscribe_topic('t', str, key='a')))
+
+                        # the subscription is in place when the context is
+                        # entered: no old messages, but all the new ones
+                        acc: List[str] = []
+                        async with remote.tmp_subscription('t', str,
+                                                           send_old_messages=False) as s:
+                            remote.send('b2', 't')
+                            acc.extend(await atake(1, remote.subscribe('t', s, str)))
+                        self.assertListEqual(['b2'], acc)
+
+                        self.assertListEqual(['a1', 'b1', 'a2', 'b2'],
+                                             broker.topics['t'].messages)
+
+                        metrics = await remote.fetch_metrics()
+                        self.assertEqual(4, metrics['topics']['t']['messages_in'])
+
+                        records = await remote.fetch_records('t', str, offset=2)
+                        self.assertListEqual([(2, 'a2'), (3, 'b2')],
+                                             [(record.offset, record.message)
+                                              for record in records])
+
+                    nursery.cancel_scope.cancel()
+            finally:
+                await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_subscribe_unknown_topic(self) -> None:
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'broker.sock')
+            broker = Broker()
+            try:
+                async with open_nursery() as nursery:
+                    await nursery.start(serve_broker, broker, path)
+
+                    async with open_remote_broker(path) as remote:
+                        with self.assertRaises(KeyError):
+                            await atake(1, remote.subscribe_topic('nope', str))
+                        with self.assertRaises(KeyError):
+                            await remote.fetch_records('nope', str)
+
+                    nursery.cancel_scope.cancel()
+            finally:
+                await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_bad_clients(self) -> None:
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'broker.sock')
+            broker = Broker()
+            broker.add_topic('t', str)
+            try:
+                async with open_nursery() as nursery:
+                    await nursery.start(serve_broker, broker, path)
+                    self.assertEqual(0o600, S_IMODE(stat(path).st_mode))
+
+                    # gone before the reply, malformed hello, bad options
+                    for hello in [('metrics',), ('subscribe', 't'), 42,
+                                  ('subscribe', 't', {'nope': 1})]:
+                        async with await open_unix_socket(path) as stream:
+                            await _send_frames(stream, [hello])
+                    await wait_all_tasks_blocked()
+
+                    async with open_remote_broker(path) as remote:
+                        remote.send('a', 'nope')
+                        remote.send('b', 't')
+                        with self.assertRaises(KeyError):
+                            await remote.sync()
+                        await remote.sync()  # reported once
+
+                        self.assertListEqual(['b'],
+                                             await atake(1, remote.subscribe_topic('t', str)))
+                        self.assertListEqual(['b'], broker.topics['t'].messages)
+
+                    nursery.cancel_scope.cancel()
+            finally:
+                await broker.aclose()
+
+    @trio_test
+    @timeout(5)
+    async def test_sync_closed(self) -> None:
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, 'broker.sock')
+            broker = Broker()
+            try:
+                async with open_nursery() as nursery:
+                    server = CancelScope()
+
+                    async def serve(task_status: Any = TASK_STATUS_IGNORED) -> None:
+                        with server:
+                            await serve_broker(broker, path,
+                                               task_status=task_status)
+                    await nursery.start(serve)
+
+                    async with open_remote_broker(path) as remote:
+                        await remote.sync()
+                        server.cancel()  # closes the connections
+                        with self.assertRaises(BrokenPipeError):
+                            await remote.sync()
+                        with self.assertRaises(BrokenPipeError):
+                            await remote.fetch_records('t', str)
+            finally:
+                await broker.aclose()